@@ -0,0 +1,455 @@
+""" Benchmarks of client side of pytds
+
+Cases are run against fake server from tests/simple_server.py which replies
+with canned TDS token streams, so time is spent mostly in the client code.
+MARS case replays canned SMP stream through in-memory transport, because
+the fake server does not implement SMP.
+
+For every case best time of several runs is taken, data sets are fixed,
+so results can be compared between commits:
+
+    python profiling/benchmark.py --json before.json
+    # switch to another commit
+    python profiling/benchmark.py --compare before.json
+
+Names of cases to run can be given as arguments, a name matches all
+cases starting with it, e.g. ``fetch_narrow``.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import struct
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+import pytds
+import pytds.smp
+import pytds.tds
+from pytds.tds_base import PacketType, PreLoginEnc
+import simple_server
+
+
+_COLLATION = b'\x09\x04\xd0\x00\x34'
+_done = struct.Struct('<BHHQ')
+_packet_header = struct.Struct('>BBHHBx')
+
+
+def _date(i):
+    return struct.pack('<l', 737000 + i % 1000)[:3]
+
+
+def _nvarchar(i):
+    s = u'value {}'.format(i).encode('utf-16le')
+    return struct.pack('<H', len(s)) + s
+
+
+def _varchar(i):
+    s = 'value {}'.format(i).encode('ascii')
+    return struct.pack('<H', len(s)) + s
+
+
+# name, TYPE_INFO, column flags, function which encodes value for given row number
+TYPES = [
+    ('int', b'\x38', 0, lambda i: struct.pack('<l', i)),
+    ('bigint', b'\x7f', 0, lambda i: struct.pack('<q', i * 1000003)),
+    ('float', b'\x3e', 0, lambda i: struct.pack('<d', i * 0.25)),
+    ('bit', b'\x32', 0, lambda i: struct.pack('B', i & 1)),
+    ('intn', b'\x26\x04', 1, lambda i: b'\x04' + struct.pack('<l', i)),
+    ('decimal', b'\x6a\x09\x12\x04', 1, lambda i: b'\x09\x01' + struct.pack('<Q', i * 10007)),
+    ('money', b'\x3c', 0, lambda i: struct.pack('<lL', 0, i * 100)),
+    ('datetime', b'\x3d', 0, lambda i: struct.pack('<lL', 40000 + i % 1000, i % 25920000)),
+    ('datetime2', b'\x2a\x07', 1, lambda i: b'\x08' + struct.pack('<Q', i * 10 ** 7)[:5] + _date(i)),
+    ('date', b'\x28', 1, lambda i: b'\x03' + _date(i)),
+    ('guid', b'\x24\x10', 1, lambda i: b'\x10' + struct.pack('<QQ', i, i)),
+    ('nvarchar', b'\xe7' + struct.pack('<H', 100) + _COLLATION, 1, _nvarchar),
+    ('varchar', b'\xa7' + struct.pack('<H', 50) + _COLLATION, 1, _varchar),
+    ('varbinary', b'\xa5' + struct.pack('<H', 50), 1, lambda i: struct.pack('<Hl', 4, i)),
+]
+
+
+def colmetadata(columns):
+    """ Generates COLMETADATA token
+
+    :param columns: List of tuples (name, TYPE_INFO, flags)
+    """
+    res = [b'\x81', struct.pack('<h', len(columns))]
+    for name, type_info, flags in columns:
+        coded_name = name.encode('utf-16le')
+        res.append(struct.pack('<LH', 0, flags) + type_info + struct.pack('B', len(name)) + coded_name)
+    return b''.join(res)
+
+
+def done(rows_affected=0, status=pytds.tds_base.TDS_DONE_COUNT, marker=pytds.tds_base.TDS_DONE_TOKEN):
+    return _done.pack(marker, status, 0, rows_affected)
+
+
+def result_set(types, rows):
+    """ Generates result set with columns of given types
+
+    :param types: List of items from TYPES
+    :param rows: Number of rows
+    """
+    columns = [('c{}'.format(i), type_info, flags) for i, (_, type_info, flags, _) in enumerate(types)]
+    encoders = [enc for _, _, _, enc in types]
+    body = b''.join(b'\xd1' + b''.join(enc(i) for enc in encoders) for i in range(rows))
+    return colmetadata(columns) + body + done(rows)
+
+
+def nbcrow_result_set(num_columns, rows):
+    """ Generates result set of nullable INT columns, most of the values are NULL
+    """
+    columns = [('c{}'.format(i), b'\x26\x04', 1) for i in range(num_columns)]
+    bitmap_size = (num_columns + 7) // 8
+    body = []
+    for i in range(rows):
+        bitmap = 0
+        values = []
+        for j in range(num_columns):
+            if (i + j) % 8:
+                bitmap |= 1 << j
+            else:
+                values.append(b'\x04' + struct.pack('<l', i))
+        body.append(b'\xd2' + bitmap.to_bytes(bitmap_size, 'little') + b''.join(values))
+    return colmetadata(columns) + b''.join(body) + done(rows)
+
+
+def plp(data, chunk_size=8000):
+    res = [struct.pack('<Q', len(data))]
+    for pos in range(0, len(data), chunk_size):
+        chunk = data[pos:pos + chunk_size]
+        res.append(struct.pack('<L', len(chunk)) + chunk)
+    res.append(struct.pack('<L', 0))
+    return b''.join(res)
+
+
+def lob_result_set(type_info, value, rows):
+    """ Generates result set with single MAX column with given value in every row
+    """
+    row = b'\xd1' + plp(value)
+    return colmetadata([('c', type_info, 1)]) + row * rows + done(rows)
+
+
+class Server(object):
+    """ Fake server running in a background thread
+
+    Requests are answered by a handler, handler can be replaced between cases.
+    """
+    def __init__(self, enc=PreLoginEnc.ENCRYPT_NOT_SUP, cert=None, key=None):
+        self._server = simple_server.SimpleServer(('127.0.0.1', 0), enc=enc, cert=cert, pkey=key)
+        self._server.set_request_handler(self._handle)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self.handler = None
+        # number of bytes received in requests
+        self.received = 0
+
+    def _handle(self, packet_type, payload):
+        self.received += len(payload)
+        return self.handler(packet_type, payload)
+
+    def connect(self, **kwargs):
+        host, port = self._server.server_address
+        return pytds.connect(dsn=host, port=port, user='sa', password='password',
+                             disable_connect_retry=True, autocommit=True, **kwargs)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def fetch_case(server, conn, response, rows):
+    def handler(packet_type, payload):
+        return response
+
+    def run():
+        server.handler = handler
+        with conn.cursor() as cur:
+            cur.execute('select')
+            assert len(cur.fetchall()) == rows
+        return rows, len(response)
+    return run
+
+
+def executemany_case(server, conn, rows, batch_size=None):
+    rpc_marker = b'\xff\xff' + struct.pack('<H', pytds.tds_base.TDS_SP_EXECUTESQL)
+    inner = done(1, pytds.tds_base.TDS_DONE_COUNT | pytds.tds_base.TDS_DONE_MORE_RESULTS,
+                 pytds.tds_base.TDS_DONEINPROC_TOKEN)
+    more = inner + done(1, pytds.tds_base.TDS_DONE_COUNT | pytds.tds_base.TDS_DONE_MORE_RESULTS,
+                        pytds.tds_base.TDS_DONEPROC_TOKEN)
+    last = inner + done(1, pytds.tds_base.TDS_DONE_COUNT, pytds.tds_base.TDS_DONEPROC_TOKEN)
+
+    def handler(packet_type, payload):
+        calls = payload.count(rpc_marker)
+        return more * (calls - 1) + last
+
+    params = [(i, i * 0.25, u'value {}'.format(i)) for i in range(rows)]
+
+    def run():
+        server.handler = handler
+        server.received = 0
+        with conn.cursor() as cur:
+            cur.executemany('insert into t values (%s, %s, %s)', params, batch_size=batch_size)
+        return rows, server.received
+    return run
+
+
+def copy_to_case(server, conn, rows):
+    metadata = colmetadata([
+        ('id', b'\x38', 0),
+        ('value', b'\x6d\x08', 1),  # FLTN(8)
+        ('name', b'\xe7' + struct.pack('<H', 100) + _COLLATION, 1),
+    ]) + done(0)
+
+    def handler(packet_type, payload):
+        if packet_type == PacketType.QUERY and u'select top 0'.encode('utf-16le') in payload:
+            return metadata
+        return done(0)
+
+    data = [(i, i * 0.25, u'value {}'.format(i)) for i in range(rows)]
+
+    def run():
+        server.handler = handler
+        server.received = 0
+        with conn.cursor() as cur:
+            cur.copy_to(data=data, table_or_view='t', columns=['id', 'value', 'name'])
+        return rows, server.received
+    return run
+
+
+def tvp_case(server, conn, rows):
+    def handler(packet_type, payload):
+        return done(0, 0)
+
+    data = [(i, u'value {}'.format(i)) for i in range(rows)]
+
+    def run():
+        server.handler = handler
+        server.received = 0
+        with conn.cursor() as cur:
+            tvp = pytds.TableValuedParam(type_name='dbo.T', rows=data)
+            cur.execute('exec p %s', (tvp,))
+        return rows, server.received
+    return run
+
+
+class ReplaySock(object):
+    """ Transport which replays given data, sent data is discarded
+    """
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def recv(self, size):
+        res = self._data[self._pos:self._pos + size].tobytes()
+        self._pos += len(res)
+        return res
+
+    def recv_into(self, buffer, size=0):
+        if size == 0:
+            size = len(buffer)
+        res = self._data[self._pos:self._pos + size]
+        buffer[:len(res)] = res
+        self._pos += len(res)
+        return len(res)
+
+    def sendall(self, data, flags=0):
+        pass
+
+    def close(self):
+        pass
+
+
+def smp_stream(responses, packet_size=4096):
+    """ Generates SMP stream with responses for several sessions
+
+    Response of every session is split into TDS packets, SMP DATA packets
+    of the sessions follow each other in round robin order.
+    """
+    sessions_packets = []
+    for response in responses:
+        chunk_size = packet_size - _packet_header.size
+        chunks = [response[pos:pos + chunk_size] for pos in range(0, len(response), chunk_size)]
+        packets = []
+        for i, chunk in enumerate(chunks):
+            status = 1 if i == len(chunks) - 1 else 0
+            packets.append(_packet_header.pack(PacketType.REPLY, status, len(chunk) + _packet_header.size,
+                                               0, i % 256) + chunk)
+        sessions_packets.append(packets)
+    res = []
+    for seq_num in range(max(len(packets) for packets in sessions_packets)):
+        for sid, packets in enumerate(sessions_packets):
+            if seq_num < len(packets):
+                packet = packets[seq_num]
+                res.append(pytds.smp.SMP_HEADER.pack(pytds.smp.SMP_ID, pytds.smp.PacketTypes.DATA, sid,
+                                                     pytds.smp.SMP_HEADER.size + len(packet), seq_num + 1, 4))
+                res.append(packet)
+    return b''.join(res)
+
+
+def mars_case(num_sessions, rows):
+    response = result_set([TYPES[0]], rows)
+    stream = smp_stream([response] * num_sessions)
+
+    def run():
+        tds = pytds.tds._TdsSocket()
+        mgr = pytds.smp.SmpManager(ReplaySock(stream))
+        sessions = [pytds.tds._TdsSession(tds, mgr.create_session(), None) for _ in range(num_sessions)]
+        for sess in sessions:
+            sess.state = pytds.tds_base.TDS_PENDING
+            sess.find_result_or_done()
+        for _ in range(rows):
+            for sess in sessions:
+                sess.fetchone()
+        for sess in sessions:
+            assert sess.fetchone() is None
+        return rows * num_sessions, len(stream)
+    return run
+
+
+def tls_certificate():
+    """ Generates certificate of the fake server using test CA
+
+    :returns: Tuple of path to CA certificate, server certificate and key
+    """
+    import OpenSSL.crypto
+    from cryptography import x509
+    import utils_35
+    test_ca = utils_35.TestCA()
+    key = test_ca.key('server')
+    subject = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, '127.0.0.1')])
+    builder = (x509.CertificateBuilder()
+               .subject_name(subject)
+               .not_valid_before(datetime.datetime.utcnow())
+               .not_valid_after(datetime.datetime.utcnow() + datetime.timedelta(days=1))
+               .serial_number(x509.random_serial_number())
+               .public_key(key.public_key()))
+    cert = test_ca.sign(name='server', cb=builder)
+    return (test_ca.cert_path('root'),
+            OpenSSL.crypto.X509.from_cryptography(cert),
+            OpenSSL.crypto.PKey.from_cryptography_key(key))
+
+
+def scaled(n, scale):
+    return max(1, int(n * scale))
+
+
+def make_cases(server, conn, tls_conns, scale):
+    """ Returns list of tuples (name, function creating case)
+
+    Case is a function which runs benchmarked operation once and returns
+    number of processed rows and bytes.
+    """
+    cases = []
+    for typ in TYPES:
+        rows = scaled(100000, scale)
+        cases.append(('fetch_narrow_' + typ[0],
+                      lambda typ=typ, rows=rows: fetch_case(server, conn, result_set([typ], rows), rows)))
+    rows = scaled(20000, scale)
+    cases.append(('fetch_wide', lambda rows=rows: fetch_case(server, conn, result_set(TYPES * 2, rows), rows)))
+    rows = scaled(50000, scale)
+    cases.append(('fetch_nbcrow_nulls', lambda rows=rows: fetch_case(
+        server, conn, nbcrow_result_set(32, rows), rows)))
+    lob_rows = scaled(500, scale)
+    nvarchar_max = b'\xe7\xff\xff' + _COLLATION
+    cases.append(('fetch_lob_nvarchar', lambda: fetch_case(
+        server, conn, lob_result_set(nvarchar_max, u'x'.encode('utf-16le') * 32768, lob_rows), lob_rows)))
+    cases.append(('fetch_lob_varbinary', lambda: fetch_case(
+        server, conn, lob_result_set(b'\xa5\xff\xff', b'\x01' * 65536, lob_rows), lob_rows)))
+    rows = scaled(20000, scale)
+    cases.append(('executemany', lambda rows=rows: executemany_case(server, conn, rows)))
+    cases.append(('executemany_batched', lambda rows=rows: executemany_case(server, conn, rows, batch_size=100)))
+    rows = scaled(50000, scale)
+    cases.append(('copy_to', lambda rows=rows: copy_to_case(server, conn, rows)))
+    cases.append(('tvp', lambda rows=rows: tvp_case(server, conn, rows)))
+    rows = scaled(25000, scale)
+    cases.append(('mars_interleaved', lambda rows=rows: mars_case(4, rows)))
+    rows = scaled(100000, scale)
+    for prefix, tls_server, tls_conn in tls_conns:
+        cases.append((prefix + '_fetch_narrow_int', lambda tls_server=tls_server, tls_conn=tls_conn, rows=rows:
+                      fetch_case(tls_server, tls_conn, result_set([TYPES[0]], rows), rows)))
+    return cases
+
+
+def measure(run, repeat):
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        rows, size = run()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'rows': rows, 'bytes': size, 'seconds': best,
+            'rows_per_sec': rows / best, 'mb_per_sec': size / best / 1e6}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs pytds benchmarks against fake TDS server')
+    parser.add_argument('cases', nargs='*', help='prefixes of names of cases to run, all by default')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of every case, best is reported')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for number of rows in data sets')
+    parser.add_argument('--json', help='file to save results to')
+    parser.add_argument('--compare', help='file with saved results to compare with')
+    parser.add_argument('--no-tls', action='store_true', help='skip TLS cases')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    server = Server()
+    conn = server.connect()
+    # TLS connections with pyOpenSSL and with standard ssl module backends
+    tls_conns = []
+    if not args.no_tls:
+        try:
+            cafile, cert, key = tls_certificate()
+        except ImportError as ex:
+            print('TLS case is skipped: {}'.format(ex))
+        else:
+            backends = [('tls', 'openssl')]
+            if pytds.tls.SSL_OBJECT_AVAILABLE:
+                backends.append(('tls_ssl', 'ssl'))
+            for prefix, backend in backends:
+                # fake server handles one connection at a time
+                tls_server = Server(enc=PreLoginEnc.ENCRYPT_ON, cert=cert, key=key)
+                tls_conns.append((prefix, tls_server, tls_server.connect(cafile=cafile, tls_backend=backend)))
+
+    results = {}
+    print('{:<28}{:>10}{:>14}{:>10}{:>10}'.format('case', 'rows', 'rows/sec', 'MB/sec', 'change'))
+    try:
+        for name, make_case in make_cases(server, conn, tls_conns, args.scale):
+            if args.cases and not any(name.startswith(prefix) for prefix in args.cases):
+                continue
+            res = measure(make_case(), args.repeat)
+            results[name] = res
+            change = ''
+            if name in baseline:
+                change = '{:+.1f}%'.format((res['rows_per_sec'] / baseline[name]['rows_per_sec'] - 1) * 100)
+            print('{:<28}{:>10}{:>14.0f}{:>10.1f}{:>10}'.format(
+                name, res['rows'], res['rows_per_sec'], res['mb_per_sec'], change))
+    finally:
+        conn.close()
+        server.close()
+        for _, tls_server, tls_conn in tls_conns:
+            tls_conn.close()
+            tls_server.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'scale': args.scale,
+                       'repeat': args.repeat,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ HEADER = struct.Struct('>BBHHBx')
 
 
 class Sock:
+    """ Socket which provides endless stream of packets, as many
+    as fit into the buffer are returned by a single recv_into call
+    """
     def __init__(self):
         self._read_pos = 0
         self._buf = bytearray(b'\x00' * BUFSIZE)
@@ -20,12 +23,13 @@ class Sock:
     def recv_into(self, buffer, size=0):
         if size == 0:
             size = len(buffer)
-        if self._read_pos >= BUFSIZE:
-            HEADER.pack_into(self._buf, 0, 0, 0, BUFSIZE, 0, 0)
-            self._read_pos = 0
-        to_read = min(size, BUFSIZE - self._read_pos)
-        buffer[:to_read] = self._buf[self._read_pos:self._read_pos+to_read]
-        return to_read
+        pos = 0
+        while pos < size:
+            to_read = min(size - pos, BUFSIZE - self._read_pos)
+            buffer[pos:pos + to_read] = self._buf[self._read_pos:self._read_pos + to_read]
+            pos += to_read
+            self._read_pos = (self._read_pos + to_read) % BUFSIZE
+        return size
 
     def recv(self, size):
         if self._read_pos >= len(self._buf):
@@ -2,11 +2,17 @@
 from collections import deque
 import datetime
 import errno
+import functools
+import itertools
 import keyword
 import os
 import re
+import select
 import six
 import socket
+import sys
+import threading
+import time
 import uuid
 import warnings
 import weakref
@@ -17,9 +23,10 @@ from six.moves import xrange
 from pytds.tds_types import NVarCharType
 from . import lcid
 import pytds.tz
+import pytds.observer
 from .tds import (
     _TdsSocket, tds7_get_instances,
-    _create_exception_by_message,
+    _create_exception_by_message, _RowDecoder,
     output, default
 )
 from . import tds_base
@@ -32,9 +39,11 @@ from .tds_base import (
     PreLoginEnc)
 
 from .tds_types import (
-    TableValuedParam, Binary
+    TableValuedParam, Binary, LobReader, _is_stream
 )
 
+from .observer import Observer
+
 from .tds_base import (
     ROWID, DECIMAL, STRING, BINARY, NUMBER, DATETIME, INTEGER, REAL, XML
 )
@@ -148,20 +157,290 @@ def recordtype_row_strategy(column_names):
     return row_factory
 
 
-class _ConnectionPool(object):
-    def __init__(self, max_pool_size=100, min_pool_size=0):
-        self._max_pool_size = max_pool_size
-        self._pool = {}
+def _is_connection_alive(tds_socket):
+    """ Checks that pooled connection was not closed by the server while it was idle
 
-    def add(self, key, conn):
-        l = self._pool.setdefault(key, []).append(conn)
+    Idle connection should not have any data to read, readable socket means
+    that it was closed by the server or that the stream is out of sync.
+    """
+    if not tds_socket.is_connected():
+        return False
+    sock = tds_socket.sock
+    # check underlying socket of TLS connection
+    sock = getattr(sock, '_transport', sock)
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (TypeError, ValueError, select.error, socket.error):
+        # not a real socket
+        return True
+    return not readable
 
-    def take(self, key):
-        l = self._pool.get(key, [])
-        if len(l) > 0:
-            return l.pop()
-        else:
+
+class _PoolEntry(object):
+    """ Slot of a connection pool
+
+    Slot is reserved by :meth:`_Pool.acquire`, if ``tds_socket`` is None
+    it is responsibility of the caller to open new connection and to attach it
+    to the slot.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.tds_socket = None
+        self.session = None
+        self.created = None
+        self.last_used = None
+
+    def attach(self, tds_socket, session):
+        self.tds_socket = tds_socket
+        self.session = session
+        self.created = self.last_used = time.time()
+
+
+class _Pool(object):
+    """ Thread-safe pool of connections opened with the same parameters
+
+    :param max_size: Maximum number of opened connections, both idle and in use
+    :param min_size: Number of connections which pool tries to keep open
+    :param idle_timeout: Idle connections are closed after this number of seconds,
+      None disables idle eviction
+    :param max_lifetime: Connections are closed when they are older than this number of seconds,
+      None disables lifetime eviction
+
+    Expired connections are evicted when connections are taken from the pool or
+    returned into it, and by a background thread which runs while there are
+    idle connections which can expire, so they are closed when pool is not used.
+    """
+    def __init__(self, max_size=100, min_size=0, idle_timeout=None, max_lifetime=None):
+        if max_size < 1:
+            raise ValueError('max_pool_size should be positive')
+        if min_size > max_size:
+            raise ValueError('min_pool_size should not be greater than max_pool_size')
+        self._max_size = max_size
+        self._min_size = min_size
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()
+        self._size = 0  # number of reserved slots including idle ones
+        self._waiting = 0
+        self._prewarming = False
+        self._reaping = False
+        self._opened = 0
+        self._closed = 0
+        self._timeouts = 0
+
+    def _is_expired(self, entry, now):
+        if self._max_lifetime is not None and now - entry.created > self._max_lifetime:
+            return True
+        return self._idle_timeout is not None and now - entry.last_used > self._idle_timeout
+
+    def _evict(self):
+        """ Removes expired idle connections, should be called under lock
+
+        Idle timeout does not apply to connections needed to keep min_size.
+
+        :returns: List of removed entries, they should be closed outside of the lock
+        """
+        now = time.time()
+        evicted = []
+        kept = deque()
+        for entry in self._idle:
+            lifetime_expired = self._max_lifetime is not None and now - entry.created > self._max_lifetime
+            if lifetime_expired or (self._is_expired(entry, now) and self._size - len(evicted) > self._min_size):
+                evicted.append(entry)
+            else:
+                kept.append(entry)
+        self._idle = kept
+        self._size -= len(evicted)
+        self._closed += len(evicted)
+        return evicted
+
+    def _next_eviction_delay(self):
+        """ Returns number of seconds until the next idle connection expires, should be called under lock
+
+        :returns: None if no idle connection can expire
+        """
+        times = []
+        for entry in self._idle:
+            if self._max_lifetime is not None:
+                times.append(entry.created + self._max_lifetime)
+            if self._idle_timeout is not None and self._size > self._min_size:
+                times.append(entry.last_used + self._idle_timeout)
+        if not times:
             return None
+        # connection expires once the timeout is exceeded, so checking is done a bit later
+        return max(min(times) - time.time(), 0) + 0.01
+
+    def _start_reaper(self):
+        """ Starts background thread which evicts expired idle connections, should be called under lock """
+        if self._reaping or (self._idle_timeout is None and self._max_lifetime is None):
+            return
+        self._reaping = True
+        thread = threading.Thread(target=self._reap, name='pytds-pool-reaper')
+        thread.daemon = True
+        thread.start()
+
+    def _reap(self):
+        while True:
+            with self._cond:
+                evicted = self._evict()
+                delay = self._next_eviction_delay()
+                if delay is None:
+                    self._reaping = False
+            self._close_entries(evicted)
+            if delay is None:
+                return
+            time.sleep(delay)
+
+    @staticmethod
+    def _close_entries(entries):
+        for entry in entries:
+            try:
+                entry.tds_socket.close()
+            except Exception:
+                logger.debug('Error while closing pooled connection', exc_info=True)
+
+    def acquire(self, timeout=None):
+        """ Takes idle connection from the pool or reserves slot for a new connection
+
+        Blocks while all max_size connections are in use.
+
+        :param timeout: Maximum number of seconds to wait, None means wait forever
+        :returns: An instance of :class:`_PoolEntry`
+        :raises TimeoutError: If no connection became available in time
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._cond:
+                evicted = self._evict()
+                entry = None
+                while entry is None:
+                    if self._idle:
+                        # most recently used connection is most likely to be alive
+                        entry = self._idle.pop()
+                    elif self._size < self._max_size:
+                        self._size += 1
+                        self._opened += 1
+                        entry = _PoolEntry(self)
+                    else:
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            self._timeouts += 1
+                            break
+                        self._waiting += 1
+                        try:
+                            self._cond.wait(remaining)
+                        finally:
+                            self._waiting -= 1
+            self._close_entries(evicted)
+            if entry is None:
+                raise TimeoutError('Timed out waiting for a connection from the pool, '
+                                   'all {0} connections are in use'.format(self._max_size))
+            if entry.tds_socket is None or _is_connection_alive(entry.tds_socket):
+                return entry
+            logger.info('Discarding dead connection from the pool')
+            self.discard(entry)
+
+    def release(self, entry):
+        """ Returns connection into the pool
+
+        Connection is closed if it is broken or expired.
+        """
+        if entry.tds_socket is None or not entry.tds_socket.is_connected():
+            self.discard(entry)
+            return
+        entry.last_used = time.time()
+        if self._max_lifetime is not None and entry.last_used - entry.created > self._max_lifetime:
+            self.discard(entry)
+            return
+        with self._cond:
+            self._idle.append(entry)
+            evicted = self._evict()
+            self._start_reaper()
+            self._cond.notify()
+        self._close_entries(evicted)
+
+    def discard(self, entry):
+        """ Closes connection and frees its slot """
+        with self._cond:
+            self._size -= 1
+            self._closed += 1
+            self._cond.notify()
+        if entry.tds_socket is not None:
+            self._close_entries([entry])
+
+    def prewarm(self, factory):
+        """ Opens connections in background thread until pool has min_size connections
+
+        :param factory: Callable which opens new connection and returns
+          tuple of :class:`pytds.tds._TdsSocket` and its main session
+        """
+        with self._cond:
+            if self._prewarming or self._size >= self._min_size:
+                return
+            self._prewarming = True
+        thread = threading.Thread(target=self._prewarm, args=(factory,), name='pytds-pool-prewarm')
+        thread.daemon = True
+        thread.start()
+
+    def _prewarm(self, factory):
+        try:
+            while True:
+                with self._cond:
+                    if self._size >= self._min_size:
+                        return
+                    self._size += 1
+                    self._opened += 1
+                entry = _PoolEntry(self)
+                try:
+                    entry.attach(*factory())
+                except Exception:
+                    logger.warning('Failed to open connection to pre-warm the pool', exc_info=True)
+                    self.discard(entry)
+                    return
+                self.release(entry)
+        finally:
+            with self._cond:
+                self._prewarming = False
+
+    def stats(self):
+        """ Returns dictionary with the current state and counters of the pool """
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'waiting': self._waiting,
+                'max_size': self._max_size,
+                'min_size': self._min_size,
+                'opened': self._opened,
+                'closed': self._closed,
+                'timeouts': self._timeouts,
+            }
+
+
+class _ConnectionPool(object):
+    """ Collection of pools, one pool for every unique set of connection parameters """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def get(self, key, max_pool_size=100, min_pool_size=0, idle_timeout=None, max_lifetime=None):
+        """ Returns pool for the key creating new pool if necessary """
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = _Pool(max_size=max_pool_size, min_size=min_pool_size,
+                             idle_timeout=idle_timeout, max_lifetime=max_lifetime)
+                self._pools[key] = pool
+            return pool
+
+    def stats(self):
+        """ Returns dictionary of pool statistics by pool key, see :meth:`_Pool.stats` """
+        with self._lock:
+            pools = list(self._pools.items())
+        return dict((key, pool.stats()) for key, pool in pools)
 
 
 _connection_pool = _ConnectionPool()
@@ -181,6 +460,10 @@ class Connection(object):
         self._tzinfo_factory = None
         self._key = None
         self._pooling = False
+        self._pool_params = {}
+        self._pool_timeout = None
+        self._pool_entry = None
+        self._observer = None
 
     @property
     def as_dict(self):
@@ -274,6 +557,19 @@ class Connection(object):
         """
         return self._conn.mars_enabled
 
+    @property
+    def observer(self):
+        """ Instance of :class:`pytds.observer.Observer` which is notified about
+        requests sent over this connection, None if requests are not observed
+        """
+        return self._observer
+
+    @observer.setter
+    def observer(self, value):
+        self._observer = value
+        if self._conn is not None:
+            self._conn.observer = value
+
     def _connect(self, host, port, instance, timeout):
         login = self._login
 
@@ -298,6 +594,8 @@ class Connection(object):
 
         sock.settimeout(timeout)
         conn = _TdsSocket(self._use_tz)
+        conn.server_address = (host, port)
+        conn.observer = self._observer
         self._conn = conn
         try:
             route = conn.login(login, sock, self._tzinfo_factory)
@@ -331,9 +629,25 @@ class Connection(object):
 
     def _try_open(self, timeout):
         if self._pooling:
-            res = _connection_pool.take(self._key)
-            if res is not None:
-                self._conn, sess = res
+            pool = _connection_pool.get(self._key, **self._pool_params)
+            pool_timeout = self._pool_timeout
+            if pool_timeout is None:
+                pool_timeout = self._login.connect_timeout
+            observer = self._observer
+            if observer is None:
+                entry = pool.acquire(timeout=pool_timeout)
+            else:
+                started = pytds.observer.timer()
+                try:
+                    entry = pool.acquire(timeout=pool_timeout)
+                except Exception as ex:
+                    observer.pool_checkout(self, pytds.observer.timer() - started, ex)
+                    raise
+                observer.pool_checkout(self, pytds.observer.timer() - started, None)
+            self._pool_entry = entry
+            if entry.tds_socket is not None:
+                self._conn, sess = entry.tds_socket, entry.session
+                self._conn.observer = self._observer
                 if self._conn.mars_enabled:
                     cursor = _MarsCursor(
                         self,
@@ -345,15 +659,51 @@ class Connection(object):
                         sess,
                         self._tzinfo_factory)
                 self._active_cursor = self._main_cursor = cursor
-                cursor.callproc('sp_reset_connection')
+                # reset is sent along with the first request, it rolls back
+                # transaction left by the previous user of the connection
+                sess._writer.reset_connection()
+                self._conn.tds72_transaction = 0
+                if self._conn.prepared_cache is not None:
+                    self._conn.prepared_cache.clear()
                 return
 
         login = self._login
         host, port, instance = login.servers[0]
-        self._connect(host=host, port=port, instance=instance, timeout=timeout)
+        try:
+            self._connect(host=host, port=port, instance=instance, timeout=timeout)
+        except:
+            self._discard_pool_entry()
+            raise
+        if self._pool_entry is not None:
+            self._pool_entry.attach(self._conn, self._main_cursor._session)
+            self._pool_entry.pool.prewarm(self._open_for_pool)
+
+    def _discard_pool_entry(self):
+        entry = self._pool_entry
+        if entry is not None:
+            self._pool_entry = None
+            entry.pool.discard(entry)
+
+    def _open_for_pool(self):
+        """ Opens new physical connection with parameters of this connection
+
+        Used to pre-warm connection pool.
+
+        :returns: Tuple of :class:`pytds.tds._TdsSocket` and its main session
+        """
+        conn = Connection()
+        conn._login = self._login
+        conn._use_tz = self._use_tz
+        conn._autocommit = self._autocommit
+        conn._isolation_level = self._isolation_level
+        conn._tzinfo_factory = self._tzinfo_factory
+        conn._open()
+        return conn._conn, conn._main_cursor._session
 
     def _open(self):
         import time
+        # slot of the broken connection should be released
+        self._discard_pool_entry()
         self._conn = None
         self._dirty = False
         login = self._login
@@ -454,6 +804,58 @@ class Connection(object):
                           self._conn.main_session,
                           self._tzinfo_factory)
 
+    def execute_concurrently(self, operations, timeout=None):
+        """ Executes several statements concurrently, each in its own MARS session
+
+        All requests are sent before waiting for any response, so that round trips
+        and execution of statements overlap.  Results can be read from returned cursors
+        in any order, packets of cursors which are not read at the moment are buffered
+        within receive windows of their sessions, after that server waits until they
+        are read.  Requires connection opened with ``use_mars=True``.
+
+        Example::
+
+            totals, recent = conn.execute_concurrently([
+                'select count(*) from orders',
+                ('select top 10 * from orders where customer_id = %s order by id desc', (customer_id,)),
+            ])
+            with totals, recent:
+                count = totals.fetchone()[0]
+                rows = recent.fetchall()
+
+        :param operations: Sequence of SQL statements, or of tuples of statement and its parameters
+        :keyword timeout: Timeout in seconds for every statement, see :meth:`Cursor.execute`
+        :returns: List of cursors in the order of statements, positioned on first result
+          sets of the statements, cursors should be closed by the caller
+        """
+        self._assert_open()
+        if not self.mars_enabled:
+            raise InterfaceError('Concurrent execution requires MARS, connect with use_mars=True')
+        cursors = []
+        try:
+            for operation in operations:
+                if isinstance(operation, six.string_types):
+                    operation, params = operation, ()
+                else:
+                    operation, params = operation
+                cursor = self.cursor()
+                cursors.append(cursor)
+                if len(cursors) == 1:
+                    cursor._ensure_transaction()
+                cursor._submit_execute(operation, params, timeout)
+            for cursor in cursors:
+                cursor._find_submitted_result()
+        except:
+            exc_info = sys.exc_info()
+            for cursor in cursors:
+                try:
+                    cursor.close()
+                except Exception:
+                    # connection can be broken already, original error is more important
+                    logger.debug('failed to close cursor', exc_info=True)
+            six.reraise(*exc_info)
+        return cursors
+
     def rollback(self):
         """
         Roll back transaction which is currently in progress.
@@ -486,8 +888,9 @@ class Connection(object):
         this case.
         """
         if self._conn:
-            if self._pooling:
-                _connection_pool.add(self._key, (self._conn, self._main_cursor._session))
+            if self._pool_entry is not None:
+                entry, self._pool_entry = self._pool_entry, None
+                entry.pool.release(entry)
             else:
                 self._conn.close()
             self._active_cursor = None
@@ -506,6 +909,65 @@ class Connection(object):
             self._active_cursor = cursor
 
 
+def _observed(kind, arg_index, arg_name):
+    """ Decorator for cursor methods performing database operations
+
+    If connection has an observer, it is notified about start and end of the
+    operation.  Name of the operation is taken from argument of the method
+    given by position or by keyword.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            conn = self._conn
+            if conn is not None:
+                conn = conn()
+            if conn is None or conn._observer is None or pytds.observer.current_operation() is not None:
+                return method(self, *args, **kwargs)
+            name = args[arg_index] if len(args) > arg_index else kwargs.get(arg_name)
+            return _observe_operation(conn, kind, name, method, self, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def _observe_operation(conn, kind, name, method, cursor, args, kwargs):
+    observer = conn._observer
+    # previous operation is completed when cursor is reused
+    cursor._end_operation()
+    if conn._conn is not None and conn._conn.server_address is not None:
+        server, port = conn._conn.server_address
+        database = conn._conn.env.database
+    else:
+        server, port, _ = conn._login.servers[0]
+        database = None
+    operation = pytds.observer.OperationStats(kind, name, conn, server, port, database)
+    pytds.observer.set_current_operation(operation)
+    try:
+        observer.operation_started(operation)
+        return method(cursor, *args, **kwargs)
+    except Exception as ex:
+        operation.error = ex
+        raise
+    finally:
+        pytds.observer.set_current_operation(None)
+        finish = functools.partial(_finish_operation, observer, cursor, operation)
+        if operation.error is not None:
+            finish()
+        else:
+            # results are fetched after the method returns, operation is completed
+            # when they are consumed, or when cursor is closed or reused
+            cursor._operation = operation
+            operation._finish_when_completed(finish)
+
+
+def _finish_operation(observer, cursor, operation):
+    if cursor._operation is operation:
+        cursor._operation = None
+    operation.end_time = pytds.observer.timer()
+    operation.rowcount = cursor.rowcount
+    observer.operation_finished(operation)
+
+
 class Cursor(six.Iterator):
     """
     This class represents a database cursor, which is used to issue queries
@@ -514,8 +976,11 @@ class Cursor(six.Iterator):
     def __init__(self, conn, session, tzinfo_factory):
         self._conn = weakref.ref(conn)
         self.arraysize = 1
+        self.executemany_batch_size = 1
         self._session = session
         self._tzinfo_factory = tzinfo_factory
+        # observed operation which results are not consumed yet
+        self._operation = None
 
     def _assert_open(self):
         conn = self._conn
@@ -547,11 +1012,13 @@ class Cursor(six.Iterator):
             column_names = [col[0] for col in self._session.res_info.description]
             self._row_factory = conn._row_strategy(column_names)
 
+    @_observed('callproc', 0, 'procname')
     def _callproc(self, procname, parameters):
         self._ensure_transaction()
         results = list(parameters)
         parameters = self._session._convert_params(parameters)
-        self._exec_with_retry(lambda: self._session.submit_rpc(procname, parameters, 0))
+        self._exec_with_retry(lambda: self._session.submit_rpc(procname, parameters, 0),
+                              retry=not _has_single_pass_params(parameters))
         self._session.process_rpc()
         for key, param in self._session.output_params.items():
             results[key] = param.value
@@ -625,15 +1092,27 @@ class Cursor(six.Iterator):
 
     def cancel(self):
         """ Cancel current statement
+
+        Sends cancel request to the server without waiting for acknowledgement,
+        rows of the current result set which were not fetched yet are discarded
+        and the rest of the response is skipped by the next request.  Can be
+        called from another thread to stop statement which is being executed or
+        fetched by the thread using the cursor.
         """
-        conn = self._assert_open()
-        conn._try_activate_cursor(self)
-        self._session.cancel_if_pending()
+        conn = self._conn
+        if conn is not None:
+            conn = conn()
+        if not conn:
+            raise InterfaceError('Cursor is closed')
+        # results of inactive cursor were already discarded
+        if conn._active_cursor is self:
+            self._session.send_cancel()
 
     def close(self):
         """
         Closes the cursor. The cursor is unusable from this point.
         """
+        self._end_operation()
         conn = self._conn
         if conn is not None:
             conn = conn()
@@ -643,7 +1122,19 @@ class Cursor(six.Iterator):
                 self._session = None
             self._conn = None
 
-    def _exec_with_retry(self, fun):
+    def _end_operation(self):
+        """ Completes observed operation of the cursor which results were not consumed yet """
+        if self._operation is not None:
+            self._operation._finish_now()
+
+    def _exec_with_retry(self, fun, retry=True):
+        """ Calls function submitting request, if connection was reset it is reopened
+        and function is called again, unless connection has a transaction in progress
+
+        :param fun: Function submitting request
+        :param retry: If false connection errors are raised without a retry,
+          used for requests with streamed parameters which can't be read again
+        """
         conn = self._assert_open()
         in_tran = conn._conn.tds72_transaction
         if in_tran and conn._dirty:
@@ -662,8 +1153,11 @@ class Cursor(six.Iterator):
                 if e.errno not in (errno.ECONNRESET, errno.EPIPE):
                     raise
                 conn._conn.close()
+                if not retry:
+                    raise
             except ClosedConnectionError:
-                pass
+                if not retry:
+                    raise
             # in case of connection reset try again
             conn = self._assert_open()
             return fun()
@@ -673,62 +1167,58 @@ class Cursor(six.Iterator):
         if not conn._autocommit and not conn._conn.tds72_transaction:
             conn._main_cursor._begin_tran(isolation_level=conn._isolation_level)
 
-    def _execute(self, operation, params):
+    @_observed('execute', 0, 'operation')
+    def _submit_execute(self, operation, params, timeout):
+        def submit():
+            # session is replaced when connection is reopened by _exec_with_retry
+            session = self._session
+            session.request_timeout = timeout
+            try:
+                _make_execute_request(session, operation, params)()
+            finally:
+                session.request_timeout = None
+        self._exec_with_retry(submit, retry=not _has_single_pass_params(params))
+
+    def _find_submitted_result(self):
+        """ Positions cursor on the first result of request sent by :meth:`_submit_execute` """
+        operation = self._operation
+        finish = None
+        if operation is not None:
+            # observed operation is not completed until error of the statement is recorded
+            finish, operation._finish = operation._finish, None
+        try:
+            self._session.find_result_or_done()
+        except Exception as ex:
+            if operation is not None:
+                operation.error = ex
+            raise
+        finally:
+            if finish is not None:
+                operation._finish_when_completed(finish)
+        self._setup_row_factory()
+
+    @_observed('execute', 0, 'operation')
+    def _execute(self, operation, params, timeout=None):
         self._ensure_transaction()
-        operation = six.text_type(operation)
-        if params:
-            named_params = {}
-            if isinstance(params, (list, tuple)):
-                names = []
-                pid = 1
-                for val in params:
-                    if val is None:
-                        names.append('NULL')
-                    else:
-                        name = '@P{0}'.format(pid)
-                        names.append(name)
-                        named_params[name] = val
-                        pid += 1
-                if len(names) == 1:
-                    operation = operation % names[0]
-                else:
-                    operation = operation % tuple(names)
-            elif isinstance(params, dict):
-                # prepend names with @
-                rename = {}
-                for name, value in params.items():
-                    if value is None:
-                        rename[name] = 'NULL'
-                    else:
-                        mssql_name = '@{0}'.format(name)
-                        rename[name] = mssql_name
-                        named_params[mssql_name] = value
-                operation = operation % rename
-            if named_params:
-                named_params = self._session._convert_params(named_params)
-                param_definition = u','.join(
-                    u'{0} {1}'.format(p.column_name, p.type.get_declaration())
-                    for p in named_params)
-                self._exec_with_retry(lambda: self._session.submit_rpc(
-                    tds_base.SP_EXECUTESQL,
-                    [self._session.make_param('', operation), self._session.make_param('', param_definition)] + named_params,
-                    0))
-            else:
-                self._exec_with_retry(lambda: self._session.submit_plain_query(operation))
-        else:
-            self._exec_with_retry(lambda: self._session.submit_plain_query(operation))
+        self._submit_execute(operation, params, timeout)
         self._session.find_result_or_done()
         self._setup_row_factory()
 
-    def execute(self, operation, params=()):
+    def execute(self, operation, params=(), timeout=None):
         """ Execute the query
 
         :param operation: SQL statement
         :type operation: str
+        :keyword timeout: Timeout in seconds for the statement including fetching of
+          its results.  When it expires statement is cancelled and :class:`TimeoutError`
+          is raised by the call waiting for results, if server does not acknowledge
+          cancellation within another timeout period connection is closed.
+          Default is no timeout.
+        :type timeout: float
         """
         conn = self._assert_open()
         conn._try_activate_cursor(self)
-        self._execute(operation, params)
+        self._execute(operation, params, timeout)
         # for compatibility with pyodbc
         return self
 
@@ -749,14 +1239,63 @@ class Cursor(six.Iterator):
         self._session.rollback(cont=cont, isolation_level=isolation_level)
         conn._dirty = False
 
-    def executemany(self, operation, params_seq):
-        counts = []
-        for params in params_seq:
-            self.execute(operation, params)
-            if self._session.rows_affected != -1:
-                counts.append(self._session.rows_affected)
-        if counts:
-            self._session.rows_affected = sum(counts)
+    def executemany(self, operation, params_seq, batch_size=None):
+        """ Execute the query for every set of parameters
+
+        By default every execution is a separate request, executions stop
+        at the first failure and result set returned by the last execution
+        can be fetched.  Executions can be sent in batches, every batch is
+        a single request which contains up to batch_size RPC calls.  Server
+        executes all calls of a batch even if some of them fail, so sets of
+        parameters following the failed one in the same batch are applied before
+        the error is raised, following batches are not sent.  Result sets returned
+        by batched executions are discarded.
+
+        :param operation: SQL statement
+        :type operation: str
+        :param params_seq: Sequence of sets of parameters
+        :keyword batch_size: Maximum number of executions sent in one request,
+          default value is cursor.executemany_batch_size which is 1
+        :type batch_size: int
+        """
+        conn = self._assert_open()
+        conn._try_activate_cursor(self)
+        self._executemany(operation, params_seq, batch_size)
+
+    @_observed('executemany', 0, 'operation')
+    def _executemany(self, operation, params_seq, batch_size):
+        if batch_size is None:
+            batch_size = self.executemany_batch_size
+        if batch_size == 1:
+            counts = []
+            for params in params_seq:
+                self._execute(operation, params)
+                if self._session.rows_affected != -1:
+                    counts.append(self._session.rows_affected)
+            if counts:
+                self._session.rows_affected = sum(counts)
+            return
+        self._ensure_transaction()
+        total = -1
+        # whether parameters of the current batch have streams, sets of parameters are read
+        # by the generator of requests only until the batch is complete
+        streamed = []
+
+        def track_streams(params_seq):
+            for params in params_seq:
+                if _has_single_pass_params(params):
+                    streamed.append(params)
+                yield params
+
+        requests = _make_executemany_requests(lambda: self._session, operation, track_streams(params_seq), batch_size)
+        for submit in requests:
+            self._exec_with_retry(submit, retry=not streamed)
+            del streamed[:]
+            count = self._session.process_batch()
+            if count != -1:
+                total = max(total, 0) + count
+        self._session.rows_affected = total
+        self._setup_row_factory()
 
     def execute_scalar(self, query_string, params=None):
         """
@@ -821,6 +1360,25 @@ class Cursor(six.Iterator):
             raise ValueError('Invalid value for column_idx')
         self._session.res_info.columns[column_idx].serializer.set_chunk_handler(pytds.tds_types._StreamChunkedHandler(stream))
 
+    def set_lob_readers(self, column_idx):
+        """ Makes values of columns starting from column_idx be read lazily
+
+        Values of these columns are returned as :class:`pytds.tds_types.LobReader`
+        instances, which read values from the connection on demand, so that
+        large values don't have to be stored in memory.  Because values of
+        a row are received sequentially, all columns starting from column_idx
+        should be of VARCHAR(MAX), NVARCHAR(MAX), VARBINARY(MAX) or XML types.
+        Setting applies to the current result set.
+
+        :param column_idx: Index of the first column to be read lazily
+        """
+        info = self._session.res_info
+        if info is None:
+            raise ProgrammingError("Previous statement didn't produce any results")
+        if len(info.columns) <= column_idx or column_idx < 0:
+            raise ValueError('Invalid value for column_idx')
+        info.row_decoder = _RowDecoder(info.columns, lob_start=column_idx)
+
     @property
     def messages(self):
         """ Messages generated by server, see http://legacy.python.org/dev/peps/pep-0249/#cursor-messages
@@ -875,6 +1433,31 @@ class Cursor(six.Iterator):
         """
         return list(row for row in self)
 
+    def fetch_columns(self, size=None):
+        """ Fetches next multiple rows in columnar form
+
+        Values of integer, float, bit and datetime2 columns are stored in
+        :class:`array.array` instances, or in NumPy arrays if NumPy is
+        installed, values of other columns are stored in lists.
+        Datetime2 values are stored as number of microseconds since
+        1970-01-01 (``datetime64[us]`` for NumPy).  On Python 2 :mod:`array`
+        does not support 8 byte integers, without NumPy bigint and datetime2
+        values are stored in lists there.
+
+        :param size: Maximum number of rows to fetch, default value is cursor.arraysize
+        :returns: List of tuples ``(values, null_mask)`` in the order of columns,
+          null_mask has true values for NULL cells, it is ``None`` for columns
+          which can not contain NULLs.
+        """
+        if size is None:
+            size = self.arraysize
+        return self._session.fetch_columns(size)
+
+    def fetchall_columnar(self):
+        """ Fetches all remaining rows in columnar form, see :meth:`fetch_columns`
+        """
+        return self._session.fetch_columns()
+
     def __next__(self):
         row = self.fetchone()
         if row is None:
@@ -895,6 +1478,7 @@ class Cursor(six.Iterator):
         """
         pass
 
+    @_observed('copy_to', 1, 'table_or_view')
     def copy_to(self, file=None, table_or_view=None, sep='\t', columns=None,
                 check_constraints=False, fire_triggers=False, keep_nulls=False,
                 kb_per_batch=None, rows_per_batch=None, order=None, tablock=False,
@@ -913,14 +1497,14 @@ class Cursor(six.Iterator):
         :keyword columns: List of Column objects or column names in target
           table to insert to. SQL Server will do some conversions, so these
           may not have to match the actual table definition exactly.
-          If not provided will insert into all columns assuming nvarchar(4000)
-          NULL for all columns.
-          If only the column name is provided, the type is assumed to be
-          nvarchar(4000) NULL.
-          If rows are given with file, you cannot specify non-string data
-          types.
-          If rows are given with data, the values must be a type supported by
-          the serializer for the column in tds_types.
+          If not provided will insert into all columns.
+          If rows are given with file, columns given by name and all
+          columns when columns are not provided are assumed to be
+          nvarchar(4000) NULL, you cannot specify non-string data types.
+          If rows are given with data, types of columns given by name and
+          of all columns when columns are not provided are taken from the
+          table definition, values must be of types supported by the
+          serializers of these types, e.g. int for INT column.
         :type columns: list
         :keyword check_constraints: Check table constraints for incoming data
         :type check_constraints: bool
@@ -933,7 +1517,8 @@ class Cursor(six.Iterator):
           server documentation for details
         :type kb_per_batch: int
         :keyword rows_per_batch: Rows per batch can be used to optimize performance, see MSSQL
-          server documentation for details
+          server documentation for details.  Rows are sent in separate bulk load
+          batches of this size, in autocommit mode every batch is committed on its own.
         :type rows_per_batch: int
         :keyword order: The ordering of the data in source table. List of columns with ASC or DESC suffix.
           E.g. ``['order_id ASC', 'name DESC']``
@@ -963,21 +1548,89 @@ class Cursor(six.Iterator):
         else:
             rows = data
 
-        obj_name = tds_base.tds_quote_id(table_or_view)
-        if schema:
-            obj_name = '{0}.{1}'.format(tds_base.tds_quote_id(schema), obj_name)
-        if columns:
+        obj_name = _quote_table_name(table_or_view, schema)
+        if columns and all(isinstance(column, Column) for column in columns):
+            metadata = list(columns)
+        else:
+            # types are taken from the table definition, columns of result set
+            # carry serializers which are used to send values
+            table_columns = self._table_columns(
+                obj_name, [column.column_name if isinstance(column, Column) else column for column in columns or ()])
             metadata = []
-            for column in columns:
-                if isinstance(column, Column):
-                    metadata.append(column)
+            for i, col in enumerate(table_columns):
+                if columns and isinstance(columns[i], Column):
+                    metadata.append(columns[i])
+                elif data is None:
+                    metadata.append(Column(name=col.column_name, type=NVarCharType(size=4000),
+                                           flags=Column.fNullable if columns else col.flags & Column.fNullable))
                 else:
-                    metadata.append(Column(name=column, type=NVarCharType(size=4000), flags=Column.fNullable))
+                    metadata.append(col)
+        self._insert_bulk(obj_name, metadata, _split_rows(rows, rows_per_batch), self._session.submit_bulk,
+                          check_constraints=check_constraints, fire_triggers=fire_triggers,
+                          keep_nulls=keep_nulls, kb_per_batch=kb_per_batch, rows_per_batch=rows_per_batch,
+                          order=order, tablock=tablock)
+
+    @_observed('copy_from_columns', 0, 'table_or_view')
+    def copy_from_columns(self, table_or_view, columns, null_masks=None, schema=None,
+                          check_constraints=False, fire_triggers=False, keep_nulls=False,
+                          kb_per_batch=None, rows_per_batch=None, order=None, tablock=False):
+        """ *Experimental*. Efficiently load data given by columns to database using ``BULK INSERT`` operation
+
+        Types of columns are taken from the table definition.  Values of
+        columns of fixed size types, like INT or FLOAT, are serialized by whole
+        blocks of rows, without creating Python row tuples.
+
+        :param table_or_view: Destination table or view in the database
+        :type table_or_view: str
+        :param columns: Mapping of column names to values, values of every column
+          are given by a sequence, e.g. :class:`array.array`, NumPy array or list,
+          all sequences should have the same length.  None values in lists
+          and masked values of NumPy masked arrays are inserted as NULLs.
+        :type columns: dict
+        :keyword null_masks: Mapping of column names to null masks, null mask is
+          a sequence which has true values for NULL cells.  Masks returned by
+          :meth:`fetch_columns` can be used.
+        :type null_masks: dict
+
+        Other keyword parameters have the same meaning as for :meth:`copy_to`.
+        """
+        obj_name = _quote_table_name(table_or_view, schema)
+        names = list(columns)
+        data = [(columns[name], (null_masks or {}).get(name)) for name in names]
+        lengths = set(len(values) for values, _ in data)
+        if len(lengths) > 1:
+            raise ValueError('All columns should have the same length')
+        num_rows = lengths.pop() if lengths else 0
+        metadata = self._table_columns(obj_name, names)
+        batch_size = rows_per_batch or max(num_rows, 1)
+        batches = ([(values[start:start + batch_size], None if mask is None else mask[start:start + batch_size])
+                    for values, mask in data]
+                   for start in xrange(0, max(num_rows, 1), batch_size))
+        self._insert_bulk(obj_name, metadata, batches, self._session.submit_bulk_columns,
+                          check_constraints=check_constraints, fire_triggers=fire_triggers,
+                          keep_nulls=keep_nulls, kb_per_batch=kb_per_batch, rows_per_batch=rows_per_batch,
+                          order=order, tablock=tablock)
+
+    def _table_columns(self, obj_name, names):
+        """ Returns list of :class:`Column` instances describing columns of table
+
+        :param obj_name: Quoted name of table or view
+        :param names: Names of columns, all columns are returned if empty
+        """
+        if names:
+            select_list = ','.join(tds_base.tds_quote_id(name) for name in names)
         else:
-            self.execute('select top 1 * from {} where 1<>1'.format(obj_name))
-            metadata = [Column(name=col[0], type=NVarCharType(size=4000), flags=Column.fNullable if col[6] else 0)
-                        for col in self.description]
-        col_defs = ','.join('{0} {1}'.format(tds_base.tds_quote_id(col.column_name), col.type.get_declaration())
+            select_list = '*'
+        self.execute('select top 0 {0} from {1}'.format(select_list, obj_name))
+        return self._session.res_info.columns
+
+    def _insert_bulk(self, obj_name, metadata, batches, submit, check_constraints, fire_triggers, keep_nulls,
+                     kb_per_batch, rows_per_batch, order, tablock):
+        """ Loads batches of data using ``INSERT BULK`` statement
+
+        Every batch is sent as a separate bulk load request by submit(metadata, batch) call.
+        """
+        col_defs = ','.join('{0} {1}'.format(tds_base.tds_quote_id(col.column_name), _column_declaration(col))
                             for col in metadata)
         with_opts = []
         if check_constraints:
@@ -998,9 +1651,14 @@ class Cursor(six.Iterator):
         if with_opts:
             with_part = 'WITH ({0})'.format(','.join(with_opts))
         operation = 'INSERT BULK {0}({1}) {2}'.format(obj_name, col_defs, with_part)
-        self.execute(operation)
-        self._session.submit_bulk(metadata, rows)
-        self._session.process_simple_request()
+        total = 0
+        for batch in batches:
+            self.execute(operation)
+            submit(metadata, batch)
+            self._session.process_simple_request()
+            if self._session.rows_affected > 0:
+                total += self._session.rows_affected
+        self._session.rows_affected = total
 
 
 class _MarsCursor(Cursor):
@@ -1025,13 +1683,15 @@ class _MarsCursor(Cursor):
         return spid
 
     def cancel(self):
-        self._assert_open()
-        self._session.cancel_if_pending()
+        if self._session is None:
+            raise InterfaceError('Cursor is closed')
+        self._session.send_cancel()
 
     def close(self):
         """
         Closes the cursor. The cursor is unusable from this point.
         """
+        self._end_operation()
         if self._session is not None:
             try:
                 self._session.close()
@@ -1040,12 +1700,16 @@ class _MarsCursor(Cursor):
                 if e.errno != errno.ECONNRESET:
                     raise
 
-    def execute(self, operation, params=()):
+    def execute(self, operation, params=(), timeout=None):
         self._assert_open()
-        self._execute(operation, params)
+        self._execute(operation, params, timeout)
         # for compatibility with pyodbc
         return self
 
+    def executemany(self, operation, params_seq, batch_size=None):
+        self._assert_open()
+        self._executemany(operation, params_seq, batch_size)
+
     def callproc(self, procname, parameters=()):
         """
         Call a stored procedure with the given name.
@@ -1073,6 +1737,227 @@ class _MarsCursor(Cursor):
         conn._dirty = False
 
 
+def _split_rows(rows, batch_size):
+    """ Splits rows into consecutive batches of at most batch_size rows
+
+    Batches are iterators over the source rows, so rows are never
+    materialized, every batch should be consumed before the next one is
+    requested.  At least one, possibly empty, batch is produced.
+
+    :param rows: Iterable of rows
+    :param batch_size: Maximum number of rows in a batch, falsy value means single batch
+    """
+    rows = iter(rows)
+    if not batch_size:
+        yield rows
+        return
+    first = True
+    while True:
+        try:
+            row = next(rows)
+        except StopIteration:
+            if first:
+                yield rows
+            return
+        first = False
+        yield itertools.chain((row,), itertools.islice(rows, batch_size - 1))
+
+
+def _quote_table_name(table_or_view, schema):
+    obj_name = tds_base.tds_quote_id(table_or_view)
+    if schema:
+        obj_name = '{0}.{1}'.format(tds_base.tds_quote_id(schema), obj_name)
+    return obj_name
+
+
+def _column_declaration(col):
+    if col.type is None:
+        return pytds.tds_types.declaration_by_serializer(col.serializer)
+    return col.type.get_declaration()
+
+
+def _convert_operation(session, operation, params):
+    """ Substitutes query parameters with server side parameters
+
+    :param session: :class:`pytds.tds._TdsSession` which will be used to send request
+    :param operation: SQL statement
+    :param params: parameters as sequence or dictionary
+    :returns: Tuple of SQL statement and list of :class:`Column` instances with values of parameters
+    """
+    operation = six.text_type(operation)
+    named_params = {}
+    if params:
+        if isinstance(params, (list, tuple)):
+            names = []
+            pid = 1
+            for val in params:
+                if val is None:
+                    names.append('NULL')
+                else:
+                    name = '@P{0}'.format(pid)
+                    names.append(name)
+                    named_params[name] = val
+                    pid += 1
+            if len(names) == 1:
+                operation = operation % names[0]
+            else:
+                operation = operation % tuple(names)
+        elif isinstance(params, dict):
+            # prepend names with @
+            rename = {}
+            for name, value in params.items():
+                if value is None:
+                    rename[name] = 'NULL'
+                else:
+                    mssql_name = '@{0}'.format(name)
+                    rename[name] = mssql_name
+                    named_params[mssql_name] = value
+            operation = operation % rename
+    if named_params:
+        named_params = session._convert_params(named_params)
+    return operation, named_params
+
+
+def _has_single_pass_params(params):
+    """ Checks whether parameters have values which can be read only once,
+    like file-like objects or iterators streamed into MAX parameters
+
+    :param params: parameters as sequence or dictionary
+    """
+    if isinstance(params, dict):
+        params = params.values()
+    elif not isinstance(params, (list, tuple)):
+        return False
+    for value in params:
+        if isinstance(value, output):
+            value = value.value
+        elif isinstance(value, Column):
+            value = value.value
+        if _is_stream(value):
+            return True
+    return False
+
+
+def _make_execute_calls(session, operation, named_params, prepare=True):
+    """ Makes RPC calls which execute SQL statement with parameters
+
+    :param session: :class:`pytds.tds._TdsSession` which will be used to send request
+    :param operation: SQL statement returned by :func:`_convert_operation`
+    :param named_params: list of parameters returned by :func:`_convert_operation`
+    :param prepare: allows to prepare statement if it is not prepared yet and
+      prepared statement cache is enabled
+    :returns: Tuple of list of calls for :meth:`pytds.tds._TdsSession.submit_rpcs`
+      and function which should be called after calls are submitted or None
+    """
+    cache = session.conn.prepared_cache
+    if cache is not None:
+        declarations = tuple(
+            u'{0} {1}'.format(p.column_name, p.type.get_declaration())
+            for p in named_params)
+        return cache.make_calls(session, operation, declarations, named_params, prepare=prepare)
+    param_definition = u','.join(
+        u'{0} {1}'.format(p.column_name, p.type.get_declaration())
+        for p in named_params)
+    return [(tds_base.SP_EXECUTESQL,
+             [session.make_param('', operation), session.make_param('', param_definition)] + named_params,
+             0)], None
+
+
+def _make_submit(session, calls, submitted):
+    def submit():
+        session.submit_rpcs(calls)
+        if submitted is not None:
+            submitted()
+    return submit
+
+
+def _make_execute_request(session, operation, params):
+    """ Prepares request for executing SQL statement with given parameters
+
+    Query parameters are substituted with server side parameters and
+    converted into RPC call to ``sp_executesql``, or to a call of prepared
+    statement if prepared statement cache is enabled, when no parameters
+    are given plain SQL batch is used.
+
+    :param session: :class:`pytds.tds._TdsSession` which will be used to send request
+    :param operation: SQL statement
+    :param params: parameters as sequence or dictionary
+    :returns: callable which submits request into session
+    """
+    operation, named_params = _convert_operation(session, operation, params)
+    if not named_params:
+        return lambda: session.submit_plain_query(operation)
+    calls, submitted = _make_execute_calls(session, operation, named_params)
+    return _make_submit(session, calls, submitted)
+
+
+def _make_executemany_requests(get_session, operation, params_seq, batch_size):
+    """ Generates requests which execute SQL statement for every set of parameters
+
+    Executions of statement are combined into requests containing up to
+    batch_size RPC calls.  Statement which is not prepared yet is prepared by a
+    separate request, so that following requests can use its handle.
+    Response to every request should be processed before next request is generated.
+
+    :param get_session: function returning :class:`pytds.tds._TdsSession` which will be used to send requests,
+      if it returns another session when request is submitted, e.g. after reconnect, request is rebuilt for it
+    :param operation: SQL statement
+    :param params_seq: sequence of sets of parameters
+    :param batch_size: maximum number of calls in a single request
+    :returns: generator of callables, every callable submits single request into session
+    """
+    calls = []
+    batch = []
+    for params in params_seq:
+        session = get_session()
+        op, named_params = _convert_operation(session, operation, params)
+        if not named_params:
+            if calls:
+                yield _make_batch_submit(get_session, session, operation, batch, _make_submit(session, calls, None))
+                calls = []
+                batch = []
+            yield _make_batch_submit(get_session, session, operation, [params],
+                                     functools.partial(session.submit_plain_query, op))
+            continue
+        new_calls, submitted = _make_execute_calls(session, op, named_params, prepare=not calls)
+        calls.extend(new_calls)
+        batch.append(params)
+        if submitted is not None or len(calls) >= batch_size:
+            yield _make_batch_submit(get_session, session, operation, batch, _make_submit(session, calls, submitted))
+            calls = []
+            batch = []
+    if calls:
+        yield _make_batch_submit(get_session, session, operation, batch, _make_submit(session, calls, None))
+
+
+def _make_batch_submit(get_session, session, operation, batch, submit):
+    """ Wraps callable submitting request built for the session, if session was
+    replaced by the time of submission, e.g. after reconnect, request is built again for the new session
+    """
+    def submit_batch():
+        current = get_session()
+        if current is session:
+            submit()
+        else:
+            logger.info('session was replaced, rebuilding request')
+            _make_batch_request(current, operation, batch)()
+    return submit_batch
+
+
+def _make_batch_request(session, operation, batch):
+    """ Makes callable submitting single request which executes statement for every set of parameters in batch """
+    calls = []
+    submitted = None
+    for params in batch:
+        op, named_params = _convert_operation(session, operation, params)
+        if not named_params:
+            return functools.partial(session.submit_plain_query, op)
+        new_calls, new_submitted = _make_execute_calls(session, op, named_params, prepare=not calls)
+        calls.extend(new_calls)
+        submitted = submitted or new_submitted
+    return _make_submit(session, calls, submitted)
+
+
 def _resolve_instance_port(server, port, instance, timeout=5):
     if instance and not port:
         logger.info('querying %s for list of instances', server)
@@ -1139,6 +2024,98 @@ def _parse_connection_string(connstr):
     return res
 
 
+def _create_login(dsn, database, user, password, timeout, login_timeout, appname, port, tds_version,
+                  blocksize, use_mars, auth, readonly, load_balancer, use_tz, bytes_to_unicode,
+                  failover_partner, cafile, validate_host, enc_login_only, prepared_cache_size=0,
+                  tls_backend=None):
+    """ Creates login object from connection parameters, see :func:`connect` for parameters
+    """
+    login = _TdsLogin()
+    login.client_host_name = socket.gethostname()[:128]
+    login.library = "Python TDS Library"
+    login.user_name = user or ''
+    login.password = password or ''
+    login.app_name = appname or 'pytds'
+    login.port = port
+    login.language = ''  # use database default
+    login.attach_db_file = ''
+    login.tds_version = tds_version
+    if tds_version < tds_base.TDS70:
+        raise ValueError('This TDS version is not supported')
+    login.database = database or ''
+    login.bulk_copy = False
+    login.client_lcid = lcid.LANGID_ENGLISH_US
+    login.use_mars = use_mars
+    login.pid = os.getpid()
+    login.change_password = ''
+    login.client_id = uuid.getnode()  # client mac address
+    login.cafile = cafile
+    login.validate_host = validate_host
+    login.enc_login_only = enc_login_only
+    if tls_backend is None:
+        tls_backend = 'openssl' if tls.OPENSSL_AVAILABLE or not tls.SSL_OBJECT_AVAILABLE else 'ssl'
+    if tls_backend not in ('openssl', 'ssl'):
+        raise ValueError("Invalid tls_backend value '{}', should be 'openssl' or 'ssl'".format(tls_backend))
+    login.tls_backend = tls_backend
+    if cafile:
+        if tls_backend == 'ssl':
+            if not tls.SSL_OBJECT_AVAILABLE:
+                raise ValueError("TLS backend 'ssl' requires Python 3.5 or newer")
+            login.tls_ctx = tls.create_ssl_context(cafile)
+        else:
+            if not tls.OPENSSL_AVAILABLE:
+                raise ValueError("You are trying to use encryption but pyOpenSSL does not work, you probably "
+                                 "need to install it first")
+            login.tls_ctx = tls.create_context(cafile)
+        if login.enc_login_only:
+            login.enc_flag = PreLoginEnc.ENCRYPT_OFF
+        else:
+            login.enc_flag = PreLoginEnc.ENCRYPT_ON
+    else:
+        login.tls_ctx = None
+        login.enc_flag = PreLoginEnc.ENCRYPT_NOT_SUP
+
+    if use_tz:
+        login.client_tz = use_tz
+    else:
+        login.client_tz = pytds.tz.local
+
+    # that will set:
+    # ANSI_DEFAULTS to ON,
+    # IMPLICIT_TRANSACTIONS to OFF,
+    # TEXTSIZE to 0x7FFFFFFF (2GB) (TDS 7.2 and below), TEXTSIZE to infinite (introduced in TDS 7.3),
+    # and ROWCOUNT to infinite
+    login.option_flag2 = tds_base.TDS_ODBC_ON
+
+    login.connect_timeout = login_timeout
+    login.query_timeout = timeout
+    login.blocksize = blocksize
+    login.auth = auth
+    login.readonly = readonly
+    login.load_balancer = load_balancer
+    login.bytes_to_unicode = bytes_to_unicode
+    login.prepared_cache_size = prepared_cache_size
+
+    if load_balancer and failover_partner:
+        raise ValueError("Both load_balancer and failover_partner shoudln't be specified")
+    if load_balancer:
+        servers = [(srv, None) for srv in load_balancer.choose()]
+    else:
+        servers = [(dsn or 'localhost', port)]
+        if failover_partner:
+            servers.append((failover_partner, port))
+
+    parsed_servers = []
+    for srv, port in servers:
+        host, instance = _parse_server(srv)
+        if instance and port:
+            raise ValueError("Both instance and port shouldn't be specified")
+        parsed_servers.append((host, port, instance))
+
+    login.servers = _get_servers_deque(tuple(parsed_servers), database)
+    return login
+
+
 def connect(dsn=None, database=None, user=None, password=None, timeout=None,
             login_timeout=15, as_dict=None,
             appname=None, port=None, tds_version=tds_base.TDS74,
@@ -1149,6 +2126,9 @@ def connect(dsn=None, database=None, user=None, password=None, timeout=None,
             cafile=None, validate_host=True, enc_login_only=False,
             disable_connect_retry=False,
             pooling=False,
+            max_pool_size=100, min_pool_size=0, pool_timeout=None,
+            pool_idle_timeout=300, pool_max_lifetime=None,
+            prepared_cache_size=0, observer=None, tls_backend=None,
             ):
     """
     Opens connection to the database
@@ -1204,63 +2184,34 @@ def connect(dsn=None, database=None, user=None, password=None, timeout=None,
       anyone who can observe traffic on your network will be able to see all your SQL requests and potentially modify
       them.
     :type enc_login_only: bool
+    :keyword tls_backend: Library used for TLS encryption, ``'openssl'`` uses pyOpenSSL, ``'ssl'`` uses
+      the standard :mod:`ssl` module and avoids copying of data, defaults to pyOpenSSL when it is installed
+    :type tls_backend: str
+    :keyword pooling: Enables connection pooling, closed connections are returned into the pool
+      and reused by following calls to :func:`connect` with the same parameters
+    :type pooling: bool
+    :keyword max_pool_size: Maximum number of connections opened by the pool, including connections in use
+    :type max_pool_size: int
+    :keyword min_pool_size: Number of connections which are opened in background thread after the first
+      connection is opened, and which are kept open by the pool
+    :type min_pool_size: int
+    :keyword pool_timeout: Maximum number of seconds to wait for a connection when all
+      ``max_pool_size`` connections are in use, defaults to ``login_timeout``
+    :type pool_timeout: float
+    :keyword pool_idle_timeout: Connections which stay idle in the pool longer than this number of seconds are closed,
+      also when the pool is not used, None disables idle eviction
+    :type pool_idle_timeout: float
+    :keyword pool_max_lifetime: Connections older than this number of seconds are closed instead of being returned
+      into the pool, None disables lifetime eviction
+    :type pool_max_lifetime: float
+    :keyword prepared_cache_size: Number of parametrized statements kept prepared on the server,
+      statements are prepared on first execution and executed by handle afterwards,
+      0 disables preparing of statements
+    :type prepared_cache_size: int
+    :keyword observer: Observer which is notified about every request sent over the connection,
+      see :class:`pytds.observer.Observer`
     :returns: An instance of :class:`Connection`
     """
-    login = _TdsLogin()
-    login.client_host_name = socket.gethostname()[:128]
-    login.library = "Python TDS Library"
-    login.user_name = user or ''
-    login.password = password or ''
-    login.app_name = appname or 'pytds'
-    login.port = port
-    login.language = ''  # use database default
-    login.attach_db_file = ''
-    login.tds_version = tds_version
-    if tds_version < tds_base.TDS70:
-        raise ValueError('This TDS version is not supported')
-    login.database = database or ''
-    login.bulk_copy = False
-    login.client_lcid = lcid.LANGID_ENGLISH_US
-    login.use_mars = use_mars
-    login.pid = os.getpid()
-    login.change_password = ''
-    login.client_id = uuid.getnode()  # client mac address
-    login.cafile = cafile
-    login.validate_host = validate_host
-    login.enc_login_only = enc_login_only
-    if cafile:
-        if not tls.OPENSSL_AVAILABLE:
-            raise ValueError("You are trying to use encryption but pyOpenSSL does not work, you probably "
-                             "need to install it first")
-        login.tls_ctx = tls.create_context(cafile)
-        if login.enc_login_only:
-            login.enc_flag = PreLoginEnc.ENCRYPT_OFF
-        else:
-            login.enc_flag = PreLoginEnc.ENCRYPT_ON
-    else:
-        login.tls_ctx = None
-        login.enc_flag = PreLoginEnc.ENCRYPT_NOT_SUP
-
-    if use_tz:
-        login.client_tz = use_tz
-    else:
-        login.client_tz = pytds.tz.local
-
-    # that will set:
-    # ANSI_DEFAULTS to ON,
-    # IMPLICIT_TRANSACTIONS to OFF,
-    # TEXTSIZE to 0x7FFFFFFF (2GB) (TDS 7.2 and below), TEXTSIZE to infinite (introduced in TDS 7.3),
-    # and ROWCOUNT to infinite
-    login.option_flag2 = tds_base.TDS_ODBC_ON
-
-    login.connect_timeout = login_timeout
-    login.query_timeout = timeout
-    login.blocksize = blocksize
-    login.auth = auth
-    login.readonly = readonly
-    login.load_balancer = load_balancer
-    login.bytes_to_unicode = bytes_to_unicode
-
     if server and dsn:
         raise ValueError("Both server and dsn shouldn't be specified")
 
@@ -1268,23 +2219,14 @@ def connect(dsn=None, database=None, user=None, password=None, timeout=None,
         warnings.warn("server parameter is deprecated, use dsn instead", DeprecationWarning)
         dsn = server
 
-    if load_balancer and failover_partner:
-        raise ValueError("Both load_balancer and failover_partner shoudln't be specified")
-    if load_balancer:
-        servers = [(srv, None) for srv in load_balancer.choose()]
-    else:
-        servers = [(dsn or 'localhost', port)]
-        if failover_partner:
-            servers.append((failover_partner, port))
-
-    parsed_servers = []
-    for srv, port in servers:
-        host, instance = _parse_server(srv)
-        if instance and port:
-            raise ValueError("Both instance and port shouldn't be specified")
-        parsed_servers.append((host, port, instance))
-
-    login.servers = _get_servers_deque(tuple(parsed_servers), database)
+    login = _create_login(
+        dsn=dsn, database=database, user=user, password=password, timeout=timeout,
+        login_timeout=login_timeout, appname=appname, port=port, tds_version=tds_version,
+        blocksize=blocksize, use_mars=use_mars, auth=auth, readonly=readonly,
+        load_balancer=load_balancer, use_tz=use_tz, bytes_to_unicode=bytes_to_unicode,
+        failover_partner=failover_partner, cafile=cafile, validate_host=validate_host,
+        enc_login_only=enc_login_only, prepared_cache_size=prepared_cache_size,
+        tls_backend=tls_backend)
 
     # unique connection identifier used to pool connection
     key = (
@@ -1296,12 +2238,18 @@ def connect(dsn=None, database=None, user=None, password=None, timeout=None,
         login.client_lcid,
         login.use_mars,
         login.cafile,
+        login.tls_backend,
         login.blocksize,
         login.readonly,
         login.bytes_to_unicode,
         login.auth,
         login.client_tz,
         autocommit,
+        max_pool_size,
+        min_pool_size,
+        pool_idle_timeout,
+        pool_max_lifetime,
+        prepared_cache_size,
     )
 
     conn = Connection()
@@ -1310,6 +2258,14 @@ def connect(dsn=None, database=None, user=None, password=None, timeout=None,
     conn._login = login
     conn._pooling = pooling
     conn._key = key
+    conn._pool_params = dict(
+        max_pool_size=max_pool_size,
+        min_pool_size=min_pool_size,
+        idle_timeout=pool_idle_timeout,
+        max_lifetime=pool_max_lifetime,
+    )
+    conn._pool_timeout = pool_timeout
+    conn._observer = observer
 
     assert row_strategy is None or as_dict is None,\
         'Both row_startegy and as_dict were specified, you should use either one or another'
@@ -1331,6 +2287,18 @@ def connect(dsn=None, database=None, user=None, password=None, timeout=None,
     return conn
 
 
+def pool_stats():
+    """ Returns statistics of connection pools
+
+    :returns: Dictionary with a dictionary of counters for every pool, keys are tuples
+      of connection parameters of the pool.  Counters are: ``size`` -- number of opened connections,
+      ``idle``, ``in_use``, ``waiting`` -- number of threads waiting for a connection,
+      ``max_size``, ``min_size``, ``opened``, ``closed`` -- total number of opened and closed connections,
+      ``timeouts`` -- number of times waiting for a connection timed out.
+    """
+    return _connection_pool.stats()
+
+
 def Date(year, month, day):
     return datetime.date(year, month, day)
 
@@ -0,0 +1,1077 @@
+"""asyncio interface for communicating with MS SQL servers
+
+Requires Python 3.5 or later.  Usage mirrors the DB-API interface
+of :mod:`pytds`, except that all methods which do network I/O are coroutines::
+
+    conn = await pytds.aio.connect(dsn='localhost', user='sa', password='sa')
+    async with conn:
+        cur = conn.cursor()
+        await cur.execute('select 1')
+        print(await cur.fetchall())
+
+Protocol is implemented by the same code as in the synchronous driver,
+rows are parsed as packets of the response arrive, so results are not held
+in memory before they are fetched.  MARS is not supported by this module.
+"""
+import asyncio
+import collections
+import errno
+import logging
+import socket
+import time
+
+from . import tds_base
+from . import tls
+from .tds import _TdsSocket, _TdsSession, _WouldBlock, _header, _create_exception_by_message
+from .tds_base import (
+    Error, LoginError, InterfaceError, OperationalError, ClosedConnectionError,
+    PreLoginEnc,
+)
+from . import (
+    _create_login, _make_execute_request, _make_executemany_requests, _resolve_instance_port,
+    tuple_row_strategy, dict_row_strategy,
+)
+
+if tls.OPENSSL_AVAILABLE:
+    import OpenSSL.SSL
+
+logger = logging.getLogger(__name__)
+
+# maximum number of bytes requested from the stream in one read
+_READ_SIZE = 65536
+
+
+class _AsyncTransport(object):
+    """ Transport which adapts asyncio streams to the synchronous protocol code
+
+    Data written by the protocol code is accumulated in the output buffer
+    and sent by :meth:`flush`.  Received data is split into TDS packets which
+    are delivered to the protocol code one packet per call, reads beyond
+    received packets fail with :class:`_WouldBlock`.  More data is received
+    by :meth:`receive_packet` and :meth:`receive_message`.
+    """
+
+    def __init__(self, reader, writer, timeout=None):
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self._out = bytearray()
+        self._in = bytearray()
+        self._in_pos = 0  # read position in the input buffer
+        self._in_end = 0  # end of complete packets in the input buffer
+        self._packet_end = 0  # end of the packet which is being read
+        self._eom_end = 0  # end of the last received packet which completes a message
+        # whether last packet of the response to the last sent request was received
+        self._eom_received = False
+        self._tls_conn = None
+
+    def gettimeout(self):
+        return self._timeout
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def start_tls(self, tls_conn):
+        """ Encrypts all following traffic using the TLS connection """
+        self._tls_conn = tls_conn
+
+    def stop_tls(self):
+        """ Reverts transport back to non-encrypted mode """
+        self._tls_conn.shutdown()
+        self._tls_conn = None
+
+    @property
+    def message_received(self):
+        """ True when the response is received up to its end, so it can be parsed without waiting """
+        return self._eom_received
+
+    def tell(self):
+        """ Returns read position, which can be restored by :meth:`seek` to read data again """
+        return self._in_pos, self._packet_end
+
+    def seek(self, position):
+        self._in_pos, self._packet_end = position
+
+    def sendall(self, data, flags=0):
+        self._out += data
+
+    def _available(self, size):
+        """ Returns number of bytes which can be read by the next read of up to size bytes """
+        if self._in_pos == self._packet_end:
+            if self._in_pos == self._in_end:
+                raise _WouldBlock()
+            self._packet_end = self._in_pos + _header.unpack_from(self._in, self._in_pos)[2]
+        return min(size, self._packet_end - self._in_pos)
+
+    def recv_into(self, buffer, size=0):
+        if size == 0:
+            size = len(buffer)
+        size = self._available(size)
+        buffer[:size] = self._in[self._in_pos:self._in_pos + size]
+        self._in_pos += size
+        return size
+
+    def recv(self, size):
+        size = self._available(size)
+        res = bytes(self._in[self._in_pos:self._in_pos + size])
+        self._in_pos += size
+        return res
+
+    def peek_token(self):
+        """ Returns id of the first token of the received message or None if nothing was received """
+        if self._in_end - self._in_pos <= _header.size:
+            return None
+        return self._in[self._in_pos + _header.size]
+
+    async def flush(self):
+        """ Sends data accumulated in the output buffer """
+        if not self._out:
+            return
+        data = bytes(self._out)
+        del self._out[:]
+        self._eom_received = False
+        if self._tls_conn is not None:
+            self._tls_conn.sendall(data)
+            chunks = []
+            while True:
+                try:
+                    chunks.append(self._tls_conn.bio_read(tls.BUFSIZE))
+                except OpenSSL.SSL.WantReadError:
+                    break
+            data = b''.join(chunks)
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def receive_packet(self):
+        """ Receives data until there is a complete packet which was not read yet
+
+        Coroutine can be cancelled at any point, in this case received
+        data is kept and the next call continues receiving of the same packet.
+        """
+        self._compact()
+        while True:
+            self._frame()
+            if self._in_end > self._in_pos:
+                return
+            await self._receive()
+
+    async def receive_message(self):
+        """ Receives data until the end of the next message
+
+        Same as :meth:`receive_packet`, but waits for the last packet of the message.
+        """
+        self._compact()
+        while True:
+            self._frame()
+            if self._eom_end > self._in_pos:
+                return
+            await self._receive()
+
+    def _compact(self):
+        """ Discards data which was read from the input buffer """
+        pos = self._in_pos
+        if pos:
+            del self._in[:pos]
+            self._in_pos = 0
+            self._in_end -= pos
+            self._packet_end -= pos
+            self._eom_end -= pos
+
+    def _frame(self):
+        """ Finds ends of complete packets in the received data """
+        while len(self._in) - self._in_end >= _header.size:
+            _, status, size, _, _ = _header.unpack_from(self._in, self._in_end)
+            if size < _header.size:
+                raise Error('Invalid packet size {0}'.format(size))
+            if len(self._in) - self._in_end < size:
+                break
+            self._in_end += size
+            if status & 1:
+                self._eom_end = self._in_end
+                self._eom_received = True
+
+    async def _receive(self):
+        data = await self._reader.read(_READ_SIZE)
+        if not data:
+            raise ClosedConnectionError()
+        if self._tls_conn is not None:
+            self._tls_conn.bio_write(data)
+            while True:
+                try:
+                    self._in += self._tls_conn.recv(tls.BUFSIZE)
+                except OpenSSL.SSL.WantReadError:
+                    break
+        else:
+            self._in += data
+
+    def is_connected(self):
+        return not self._writer.transport.is_closing()
+
+    def close(self):
+        self._writer.close()
+
+
+class _AsyncTdsSession(_TdsSession):
+    """ TDS session driven by the event loop
+
+    Encryption is negotiated by :func:`_login` instead of the
+    blocking handshake of the base class.
+    """
+
+    def __init__(self, tds, transport, tzinfo_factory):
+        super(_AsyncTdsSession, self).__init__(tds, transport, tzinfo_factory)
+        self.tls_requested = False
+
+    def _establish_channel(self):
+        self.tls_requested = True
+
+
+async def _receive(session, wait_cancel=False, whole_message=True):
+    """ Receives next response message for the session respecting transport's timeout
+
+    On timeout sends cancel request to the server and raises :class:`pytds.TimeoutError`,
+    the rest of the response is discarded by the next request.
+
+    :param wait_cancel: True when waiting for acknowledgement of cancel request,
+      in this case timeout is not applied
+    :param whole_message: False to receive only next packet of the message
+    """
+    transport = session._transport
+    timeout = None if wait_cancel else transport.gettimeout()
+    receive = transport.receive_message if whole_message else transport.receive_packet
+    try:
+        if timeout:
+            await asyncio.wait_for(receive(), timeout)
+        else:
+            await receive()
+    except asyncio.TimeoutError:
+        if not session.in_cancel:
+            session.put_cancel()
+            await transport.flush()
+        raise tds_base.TimeoutError('Timeout expired')
+
+
+async def _drain(session):
+    """ Cancels request which is pending on the session and discards its results """
+    if session.state == tds_base.TDS_IDLE:
+        return
+    if not session.in_cancel:
+        session.put_cancel()
+        await session._transport.flush()
+    while True:
+        try:
+            session.process_cancel()
+            return
+        except _WouldBlock:
+            await _receive(session, wait_cancel=True)
+
+
+def _save_position(session):
+    info = session.res_info
+    return (session._transport.tell(), session._reader.save_position(), session.more_rows,
+            info, None if info is None else info.row_count, len(session.messages))
+
+
+def _restore_position(session, position):
+    transport_position, reader_position, session.more_rows, info, row_count, messages = position
+    session._transport.seek(transport_position)
+    session._reader.restore_position(reader_position)
+    session.res_info = info
+    if info is not None:
+        info.row_count = row_count
+    del session.messages[messages:]
+
+
+async def _parse(session, parse, *args):
+    """ Calls parsing method of the session, receiving response data it needs
+
+    Until the whole response is received, session is saved before the call.
+    If received data ends in the middle of a token, session is restored,
+    next packet is received and the call is repeated.
+
+    :returns: Value returned by parse
+    """
+    transport = session._transport
+    while not transport.message_received:
+        position = _save_position(session)
+        try:
+            return parse(*args)
+        except _WouldBlock:
+            _restore_position(session, position)
+            await _receive(session, whole_message=False)
+    return parse(*args)
+
+
+async def _request(session, submit, process, incremental=False):
+    """ Performs request-response exchange on the session
+
+    :param session: An instance of :class:`_AsyncTdsSession`
+    :param submit: Callable which writes request into the session
+    :param process: Callable which processes response tokens
+    :param incremental: True to process response as it arrives, otherwise
+      the whole response is received before process is called
+    :returns: Value returned by process
+    """
+    await _drain(session)
+    submit()
+    await session._transport.flush()
+    if incremental:
+        return await _parse(session, process)
+    await _receive(session)
+    return process()
+
+
+async def _establish_channel(session, login):
+    """ Performs TLS handshake, handshake data is wrapped into PRELOGIN packets """
+    transport = session._transport
+    r = session._reader
+    w = session._writer
+    conn = tls.create_tls_connection(login)
+    logger.info('doing TLS handshake')
+    while True:
+        try:
+            conn.do_handshake()
+        except OpenSSL.SSL.WantReadError:
+            req = conn.bio_read(tls.BUFSIZE)
+            w.begin_packet(tds_base.PacketType.PRELOGIN)
+            w.write(req)
+            w.flush()
+            await transport.flush()
+            await _receive(session)
+            conn.bio_write(r.read_whole_packet())
+        else:
+            logger.info('TLS handshake is complete')
+            tls.validate_tls_connection(conn, login)
+            transport.start_tls(conn)
+            return
+
+
+async def _login(tds_sock, login, transport, tzinfo_factory):
+    """ Asynchronous version of :meth:`pytds.tds._TdsSocket.login`
+
+    :returns: Routing information if server redirected connection, None otherwise
+    """
+    tds_sock._login = login
+    tds_sock.bufsize = login.blocksize
+    tds_sock.query_timeout = login.query_timeout
+    session = _AsyncTdsSession(tds_sock, transport, tzinfo_factory)
+    tds_sock._main_session = session
+    tds_sock.sock = transport
+    tds_sock.tds_version = login.tds_version
+    login.server_enc_flag = PreLoginEnc.ENCRYPT_NOT_SUP
+    if tds_base.IS_TDS71_PLUS(tds_sock):
+        session.send_prelogin(login)
+        await transport.flush()
+        await _receive(session)
+        session.process_prelogin(login)
+        if session.tls_requested:
+            await _establish_channel(session, login)
+    session.tds7_send_login(login)
+    await transport.flush()
+    if login.server_enc_flag == PreLoginEnc.ENCRYPT_OFF:
+        transport.stop_tls()
+    await _receive(session)
+    # integrated authentication can require several round trips
+    while transport.peek_token() == tds_base.TDS_AUTH_TOKEN:
+        session._reader.get_byte()
+        session.process_auth()
+        await transport.flush()
+        await _receive(session)
+    if not session.process_login_tokens():
+        session.raise_db_exception()
+    if tds_sock.route is not None:
+        return tds_sock.route
+
+    tds_sock._finish_login(tzinfo_factory)
+    if login.database and tds_sock.env.database != login.database:
+        await _request(session,
+                       lambda: session.submit_plain_query('use ' + tds_base.tds_quote_id(login.database)),
+                       session.process_simple_request)
+    return None
+
+
+class Connection(object):
+    """Connection object, this object should be created by calling :func:`connect`"""
+
+    def __init__(self):
+        self._closed = False
+        self._conn = None
+        self._session = None
+        self._isolation_level = 0
+        self._autocommit = True
+        self._row_strategy = tuple_row_strategy
+        self._login = None
+        self._use_tz = None
+        self._tzinfo_factory = None
+        self._active_cursor = None
+        self._lock = asyncio.Lock()
+        self._pool = None
+
+    @property
+    def as_dict(self):
+        """
+        Instructs all cursors this connection creates to return results
+        as a dictionary rather than a tuple.
+        """
+        return self._row_strategy == dict_row_strategy
+
+    @as_dict.setter
+    def as_dict(self, value):
+        if value:
+            self._row_strategy = dict_row_strategy
+        else:
+            self._row_strategy = tuple_row_strategy
+
+    @property
+    def autocommit(self):
+        """
+        The current state of autocommit on the connection, use :meth:`set_autocommit` to change it.
+        """
+        return self._autocommit
+
+    async def set_autocommit(self, value):
+        """ Changes autocommit mode of the connection
+
+        Switching autocommit on rolls back transaction which is currently in progress.
+        """
+        if self._autocommit != value:
+            self._assert_open()
+            async with self._lock:
+                if value:
+                    if self._conn.tds72_transaction:
+                        await self._rollback(cont=False)
+                else:
+                    await self._begin_tran()
+            self._autocommit = value
+
+    @property
+    def isolation_level(self):
+        """Isolation level for transactions,
+        for possible values see :ref:`isolation-level-constants`
+        """
+        return self._isolation_level
+
+    @isolation_level.setter
+    def isolation_level(self, level):
+        self._isolation_level = level
+
+    @property
+    def tds_version(self):
+        """
+        Version of tds protocol that is being used by this connection
+        """
+        self._assert_open()
+        return self._conn.tds_version
+
+    @property
+    def product_version(self):
+        """
+        Version of the MSSQL server
+        """
+        self._assert_open()
+        return self._conn.product_version
+
+    @property
+    def mars_enabled(self):
+        """ Always False, MARS is not supported by asyncio interface
+        """
+        return False
+
+    def _assert_open(self):
+        if self._closed:
+            raise Error('Connection closed')
+        if not self._conn or not self._conn.is_connected():
+            raise ClosedConnectionError()
+
+    async def _connect(self, host, port, instance, timeout):
+        login = self._login
+        loop = asyncio.get_event_loop()
+        try:
+            login.server_name = host
+            login.instance_name = instance
+            port = await loop.run_in_executor(
+                None, _resolve_instance_port, host, port, instance, timeout)
+            logger.info('Opening socket to %s:%d', host, port)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except Exception as e:
+            raise LoginError("Cannot connect to server '{0}': {1}".format(host, e), e)
+
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 30)
+
+        transport = _AsyncTransport(reader, writer, timeout)
+        conn = _TdsSocket(self._use_tz)
+        self._conn = conn
+        try:
+            route = await _login(conn, login, transport, self._tzinfo_factory)
+            if route is not None:
+                # rerouted to different server
+                transport.close()
+                await self._connect(host=route['server'],
+                                    port=route['port'],
+                                    instance=instance,
+                                    timeout=timeout)
+                return
+
+            self._session = conn.main_session
+            if not self._autocommit:
+                await self._begin_tran()
+            transport.settimeout(login.query_timeout)
+        except:
+            transport.close()
+            raise
+
+    async def _open(self):
+        login = self._login
+        end_time = time.time() + login.connect_timeout
+        last_error = None
+        for _ in range(len(login.servers)):
+            host, port, instance = login.servers[0]
+            try:
+                await self._connect(host=host, port=port, instance=instance,
+                                    timeout=max(end_time - time.time(), 0.1))
+                return
+            except OperationalError as e:
+                last_error = e
+                # don't retry authentication errors, to not cause account to be locked
+                if self._conn is not None and len(self._conn.main_session.messages) <= 1 and \
+                        e.msg_no in (18456, 18486, 18487, 18488, 18452):
+                    raise
+            if time.time() > end_time:
+                break
+            login.servers.rotate(-1)
+        raise last_error
+
+    async def _begin_tran(self):
+        session = self._session
+        await _request(session,
+                       lambda: session.submit_begin_tran(isolation_level=self._isolation_level),
+                       session.process_simple_request)
+
+    async def _commit(self, cont):
+        session = self._session
+        await _request(session,
+                       lambda: session.submit_commit(cont=cont, isolation_level=self._isolation_level),
+                       session.process_simple_request)
+
+    async def _rollback(self, cont):
+        session = self._session
+        await _request(session,
+                       lambda: session.submit_rollback(cont=cont, isolation_level=self._isolation_level),
+                       session.process_simple_request)
+
+    async def _ensure_transaction(self):
+        if not self._autocommit and not self._conn.tds72_transaction:
+            await self._begin_tran()
+
+    def _try_activate_cursor(self, cursor):
+        if cursor is not self._active_cursor:
+            active = self._active_cursor
+            if active is not None and active._session is not None and \
+                    self._session.state == tds_base.TDS_PENDING and not self._session.in_cancel:
+                raise InterfaceError('Results are still pending on connection')
+            self._active_cursor = cursor
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def cursor(self):
+        """
+        Return cursor object that can be used to make queries and fetch
+        results from the database.
+        """
+        self._assert_open()
+        return Cursor(self, self._session, self._tzinfo_factory)
+
+    async def commit(self):
+        """
+        Commit transaction which is currently in progress.
+        """
+        self._assert_open()
+        if self._autocommit:
+            return
+        async with self._lock:
+            if not self._conn.tds72_transaction:
+                return
+            await self._commit(cont=True)
+
+    async def rollback(self):
+        """
+        Roll back transaction which is currently in progress.
+        """
+        try:
+            if self._autocommit:
+                return
+
+            if not self._conn or not self._conn.is_connected():
+                return
+
+            async with self._lock:
+                if not self._conn.tds72_transaction:
+                    return
+                await self._rollback(cont=True)
+        except socket.error as e:
+            if e.errno in (errno.ENETRESET, errno.ECONNRESET, errno.EPIPE):
+                return
+            self._conn.close()
+            raise
+        except ClosedConnectionError:
+            pass
+
+    async def close(self):
+        """ Close connection to an MS SQL Server.
+
+        If connection was acquired from :class:`Pool` it is returned into the pool.
+        It can be called more than once in a row.  No exception is raised in this case.
+        """
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.release(self)
+            return
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+            self._session = None
+            self._active_cursor = None
+        self._closed = True
+
+
+class Cursor(object):
+    """
+    This class represents a database cursor, which is used to issue queries
+    and fetch results from a database connection.
+
+    Fetching methods are coroutines which receive rows as they are read,
+    except that results of :meth:`callproc` are received completely
+    before it returns, as well as results read by :meth:`fetchall_columnar`.
+    """
+    def __init__(self, conn, session, tzinfo_factory):
+        self._conn = conn
+        self.arraysize = 1
+        self.executemany_batch_size = 1
+        self._session = session
+        self._tzinfo_factory = tzinfo_factory
+        self._row_factory = None
+
+    def _assert_open(self):
+        conn = self._conn
+        if conn is None:
+            raise InterfaceError('Cursor is closed')
+        conn._assert_open()
+        self._session = conn._session
+        return conn
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        row = await self.fetchone()
+        if row is None:
+            raise StopAsyncIteration
+        return row
+
+    def _setup_row_factory(self):
+        self._row_factory = None
+        if self._session.res_info:
+            column_names = [col[0] for col in self._session.res_info.description]
+            self._row_factory = self._conn._row_strategy(column_names)
+
+    async def execute(self, operation, params=()):
+        """ Execute the query
+
+        :param operation: SQL statement
+        :type operation: str
+        """
+        conn = self._assert_open()
+        async with conn._lock:
+            conn._try_activate_cursor(self)
+            await conn._ensure_transaction()
+            session = self._session
+            await _request(session,
+                           _make_execute_request(session, operation, params),
+                           session.find_result_or_done,
+                           incremental=True)
+            self._setup_row_factory()
+        return self
+
+    async def executemany(self, operation, params_seq, batch_size=None):
+        """ Execute the query for every set of parameters
+
+        See :meth:`pytds.Cursor.executemany`.
+        """
+        if batch_size is None:
+            batch_size = self.executemany_batch_size
+        conn = self._assert_open()
+        async with conn._lock:
+            conn._try_activate_cursor(self)
+            await conn._ensure_transaction()
+            session = self._session
+            if batch_size == 1:
+                counts = []
+                for params in params_seq:
+                    await _request(session,
+                                   _make_execute_request(session, operation, params),
+                                   session.find_result_or_done,
+                                   incremental=True)
+                    if session.rows_affected != -1:
+                        counts.append(session.rows_affected)
+                if counts:
+                    session.rows_affected = sum(counts)
+                self._setup_row_factory()
+                return
+            total = -1
+            for submit in _make_executemany_requests(lambda: session, operation, params_seq, batch_size):
+                count = await _request(session, submit, session.process_batch)
+                if count != -1:
+                    total = max(total, 0) + count
+            session.rows_affected = total
+            self._setup_row_factory()
+
+    async def callproc(self, procname, parameters=()):
+        """
+        Call a stored procedure with the given name.
+
+        :param procname: The name of the procedure to call
+        :type procname: str
+        :keyword parameters: The optional parameters for the procedure
+        :type parameters: sequence
+        """
+        conn = self._assert_open()
+        async with conn._lock:
+            conn._try_activate_cursor(self)
+            await conn._ensure_transaction()
+            session = self._session
+            results = list(parameters)
+            parameters = session._convert_params(parameters)
+            await _request(session,
+                           lambda: session.submit_rpc(procname, parameters, 0),
+                           session.process_rpc)
+            for key, param in session.output_params.items():
+                results[key] = param.value
+            self._setup_row_factory()
+        return results
+
+    async def execute_scalar(self, query_string, params=None):
+        """
+        Executes query and returns first column of first row from the result
+        """
+        await self.execute(query_string, params)
+        row = await self.fetchone()
+        if not row:
+            return None
+        return row[0]
+
+    async def cancel(self):
+        """ Cancel current statement
+        """
+        conn = self._assert_open()
+        async with conn._lock:
+            conn._try_activate_cursor(self)
+            await _drain(self._session)
+
+    def close(self):
+        """
+        Closes the cursor. The cursor is unusable from this point.
+        """
+        conn = self._conn
+        if conn is not None:
+            if self is conn._active_cursor:
+                conn._active_cursor = None
+            self._session = None
+            self._conn = None
+
+    @property
+    def connection(self):
+        """ Provides link back to :class:`Connection` of this cursor
+        """
+        return self._conn
+
+    @property
+    def return_value(self):
+        """ Last stored proc result
+        """
+        if self._session is None:
+            return None
+        if not self._session.has_status:
+            if self._session.state != tds_base.TDS_IDLE and not self._session._transport.message_received:
+                raise InterfaceError('Return status is not received yet, call nextset until it returns None')
+            self._session.find_return_status()
+        return self._session.ret_status if self._session.has_status else None
+
+    @property
+    def rowcount(self):
+        """ Number of rows affected by previous statement
+
+        :returns: -1 if this information was not supplied by MSSQL server
+        """
+        if self._session is None:
+            return -1
+        return self._session.rows_affected
+
+    @property
+    def description(self):
+        """ Cursor description, see http://legacy.python.org/dev/peps/pep-0249/#description
+        """
+        if self._session is None:
+            return None
+        res = self._session.res_info
+        if res:
+            return res.description
+        else:
+            return None
+
+    @property
+    def messages(self):
+        """ Messages generated by server, see http://legacy.python.org/dev/peps/pep-0249/#cursor-messages
+        """
+        if self._session:
+            result = []
+            for msg in self._session.messages:
+                ex = _create_exception_by_message(msg)
+                result.append((type(ex), ex))
+            return result
+        else:
+            return None
+
+    async def nextset(self):
+        """ Move to next recordset in batch statement, all rows of current recordset are
+        discarded if present.
+
+        :returns: true if successful or ``None`` when there are no more recordsets
+        """
+        session = self._session
+        # remaining rows are skipped one by one, so that parsing is not repeated from their start
+        while session.more_rows:
+            await _parse(session, session.next_row)
+        res = await _parse(session, session.next_set)
+        self._setup_row_factory()
+        return res
+
+    async def fetchone(self):
+        """ Fetches next row, or ``None`` if there are no more rows
+        """
+        row = await _parse(self._session, self._session.fetchone)
+        if row:
+            return self._row_factory(row)
+
+    async def fetchmany(self, size=None):
+        """ Fetches next multiple rows
+
+        :param size: Maximum number of rows to return, default value is cursor.arraysize
+        :returns: List of rows
+        """
+        if size is None:
+            size = self.arraysize
+        session = self._session
+        rows = []
+        for _ in range(size):
+            row = await _parse(session, session.fetchone)
+            if not row:
+                break
+            rows.append(self._row_factory(row))
+        return rows
+
+    async def fetchall(self):
+        """ Fetches all remaining rows
+        """
+        session = self._session
+        rows = []
+        while True:
+            row = await _parse(session, session.fetchone)
+            if not row:
+                return rows
+            rows.append(self._row_factory(row))
+
+    async def fetch_columns(self, size=None):
+        """ Fetches next multiple rows in columnar form, see :meth:`pytds.Cursor.fetch_columns`
+        """
+        if size is None:
+            size = self.arraysize
+        return await _parse(self._session, self._session.fetch_columns, size)
+
+    async def fetchall_columnar(self):
+        """ Fetches all remaining rows in columnar form, see :meth:`pytds.Cursor.fetch_columns`
+
+        Rest of the response is received before rows are decoded.
+        """
+        session = self._session
+        if session.state != tds_base.TDS_IDLE and not session._transport.message_received:
+            await _receive(session)
+        return session.fetch_columns()
+
+
+async def connect(dsn=None, database=None, user=None, password=None, timeout=None,
+                  login_timeout=15, as_dict=None,
+                  appname=None, port=None, tds_version=tds_base.TDS74,
+                  autocommit=False,
+                  blocksize=4096, auth=None, readonly=False,
+                  load_balancer=None, use_tz=None, bytes_to_unicode=True,
+                  row_strategy=None, failover_partner=None,
+                  cafile=None, validate_host=True, enc_login_only=False,
+                  prepared_cache_size=0):
+    """
+    Opens connection to the database, parameters have the same meaning
+    as for :func:`pytds.connect`
+
+    :returns: An instance of :class:`Connection`
+    """
+    login = _create_login(
+        dsn=dsn, database=database, user=user, password=password, timeout=timeout,
+        login_timeout=login_timeout, appname=appname, port=port, tds_version=tds_version,
+        blocksize=blocksize, use_mars=False, auth=auth, readonly=readonly,
+        load_balancer=load_balancer, use_tz=use_tz, bytes_to_unicode=bytes_to_unicode,
+        failover_partner=failover_partner, cafile=cafile, validate_host=validate_host,
+        enc_login_only=enc_login_only, prepared_cache_size=prepared_cache_size,
+        tls_backend='openssl')
+
+    conn = Connection()
+    conn._use_tz = use_tz
+    conn._autocommit = autocommit
+    conn._login = login
+
+    assert row_strategy is None or as_dict is None,\
+        'Both row_startegy and as_dict were specified, you should use either one or another'
+    if as_dict is not None:
+        conn.as_dict = as_dict
+    elif row_strategy is not None:
+        conn._row_strategy = row_strategy
+
+    from .tz import FixedOffsetTimezone
+    conn._tzinfo_factory = None if use_tz is None else FixedOffsetTimezone
+    await conn._open()
+    return conn
+
+
+class _PoolConnectionContext(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool._acquire()
+        return self._conn
+
+    async def __aexit__(self, *args):
+        await self._pool.release(self._conn)
+
+    def __await__(self):
+        return self._pool._acquire().__await__()
+
+
+class Pool(object):
+    """ Pool of asynchronous connections, should be created by calling :func:`create_pool`
+
+    Connections are acquired using :meth:`acquire`, which can be used
+    either as a coroutine or as an asynchronous context manager::
+
+        async with pool.acquire() as conn:
+            ...
+    """
+
+    def __init__(self, max_size, connect_kwargs):
+        self._max_size = max_size
+        self._connect_kwargs = connect_kwargs
+        self._free = collections.deque()
+        self._used = set()
+        self._cond = asyncio.Condition()
+        self._closed = False
+
+    @property
+    def size(self):
+        """ Number of connections currently opened by the pool """
+        return len(self._free) + len(self._used)
+
+    def acquire(self):
+        """ Takes connection from the pool, opening new connection when there is no idle connections
+
+        Waits for a connection to be released when pool has max_size connections in use.
+        """
+        return _PoolConnectionContext(self)
+
+    async def _acquire(self):
+        async with self._cond:
+            while True:
+                if self._closed:
+                    raise InterfaceError('Pool is closed')
+                while self._free:
+                    conn = self._free.pop()
+                    if conn._conn is not None and conn._conn.is_connected():
+                        self._used.add(conn)
+                        conn._pool = self
+                        return conn
+                    await conn.close()
+                if self.size < self._max_size:
+                    break
+                await self._cond.wait()
+            # reserve slot while connection is being opened
+            placeholder = object()
+            self._used.add(placeholder)
+        try:
+            conn = await connect(**self._connect_kwargs)
+        except:
+            async with self._cond:
+                self._used.discard(placeholder)
+                self._cond.notify()
+            raise
+        async with self._cond:
+            self._used.discard(placeholder)
+            self._used.add(conn)
+        conn._pool = self
+        return conn
+
+    async def release(self, conn):
+        """ Returns connection into the pool
+
+        Pending results are discarded, session state is reset by the server
+        together with the next request, this also rolls back transaction which is in progress.
+        """
+        if conn not in self._used:
+            return
+        conn._pool = None
+        try:
+            if conn._session is not None:
+                async with conn._lock:
+                    await _drain(conn._session)
+                    conn._session._writer.reset_connection()
+                    conn._conn.tds72_transaction = 0
+                    if conn._conn.prepared_cache is not None:
+                        conn._conn.prepared_cache.clear()
+        except Exception:
+            logger.exception('Failed to reset connection returned into the pool')
+            await conn.close()
+        async with self._cond:
+            self._used.discard(conn)
+            if not self._closed and conn._conn is not None:
+                self._free.append(conn)
+            else:
+                await conn.close()
+            self._cond.notify()
+
+    async def close(self):
+        """ Closes idle connections and prevents new connections from being acquired """
+        async with self._cond:
+            self._closed = True
+            while self._free:
+                await self._free.pop().close()
+            self._cond.notify_all()
+
+
+async def create_pool(max_size=10, **kwargs):
+    """ Creates pool of asynchronous connections
+
+    :param max_size: Maximum number of connections opened by the pool
+    :param kwargs: Connection parameters passed to :func:`connect`
+    :returns: An instance of :class:`Pool`
+    """
+    return Pool(max_size=max_size, connect_kwargs=kwargs)
@@ -0,0 +1,234 @@
+""" Hooks for observing activity of connections
+
+Observer is installed using ``observer`` parameter of :func:`pytds.connect`
+or by assigning :attr:`pytds.Connection.observer`.  When no observer is installed
+requests are not instrumented at all.
+"""
+import threading
+import timeit
+
+# clock used for all timings, values are in seconds
+timer = timeit.default_timer
+
+# operation which is being performed by the current thread
+_local = threading.local()
+
+
+def current_operation():
+    """ Returns :class:`OperationStats` of the operation performed by the current thread,
+    None if no observed operation is in progress
+    """
+    return getattr(_local, 'operation', None)
+
+
+def set_current_operation(operation):
+    _local.operation = operation
+
+
+class Observer(object):
+    """ Base class for observers of requests sent over a connection
+
+    Methods are called synchronously by the thread performing request,
+    they should be fast and should not raise exceptions.  Default
+    implementations do nothing, subclasses override methods they need.
+    """
+
+    def request_started(self, stats):
+        """ Called when request is about to be sent to the server
+
+        :param stats: An instance of :class:`RequestStats` which will be
+          updated while request is processed
+        """
+
+    def request_finished(self, stats):
+        """ Called when response to the request is completely processed,
+        or when request was not completed because of an error
+
+        :param stats: An instance of :class:`RequestStats`
+        """
+
+    def operation_started(self, operation):
+        """ Called when cursor starts executing a statement, stored procedure or bulk load
+
+        Operations are ``execute``, ``executemany`` and ``callproc`` calls, and
+        ``copy_to`` and ``copy_from_columns`` bulk loads.  Operations performed
+        internally while another operation is in progress are not reported,
+        their requests are included into the outer operation.
+
+        :param operation: An instance of :class:`OperationStats`
+        """
+
+    def operation_finished(self, operation):
+        """ Called when operation is completed
+
+        Operation is completed when responses to all its requests are read,
+        including rows fetched after the cursor method returned, or when the
+        method raises exception.  If cursor is closed or used for another
+        operation before results are consumed the operation is completed at
+        that moment, and rows which were not fetched are not included.
+
+        :param operation: An instance of :class:`OperationStats`
+        """
+
+    def pool_checkout(self, connection, wait_time, error):
+        """ Called when connection was taken from the connection pool
+
+        :param connection: :class:`pytds.Connection` which acquired pooled connection
+        :param wait_time: Time in seconds spent waiting for the pool
+        :param error: Exception if no connection was acquired, otherwise None
+        """
+
+
+class RequestStats(object):
+    """ Counters and timings of a single request
+
+    All times are values of :data:`timer` taken at corresponding moments,
+    times of events which did not happen are None.
+
+    :ivar packet_type: Type of the request, one of :class:`pytds.tds_base.PacketType` values
+    :ivar start_time: Time when sending of the request started
+    :ivar first_byte_time: Time when first data of the response was received
+    :ivar first_row_time: Time when first row was read, for columnar fetches
+      time when the first block of rows was read
+    :ivar end_time: Time when request was completed
+    :ivar rows: Total number of rows read from all result sets of the response
+    :ivar rows_affected: Row count reported by the server for the last statement, -1 if not reported
+    :ivar bytes_sent: Number of bytes sent including packet headers
+    :ivar packets_sent: Number of packets sent
+    :ivar bytes_received: Number of bytes received including packet headers
+    :ivar packets_received: Number of packets received
+    :ivar wait_time: Time spent blocked on the socket sending request and receiving response
+    :ivar cancelled: True if request was cancelled
+    :ivar operation: :class:`OperationStats` of the operation which sent the request, or None
+    """
+
+    def __init__(self, packet_type):
+        self.packet_type = packet_type
+        self.start_time = timer()
+        self.first_byte_time = None
+        self.first_row_time = None
+        self.end_time = None
+        self.rows = 0
+        self.rows_affected = -1
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.bytes_received = 0
+        self.packets_received = 0
+        self.wait_time = 0.0
+        self.cancelled = False
+        self.operation = None
+        # result sets of the response, their row counts are summed up when request ends
+        self.results = []
+
+    def __repr__(self):
+        fmt = ('<RequestStats packet_type={} duration={} time_to_first_byte={} rows={} '
+               'bytes_sent={} bytes_received={} wait_time={}>')
+        return fmt.format(self.packet_type, self.duration, self.time_to_first_byte, self.rows,
+                          self.bytes_sent, self.bytes_received, self.wait_time)
+
+    @property
+    def duration(self):
+        """ Total time of the request, None if request is not completed """
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    @property
+    def time_to_first_byte(self):
+        """ Time between start of the request and arrival of the first data of the response """
+        if self.first_byte_time is None:
+            return None
+        return self.first_byte_time - self.start_time
+
+    @property
+    def time_to_first_row(self):
+        """ Time between start of the request and reading of the first row """
+        if self.first_row_time is None:
+            return None
+        return self.first_row_time - self.start_time
+
+    @property
+    def client_time(self):
+        """ Time of the request which was not spent waiting on the socket
+
+        This is time spent encoding request and decoding response, it also
+        includes time spent by application between fetches.
+        """
+        if self.end_time is None:
+            return None
+        return self.duration - self.wait_time
+
+
+class OperationStats(object):
+    """ Information about an operation performed by a cursor
+
+    :ivar kind: Name of the cursor method, e.g. ``execute`` or ``copy_to``
+    :ivar operation: SQL statement, name of the stored procedure or name of the table
+    :ivar connection: :class:`pytds.Connection` used for the operation
+    :ivar server: Host name of the server
+    :ivar port: Port of the server
+    :ivar database: Name of the current database of the connection
+    :ivar start_time: Time when operation started
+    :ivar end_time: Time when operation was completed, see :meth:`Observer.operation_finished`
+    :ivar requests: List of :class:`RequestStats` of requests sent by the operation
+    :ivar rowcount: Row count of the cursor after the operation
+    :ivar error: Exception raised by the operation, None if operation succeeded
+    :ivar context: Free for use by observer, e.g. for keeping a tracing span
+    """
+
+    def __init__(self, kind, operation, connection, server, port, database):
+        self.kind = kind
+        self.operation = operation
+        self.connection = connection
+        self.server = server
+        self.port = port
+        self.database = database
+        self.start_time = timer()
+        self.end_time = None
+        self.requests = []
+        self.rowcount = -1
+        self.error = None
+        self.context = None
+        # called once when operation is completed
+        self._finish = None
+
+    def __repr__(self):
+        fmt = '<OperationStats kind={} operation={!r} duration={} rowcount={} error={!r}>'
+        return fmt.format(self.kind, self.operation, self.duration, self.rowcount, self.error)
+
+    @property
+    def duration(self):
+        """ Time of the operation, None if operation is not finished """
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def _finish_when_completed(self, finish):
+        """ Calls finish when all requests of the operation are completed, immediately if they are """
+        self._finish = finish
+        if all(stats.end_time is not None for stats in self.requests):
+            self._finish_now()
+
+    def _request_finished(self):
+        if self._finish is not None and all(stats.end_time is not None for stats in self.requests):
+            self._finish_now()
+
+    def _finish_now(self):
+        finish = self._finish
+        if finish is not None:
+            self._finish = None
+            finish()
+
+    @property
+    def bytes_sent(self):
+        return sum(stats.bytes_sent for stats in self.requests)
+
+    @property
+    def bytes_received(self):
+        """ Number of bytes of responses received so far """
+        return sum(stats.bytes_received for stats in self.requests)
+
+    @property
+    def rows(self):
+        """ Number of rows read so far by requests of the operation """
+        return sum(info.row_count for stats in self.requests for info in stats.results)
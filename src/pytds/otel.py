@@ -0,0 +1,125 @@
+""" Export of operations to OpenTelemetry
+
+Requires ``opentelemetry-api`` package, spans and metrics are sent to
+providers configured by the application, or to global providers by default.
+
+Example::
+
+    import pytds
+    from pytds.otel import OpenTelemetryObserver
+
+    conn = pytds.connect(server, user=user, password=password, observer=OpenTelemetryObserver())
+"""
+import re
+
+try:
+    from opentelemetry import metrics, trace
+except ImportError:
+    OPENTELEMETRY_AVAILABLE = False
+else:
+    OPENTELEMETRY_AVAILABLE = True
+
+from .observer import Observer
+
+_fingerprint_re = re.compile(r"""N?'(?:[^']|'')*'|\b0x[0-9a-fA-F]*|\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b|\s+""")
+
+_bulk_kinds = ('copy_to', 'copy_from_columns')
+
+
+def _replace_literal(m):
+    return ' ' if m.group(0).isspace() else '?'
+
+
+def fingerprint(sql):
+    """ Returns statement with string, binary and numeric literals replaced by ``?``
+    and whitespace collapsed, statements which differ only by literals have the same fingerprint
+    """
+    return _fingerprint_re.sub(_replace_literal, sql).strip()
+
+
+def _operation_name(operation):
+    if operation.kind in _bulk_kinds:
+        return 'BULK INSERT'
+    if operation.kind == 'callproc':
+        return 'EXECUTE'
+    words = (operation.operation or '').split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class OpenTelemetryObserver(Observer):
+    """ Observer which reports operations as OpenTelemetry spans and metrics
+
+    Every ``execute``, ``executemany``, ``callproc`` and bulk load becomes a client
+    span with statement fingerprint, server, database, row count and number
+    of bytes sent and received.  Durations of operations are recorded into
+    ``db.client.operation.duration`` histogram, time spent waiting for pooled
+    connections is recorded into ``db.client.connection.wait_time`` histogram.
+
+    :param tracer_provider: Tracer provider, global provider is used by default
+    :param meter_provider: Meter provider, global provider is used by default
+    :param query_text: Whether fingerprints of statements are added to spans
+    """
+
+    def __init__(self, tracer_provider=None, meter_provider=None, query_text=True):
+        if not OPENTELEMETRY_AVAILABLE:
+            raise ImportError('opentelemetry-api package is required to use OpenTelemetryObserver')
+        from . import __version__
+        self._tracer = trace.get_tracer('pytds', __version__, tracer_provider=tracer_provider)
+        meter = metrics.get_meter('pytds', __version__, meter_provider=meter_provider)
+        self._duration = meter.create_histogram(
+            'db.client.operation.duration', unit='s', description='Duration of database operations')
+        self._pool_wait = meter.create_histogram(
+            'db.client.connection.wait_time', unit='s', description='Time spent waiting for a pooled connection')
+        self._query_text = query_text
+
+    def operation_started(self, operation):
+        op_name = _operation_name(operation)
+        attributes = {
+            'db.system.name': 'microsoft.sql_server',
+            'db.operation.name': op_name,
+            'server.address': operation.server,
+            'server.port': operation.port,
+        }
+        if operation.database:
+            attributes['db.namespace'] = operation.database
+        if operation.kind == 'callproc':
+            attributes['db.stored_procedure.name'] = operation.operation
+            name = '{0} {1}'.format(op_name, operation.operation)
+        elif operation.kind in _bulk_kinds:
+            attributes['db.collection.name'] = operation.operation
+            name = '{0} {1}'.format(op_name, operation.operation)
+        else:
+            if self._query_text:
+                attributes['db.query.text'] = fingerprint(operation.operation or '')
+            name = op_name or 'mssql'
+        operation.context = self._tracer.start_span(name, kind=trace.SpanKind.CLIENT, attributes=attributes)
+
+    def operation_finished(self, operation):
+        span = operation.context
+        attributes = {
+            'db.system.name': 'microsoft.sql_server',
+            'db.operation.name': _operation_name(operation),
+            'server.address': operation.server,
+        }
+        if operation.database:
+            attributes['db.namespace'] = operation.database
+        error = operation.error
+        if error is not None:
+            attributes['error.type'] = type(error).__name__
+            msg_no = getattr(error, 'msg_no', None)
+            if msg_no is not None:
+                span.set_attribute('db.response.status_code', str(msg_no))
+            span.record_exception(error)
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+        span.set_attribute('db.mssql.rows_affected', operation.rowcount)
+        span.set_attribute('db.response.returned_rows', operation.rows)
+        span.set_attribute('db.mssql.bytes_sent', operation.bytes_sent)
+        span.set_attribute('db.mssql.bytes_received', operation.bytes_received)
+        span.end()
+        self._duration.record(operation.duration, attributes)
+
+    def pool_checkout(self, connection, wait_time, error):
+        attributes = {'db.system.name': 'microsoft.sql_server'}
+        if error is not None:
+            attributes['error.type'] = type(error).__name__
+        self._pool_wait.record(wait_time, attributes)
@@ -1,25 +1,12 @@
 # This file implements Session Multiplex Protocol used by MARS connections
 # Protocol documentation https://msdn.microsoft.com/en-us/library/cc219643.aspx
+import collections
 import struct
 import logging
 import threading
 import socket
 import errno
-from six.moves import range
-try:
-    from bitarray import bitarray
-except ImportError:
-    class BitArray(list):
-        def __init__(self, size):
-            super(BitArray, self).__init__()
-            self[:] = [False] * size
-
-        def setall(self, val):
-            for i in range(len(self)):
-                self[i] = val
-
-    bitarray = BitArray
-from .tds_base import Error, skipall
+from .tds_base import Error
 
 
 logger = logging.getLogger(__name__)
@@ -28,26 +15,49 @@ logger = logging.getLogger(__name__)
 SMP_HEADER = struct.Struct('<BBHLLL')
 SMP_ID = 0x53
 
+# maximum number of closed sessions kept for reuse
+_MAX_FREE_SESSIONS = 32
+
+# number of packets waiting for the send window after which sender waits for the window
+_MAX_SEND_QUEUE = 8
+# maximum number of pooled buffers of received packets
+_MAX_FREE_BUFFERS = 32
+
 
 class _SmpSession(object):
     def __init__(self, mgr, session_id):
+        self._mgr = mgr
+        # received packets as tuples (buffer, length), guarded by manager's lock
+        self.recv_queue = collections.deque()
+        # packets waiting for the send window, guarded by manager's send lock
+        self.send_queue = collections.deque()
+        # signalled when packet is queued for the session or its state changes
+        self._cond = threading.Condition(mgr._lock)
+        self._reset(session_id)
+
+    def _reset(self, session_id):
+        """ Initializes state of new session, closed sessions are reset when they are reused """
         self.session_id = session_id
         self.seq_num_for_send = 0
         self.high_water_for_send = 4
         self._seq_num_for_recv = 0
-        self.high_water_for_recv = 4
-        self._last_high_water_for_recv = 4
-        self._mgr = mgr
-        self.recv_queue = []
-        self.send_queue = []
+        # number of packets server can send ahead of the consumer, grows while consumer keeps up
+        self._recv_window = self._mgr._initial_window
+        self.high_water_for_recv = self._recv_window
+        # high water which was last advertised to the server
+        self._last_high_water_for_recv = self._recv_window
+        self.recv_queue.clear()
+        self.send_queue.clear()
         self._state = None
-        self._curr_buf_pos = 0
-        self._curr_buf = b''
+        # packet which is being consumed by recv_into
+        self._curr_buf = None
+        self._curr_pos = 0
+        self._curr_end = 0
 
     def __repr__(self):
         fmt = "<_SmpSession sid={} state={} recv_queue={} send_queue={} seq_num_for_send={}>"
-        return fmt.format(self.session_id, SessionState.to_str(self._state), self.recv_queue, self.send_queue,
-                          self.seq_num_for_send)
+        return fmt.format(self.session_id, SessionState.to_str(self._state), len(self.recv_queue),
+                          len(self.send_queue), self.seq_num_for_send)
 
     def get_state(self):
         return self._state
@@ -58,29 +68,24 @@ class _SmpSession(object):
     def sendall(self, data):
         self._mgr.send_packet(self, data)
 
-    def _recv_internal(self, size):
-        if not self._curr_buf[self._curr_buf_pos:]:
-            self._curr_buf = self._mgr.recv_packet(self)
-            self._curr_buf_pos = 0
-            if not self._curr_buf:
-                return 0, 0
-        to_read = min(size, len(self._curr_buf) - self._curr_buf_pos)
-        offset = self._curr_buf_pos
-        self._curr_buf_pos += to_read
-        return offset, to_read
-
     def recv_into(self, buffer, size=0):
         if size == 0:
             size = len(buffer)
-
-        offset, to_read = self._recv_internal(size)
-        buffer[:to_read] = self._curr_buf[offset:offset + to_read]
+        if self._curr_buf is None:
+            received = self._mgr.recv_packet_into(self, buffer, size)
+            if received is not None:
+                return received
+        pos = self._curr_pos
+        to_read = min(size, self._curr_end - pos)
+        buffer[:to_read] = memoryview(self._curr_buf)[pos:pos + to_read]
+        pos += to_read
+        if pos == self._curr_end:
+            self._mgr.release_buffer(self._curr_buf)
+            self._curr_buf = None
+        else:
+            self._curr_pos = pos
         return to_read
 
-    #def recv(self, size):
-    #    offset, to_read = self._recv_internal(size)
-    #    return self._curr_buf[offset:offset + to_read]
-
     def is_connected(self):
         return self._state == SessionState.SESSION_ESTABLISHED
 
@@ -122,43 +127,90 @@ class SessionState:
 
 
 class SmpManager(object):
-    def __init__(self, transport, max_sessions=2 ** 16):
+    """ Multiplexes sessions over single transport
+
+    Packets are read from the transport by one of the sessions waiting for data at a time,
+    this session demultiplexes packets into queues of other sessions and wakes them up,
+    while other sessions wait on their own condition variables.  Payload is read directly
+    into the buffer of the reading session when it is addressed to it, otherwise it is read
+    into a pooled buffer.  Sending does not wait for receiving, it is serialized by a
+    separate lock.
+
+    Receive window of a session starts at initial_window packets and grows up
+    to max_window packets while consumer of the session reads packets as fast as
+    they arrive.  Window updates are sent in ACK packets only when half of the window
+    was consumed, otherwise they are carried by DATA packets sent by the session.
+
+    :param transport: Socket-like object
+    :param max_sessions: Maximum number of sessions
+    :param initial_window: Initial receive window of sessions in packets
+    :param max_window: Maximum receive window of sessions in packets
+    """
+    def __init__(self, transport, max_sessions=2 ** 16, initial_window=4, max_window=64):
         self._transport = transport
+        self._initial_window = initial_window
+        self._max_window = max(max_window, initial_window)
         self._sessions = {}
-        self._used_ids_ba = bitarray(max_sessions)
-        self._used_ids_ba.setall(False)
-        self._lock = threading.RLock()
+        self._max_sessions = max_sessions
+        # ids of closed sessions, ids above _next_id were never used
+        self._free_ids = []
+        self._next_id = 0
+        # closed sessions which can be reused
+        self._free_sessions = []
+        # guards receiving side of sessions and their states
+        self._lock = threading.Lock()
+        # guards sending side of sessions and writes into the transport
+        self._send_lock = threading.Lock()
+        # whether some thread is reading from the transport
+        self._reading = False
+        # sessions which wait on their condition variables
+        self._waiting = []
+        self._free_buffers = []
         self._hdr_buf = memoryview(bytearray(b'\x00' * SMP_HEADER.size))
 
     def __repr__(self):
         return "<SmpManager sessions={}>".format(self._sessions)
 
     def create_session(self):
-        try:
-            session_id = self._used_ids_ba.index(False)
-        except ValueError:
-            raise Error("Can't create more MARS sessions, close some sessions and try again")
-        session = _SmpSession(self, session_id)
         with self._lock:
+            if self._free_ids:
+                session_id = self._free_ids.pop()
+            elif self._next_id < self._max_sessions:
+                session_id = self._next_id
+                self._next_id += 1
+            else:
+                raise Error("Can't create more MARS sessions, close some sessions and try again")
+            if self._free_sessions:
+                session = self._free_sessions.pop()
+                session._reset(session_id)
+            else:
+                session = _SmpSession(self, session_id)
             self._sessions[session_id] = session
-            self._used_ids_ba[session_id] = True
-            hdr = SMP_HEADER.pack(
-                SMP_ID,
-                PacketTypes.SYN,
-                session_id,
-                SMP_HEADER.size,
-                0,
-                session.high_water_for_recv,
-                )
-            self._transport.sendall(hdr)
             session._state = SessionState.SESSION_ESTABLISHED
+        hdr = SMP_HEADER.pack(
+            SMP_ID,
+            PacketTypes.SYN,
+            session_id,
+            SMP_HEADER.size,
+            0,
+            session.high_water_for_recv,
+            )
+        with self._send_lock:
+            self._transport.sendall(hdr)
         return session
 
     def close_smp_session(self, session):
-        if session._state in (SessionState.CLOSED, SessionState.FIN_SENT):
-            return
-        elif session._state == SessionState.SESSION_ESTABLISHED:
-            with self._lock:
+        with self._lock:
+            if session._state != SessionState.SESSION_ESTABLISHED:
+                return
+            session._state = SessionState.FIN_SENT
+            while session.recv_queue:
+                self.release_buffer(session.recv_queue.popleft()[0])
+            if session._curr_buf is not None:
+                self.release_buffer(session._curr_buf)
+                session._curr_buf = None
+        try:
+            with self._send_lock:
                 hdr = SMP_HEADER.pack(
                     SMP_ID,
                     PacketTypes.FIN,
@@ -167,137 +219,253 @@ class SmpManager(object):
                     session.seq_num_for_send,
                     session.high_water_for_recv,
                     )
-                session._state = SessionState.FIN_SENT
-                try:
-                    self._transport.sendall(hdr)
-                    self.recv_packet(session)
-                except (socket.error, OSError) as ex:
-                    if ex.errno in (errno.ECONNRESET, errno.EPIPE):
-                        session._state = SessionState.CLOSED
-                    else:
-                        raise ex
-
-    def send_queued_packets(self, session):
-        with self._lock:
-            while session.send_queue and session.seq_num_for_send < session.high_water_for_send:
-                data = session.send_queue.pop(0)
-                self.send_packet(session, data)
+                self._transport.sendall(hdr)
+            with self._lock:
+                self._pump(session, lambda: session._state == SessionState.CLOSED)
+                # owner of the session detaches from it when it is closed, see _TdsSession.close
+                if len(self._free_sessions) < _MAX_FREE_SESSIONS:
+                    self._free_sessions.append(session)
+        except (socket.error, OSError) as ex:
+            if ex.errno in (errno.ECONNRESET, errno.EPIPE):
+                session._state = SessionState.CLOSED
+            else:
+                raise ex
 
     @staticmethod
     def _add_one_wrap(val):
         return 0 if val == 2 ** 32 - 1 else val + 1
 
     def send_packet(self, session, data):
+        with self._send_lock:
+            if session.seq_num_for_send < session.high_water_for_send and not session.send_queue:
+                self._send_data(session, data)
+                return
+            session.send_queue.append(data)
+            if len(session.send_queue) <= _MAX_SEND_QUEUE:
+                return
+        # too much data is waiting for the window, wait until it is sent
         with self._lock:
-            if session.seq_num_for_send < session.high_water_for_send:
-                l = SMP_HEADER.size + len(data)
-                seq_num = self._add_one_wrap(session.seq_num_for_send)
-                hdr = SMP_HEADER.pack(
-                    SMP_ID,
-                    PacketTypes.DATA,
-                    session.session_id,
-                    l,
-                    seq_num,
-                    session.high_water_for_recv,
-                    )
-                session._last_high_water_for_recv = session.high_water_for_recv
-                self._transport.sendall(hdr + data)
-                session.seq_num_for_send = self._add_one_wrap(session.seq_num_for_send)
-            else:
-                session.send_queue.append(data)
-                self._read_smp_message()
+            self._pump(session, lambda: not session.send_queue or session._state != SessionState.SESSION_ESTABLISHED)
+
+    def _send_data(self, session, data):
+        # caller should hold send lock
+        seq_num = self._add_one_wrap(session.seq_num_for_send)
+        hdr = SMP_HEADER.pack(
+            SMP_ID,
+            PacketTypes.DATA,
+            session.session_id,
+            SMP_HEADER.size + len(data),
+            seq_num,
+            session.high_water_for_recv,
+            )
+        session._last_high_water_for_recv = session.high_water_for_recv
+        self._transport.sendall(hdr + data)
+        session.seq_num_for_send = seq_num
+
+    def _update_send_window(self, session, wnd):
+        """ Applies window received from the server and sends packets which fit into it """
+        if wnd <= session.high_water_for_send:
+            return
+        with self._send_lock:
+            if wnd <= session.high_water_for_send:
+                return
+            session.high_water_for_send = wnd
+            if not session.send_queue:
+                return
+            while session.send_queue and session.seq_num_for_send < session.high_water_for_send:
+                self._send_data(session, session.send_queue.popleft())
+        # sender could wait for the queue to drain
+        with self._lock:
+            session._cond.notify()
+
+    def _send_ack(self, session):
+        with self._send_lock:
+            hdr = SMP_HEADER.pack(
+                SMP_ID,
+                PacketTypes.ACK,
+                session.session_id,
+                SMP_HEADER.size,
+                session.seq_num_for_send,
+                session.high_water_for_recv,
+                )
+            self._transport.sendall(hdr)
+            session._last_high_water_for_recv = session.high_water_for_recv
+
+    def recv_packet_into(self, session, buffer, size):
+        """ Receives next DATA packet of the session
 
-    def recv_packet(self, session):
+        If calling thread reads the packet from the transport and it fits into the buffer
+        its payload is read directly into the buffer, otherwise the packet becomes current
+        buffer of the session.
+
+        :returns: Number of bytes read into the buffer, 0 if session is closed, None if packet
+          was put into current buffer of the session
+        """
         with self._lock:
             if session._state == SessionState.CLOSED:
-                return b''
-            while not session.recv_queue:
-                self._read_smp_message()
-                if session._state in (SessionState.CLOSED, SessionState.FIN_RECEIVED):
-                    return b''
-            session.high_water_for_recv = self._add_one_wrap(session.high_water_for_recv)
-            if session.high_water_for_recv - session._last_high_water_for_recv >= 2:
-                hdr = SMP_HEADER.pack(
-                    SMP_ID,
-                    PacketTypes.ACK,
-                    session.session_id,
-                    SMP_HEADER.size,
-                    session.seq_num_for_send,
-                    session.high_water_for_recv,
-                    )
-                self._transport.sendall(hdr)
-                session._last_high_water_for_recv = session.high_water_for_recv
-            return session.recv_queue.pop(0)
+                return 0
+            received = self._pump(
+                session,
+                lambda: session.recv_queue or session._state in (SessionState.CLOSED, SessionState.FIN_RECEIVED),
+                buffer, size)
+            if received is None:
+                if not session.recv_queue:
+                    return 0
+                session._curr_buf, session._curr_end = session.recv_queue.popleft()
+                session._curr_pos = 0
+            # consumed packet frees a slot in the window, when consumer keeps up
+            # with the server the window is enlarged
+            credit = 1
+            if not session.recv_queue and session._recv_window < self._max_window:
+                session._recv_window += 1
+                credit = 2
+            session.high_water_for_recv = (session.high_water_for_recv + credit) & 0xffffffff
+            # window update is sent when half of the window was consumed since
+            # last update, DATA packets sent by the session carry it as well
+            unannounced = session.high_water_for_recv - session._last_high_water_for_recv
+            send_ack = unannounced >= max(session._recv_window // 2, 1)
+        if send_ack:
+            self._send_ack(session)
+        return received
+
+    def _pump(self, session, ready, buffer=None, size=0):
+        """ Waits until ready returns true, reading packets from the transport if no other thread does it
+
+        Caller should hold the lock, it is released while waiting and reading.
+
+        :returns: Number of bytes read directly into the buffer, see :meth:`_read_smp_message`
+        """
+        try:
+            while not ready():
+                if self._reading:
+                    self._waiting.append(session)
+                    try:
+                        session._cond.wait()
+                    finally:
+                        self._waiting.remove(session)
+                    continue
+                self._reading = True
+                self._lock.release()
+                try:
+                    received = self._read_smp_message(session, buffer, size)
+                finally:
+                    self._lock.acquire()
+                    self._reading = False
+                if received is not None:
+                    return received
+            return None
+        finally:
+            if not self._reading and self._waiting:
+                # let one of waiting sessions continue reading from the transport
+                self._waiting[0]._cond.notify()
+
+    def _get_buffer(self, size):
+        try:
+            buf = self._free_buffers.pop()
+        except IndexError:
+            return bytearray(size)
+        if len(buf) < size:
+            return bytearray(size)
+        return buf
+
+    def release_buffer(self, buf):
+        """ Returns buffer of a received packet into the pool """
+        if len(self._free_buffers) < _MAX_FREE_BUFFERS:
+            self._free_buffers.append(buf)
+
+    def _recv_exact(self, view, size, message):
+        pos = 0
+        while pos < size:
+            received = self._transport.recv_into(view[pos:size], size - pos)
+            if not received:
+                self._bad_stm(message)
+            pos += received
 
     def _bad_stm(self, message):
         self.close()
         raise Error(message)
 
-    def _read_smp_message(self):
-        # caller should acquire lock before calling this function
-        buf_pos = 0
-        while buf_pos < SMP_HEADER.size:
-            read = self._transport.recv_into(self._hdr_buf[buf_pos:])
-            buf_pos += read
-            if read == 0:
-                self._bad_stm('Unexpected EOF while reading SMP header')
+    def _read_smp_message(self, reader, buffer, size):
+        """ Reads single packet from the transport and dispatches it
+
+        Called without the lock by the thread which is reading from the transport.
+
+        :param reader: Session of the calling thread
+        :param buffer: Buffer for payload of the DATA packet addressed to reader, can be None
+        :param size: Size of the buffer
+        :returns: Size of the payload read into the buffer, None if buffer was not used
+        """
+        self._recv_exact(self._hdr_buf, SMP_HEADER.size, 'Unexpected EOF while reading SMP header')
         smid, flags, sid, l, seq_num, wnd = SMP_HEADER.unpack(self._hdr_buf)
         if smid != SMP_ID:
             self._bad_stm('Invalid SMP packet signature')
-        try:
-            session = self._sessions[sid]
-        except KeyError:
-            self._bad_stm('Invalid SMP packet session id')
-        if wnd < session.high_water_for_send:
-            self._bad_stm('Invalid WNDW in packet from server')
-        if seq_num > session.high_water_for_recv:
-            self._bad_stm('Invalid SEQNUM in packet from server')
-        if l < SMP_HEADER.size:
-            self._bad_stm('Invalid LENGTH in packet from server')
-        session._last_recv_seq_num = seq_num
-        if flags == PacketTypes.DATA:
-            if session._state == SessionState.SESSION_ESTABLISHED:
-                if seq_num != self._add_one_wrap(session._seq_num_for_recv):
-                    self._bad_stm('Invalid SEQNUM in DATA packet from server')
-                session._seq_num_for_recv = seq_num
-                remains = l - SMP_HEADER.size
-                while remains:
-                    data = self._transport.recv(remains)
-                    session.recv_queue.append(data)
-                    remains -= len(data)
-                if wnd > session.high_water_for_send:
-                    session.high_water_for_send = wnd
-                    self.send_queued_packets(session)
-
-            elif session._state == SessionState.FIN_SENT:
-                skipall(self._transport, l - SMP_HEADER.size)
+        with self._lock:
+            try:
+                session = self._sessions[sid]
+            except KeyError:
+                self._bad_stm('Invalid SMP packet session id')
+            if wnd < session.high_water_for_send:
+                self._bad_stm('Invalid WNDW in packet from server')
+            if seq_num > session.high_water_for_recv:
+                self._bad_stm('Invalid SEQNUM in packet from server')
+            if l < SMP_HEADER.size:
+                self._bad_stm('Invalid LENGTH in packet from server')
+            session._last_recv_seq_num = seq_num
+            state = session._state
+            if flags == PacketTypes.DATA:
+                if state == SessionState.SESSION_ESTABLISHED:
+                    if seq_num != self._add_one_wrap(session._seq_num_for_recv):
+                        self._bad_stm('Invalid SEQNUM in DATA packet from server')
+                    session._seq_num_for_recv = seq_num
+                elif state != SessionState.FIN_SENT:
+                    self._bad_stm('Unexpected DATA packet from server')
+            elif flags == PacketTypes.ACK:
+                if state in (SessionState.FIN_RECEIVED, SessionState.CLOSED):
+                    self._bad_stm('Unexpected ACK packet from server')
+                if seq_num != session._seq_num_for_recv:
+                    self._bad_stm('Invalid SEQNUM in ACK packet from server')
+            elif flags == PacketTypes.FIN:
+                assert state in (SessionState.SESSION_ESTABLISHED, SessionState.FIN_SENT, SessionState.FIN_RECEIVED)
+                if state == SessionState.SESSION_ESTABLISHED:
+                    session._state = SessionState.FIN_RECEIVED
+                elif state == SessionState.FIN_SENT:
+                    session._state = SessionState.CLOSED
+                    del self._sessions[session.session_id]
+                    self._free_ids.append(session.session_id)
+                elif state == SessionState.FIN_RECEIVED:
+                    self._bad_stm('Unexpected FIN packet from server')
+                session._cond.notify()
+                return None
+            elif flags == PacketTypes.SYN:
+                self._bad_stm('Unexpected SYN packet from server')
             else:
-                self._bad_stm('Unexpected DATA packet from server')
-        elif flags == PacketTypes.ACK:
-            if session._state in (SessionState.FIN_RECEIVED, SessionState.CLOSED):
-                self._bad_stm('Unexpected ACK packet from server')
-            if seq_num != session._seq_num_for_recv:
-                self._bad_stm('Invalid SEQNUM in ACK packet from server')
-            session.high_water_for_send = wnd
-            self.send_queued_packets(session)
-        elif flags == PacketTypes.FIN:
-            assert session._state in (SessionState.SESSION_ESTABLISHED, SessionState.FIN_SENT, SessionState.FIN_RECEIVED)
-            if session._state == SessionState.SESSION_ESTABLISHED:
-                session._state = SessionState.FIN_RECEIVED
-            elif session._state == SessionState.FIN_SENT:
-                session._state = SessionState.CLOSED
-                del self._sessions[session.session_id]
-                self._used_ids_ba[session.session_id] = False
-            elif session._state == SessionState.FIN_RECEIVED:
-                self._bad_stm('Unexpected FIN packet from server')
-        elif flags == PacketTypes.SYN:
-            self._bad_stm('Unexpected SYN packet from server')
-        else:
-            self._bad_stm('Unexpected FLAGS in packet from server')
+                self._bad_stm('Unexpected FLAGS in packet from server')
+
+        received = None
+        if flags == PacketTypes.DATA:
+            length = l - SMP_HEADER.size
+            if state == SessionState.FIN_SENT:
+                # session is closed by client, data is discarded
+                buf = self._get_buffer(length)
+                self._recv_exact(memoryview(buf), length, 'Unexpected EOF while reading SMP payload')
+                self.release_buffer(buf)
+            elif session is reader and buffer is not None and 0 < length <= size:
+                self._recv_exact(memoryview(buffer), length, 'Unexpected EOF while reading SMP payload')
+                received = length
+            elif length:
+                buf = self._get_buffer(length)
+                self._recv_exact(memoryview(buf), length, 'Unexpected EOF while reading SMP payload')
+                with self._lock:
+                    session.recv_queue.append((buf, length))
+                    session._cond.notify()
+        self._update_send_window(session, wnd)
+        return received
 
     def close(self):
         self._transport.close()
 
     def transport_closed(self):
-        for session in self._sessions.values():
-            session._state = SessionState.CLOSED
+        with self._lock:
+            for session in self._sessions.values():
+                session._state = SessionState.CLOSED
+                session._cond.notify_all()
@@ -1,15 +1,30 @@
+import array
 import codecs
+import collections
 import contextlib
+import itertools
 import logging
 import datetime
+import functools
+import heapq
 import six
 import socket
 import struct
+import sys
+import threading
+from six.moves import xrange
+try:
+    import numpy
+except ImportError:
+    NUMPY_AVAILABLE = False
+else:
+    NUMPY_AVAILABLE = True
 
 from .collate import ucs2_codec, Collation, lcid2charset, raw_collation
 from . import tds_base
 from . import tds_types
 from . import tls
+from .observer import RequestStats, timer, current_operation
 from .tds_base import readall, readall_fast, skipall, PreLoginEnc, PreLoginToken
 
 logger = logging.getLogger()
@@ -34,6 +49,10 @@ _uint8_be = struct.Struct('>Q')
 
 logging_enabled = False
 
+_ROW_TOKEN = tds_base.TDS_ROW_TOKEN
+_NBC_ROW_TOKEN = tds_base.TDS_NBC_ROW_TOKEN
+_done_tokens = frozenset((tds_base.TDS_DONE_TOKEN, tds_base.TDS_DONEPROC_TOKEN, tds_base.TDS_DONEINPROC_TOKEN))
+
 
 # stored procedure output parameter
 class output(object):
@@ -93,30 +112,52 @@ class _TdsEnv:
         self.charset = None
 
 
+class _WouldBlock(tds_base.TimeoutError):
+    """ Raised by non-blocking transports when data which was not received yet is requested
+
+    Unlike other timeouts it does not cancel the current request, reader
+    can be restored to a position saved by :meth:`_TdsReader.save_position`
+    and parsing repeated when more data is received.
+    """
+
+
 class _TdsReader(object):
     """ TDS stream reader
 
     Provides stream-like interface for TDS packeted stream.
     Also provides convinience methods to decode primitive data like
     different kinds of integers etc.
+
+    Data is received into a buffer which can hold several packets, transport
+    is asked for as much data as fits into the buffer, so one call to
+    recv_into can receive many packets.  When a requested block of data spans
+    packets, headers of following packets are stripped in place, so that the
+    block becomes contiguous in the buffer and can be used without copying.
     """
+
+    # size of the receive buffer in packets
+    _buffer_packets = 8
+
     def __init__(self, session):
-        self._buf = bytearray(b'\x00' * 4096)
+        self._block_size = 4096
+        self._buf = bytearray(self._block_size * self._buffer_packets)
         self._bufview = memoryview(self._buf)
-        self._pos = len(self._buf)  # position in the buffer
-        self._have = 0  # number of bytes read from packet
-        self._size = 0  # size of current packet
+        self._pos = 0  # position in the buffer
+        self._size = 0  # end of the current packet in the buffer
+        self._filled = 0  # end of the received data in the buffer
         self._session = session
         self._transport = session._transport
         self._type = None
         self._status = None
+        # RequestStats of the current request when observer is installed
+        self._stats = None
 
     def set_block_size(self, size):
-        self._buf = bytearray(b'\x00' * size)
-        self._bufview = memoryview(self._buf)
+        self._block_size = size
+        self._resize(size * self._buffer_packets)
 
     def get_block_size(self):
-        return len(self._buf)
+        return self._block_size
 
     @property
     def session(self):
@@ -141,20 +182,48 @@ class _TdsReader(object):
         :param size: Number of bytes to read
         :returns: Tuple of bytes buffer, and offset in this buffer
         """
+        self._merge(size)
+        offset = self._pos
+        to_read = min(size, self._size - self._pos)
+        self._pos += to_read
+        return self._bufview[:offset + to_read], offset
+
+    def read_view(self, size):
+        """ Reads exactly size bytes from the stream
+
+        Returns memoryview of internal buffer if requested block fits into
+        the buffer, so the result is only valid until the next read
+        from the stream.
+
+        :param size: Number of bytes to read
+        :returns: A memoryview object
+        """
+        self._merge(size)
+        offset = self._pos
+        if self._size - offset >= size:
+            self._pos += size
+            return self._bufview[offset:offset + size]
+        return memoryview(readall(self, size))
+
+    def recv(self, size):
         if self._pos >= self._size:
             self._read_packet()
         offset = self._pos
         to_read = min(size, self._size - self._pos)
         self._pos += to_read
-        return self._buf, offset
+        return self._bufview[offset:offset + to_read].tobytes()
 
-    def recv(self, size):
+    def recv_view(self, size):
+        """ Same as recv but returns memoryview of internal buffer
+
+        Result is only valid until the next read from the stream.
+        """
         if self._pos >= self._size:
             self._read_packet()
         offset = self._pos
         to_read = min(size, self._size - self._pos)
         self._pos += to_read
-        return self._buf[offset:offset+to_read]
+        return self._bufview[offset:offset + to_read]
 
     def unpack(self, struc):
         """ Unpacks given structure from stream
@@ -167,7 +236,12 @@ class _TdsReader(object):
 
     def get_byte(self):
         """ Reads one byte from stream """
-        return self.unpack(_byte)[0]
+        pos = self._pos
+        while pos >= self._size:
+            self._read_packet()
+            pos = self._pos
+        self._pos = pos + 1
+        return self._buf[pos]
 
     def get_smallint(self):
         """ Reads 16bit signed integer from the stream """
@@ -199,7 +273,7 @@ class _TdsReader(object):
 
     def read_ucs2(self, num_chars):
         """ Reads num_chars UCS2 string from the stream """
-        buf = readall(self, num_chars * 2)
+        buf = self.read_view(num_chars * 2)
         return ucs2_codec.decode(buf)[0]
 
     def read_str(self, size, codec):
@@ -209,40 +283,155 @@ class _TdsReader(object):
         :param codec: Instance of codec to decode string
         :returns: Unicode string
         """
-        return codec.decode(readall(self, size))[0]
+        return codec.decode(self.read_view(size))[0]
 
     def get_collation(self):
         """ Reads :class:`Collation` object from stream """
-        buf = readall(self, Collation.wire_size)
+        buf = self.read_view(Collation.wire_size)
         return Collation.unpack(buf)
 
-    def _read_packet(self):
-        """ Reads next TDS packet from the underlying transport
+    def _resize(self, size):
+        """ Replaces buffer with a buffer of a given size keeping unread data """
+        have = self._filled - self._pos
+        buf = bytearray(max(size, have))
+        buf[:have] = self._bufview[self._pos:self._filled]
+        self._size -= self._pos
+        self._filled = have
+        self._pos = 0
+        self._buf = buf
+        self._bufview = memoryview(buf)
+
+    def _compact(self):
+        """ Moves unread data to the beginning of the buffer """
+        start = self._pos
+        if start == 0:
+            return
+        have = self._filled - start
+        self._buf[:have] = self._buf[start:self._filled]
+        self._pos = 0
+        self._size -= start
+        self._filled = have
+
+    def _receive(self, end):
+        """ Receives data from the transport until buffer is filled up to end position """
+        stats = self._stats
+        while self._filled < end:
+            if stats is None:
+                received = self._transport.recv_into(self._bufview[self._filled:], len(self._buf) - self._filled)
+            else:
+                started = timer()
+                received = self._transport.recv_into(self._bufview[self._filled:], len(self._buf) - self._filled)
+                now = timer()
+                stats.wait_time += now - started
+                if stats.first_byte_time is None:
+                    stats.first_byte_time = now
+            if received == 0:
+                raise tds_base.ClosedConnectionError()
+            self._filled += received
+
+    def _receive_header(self):
+        """ Receives and parses header of the packet which follows current packet
 
         If timeout is happened during reading of packet's header will
         cancel current request.
-        Can only be called when transport's read pointer is at the begining
-        of the packet.
+
+        :returns: Tuple of positions of the header and of the end of the packet in the buffer
         """
-        try:
-            pos = 0
-            while pos < _header.size:
-                received = self._transport.recv_into(self._bufview[pos:_header.size-pos])
-                if received == 0:
-                    raise tds_base.ClosedConnectionError()
-                pos += received
-        except tds_base.TimeoutError:
-            self._session.put_cancel()
-            raise
-        self._pos = _header.size
-        self._type, self._status, self._size, self._session._spid, _ = _header.unpack_from(self._bufview, 0)
-        self._have = pos
-        while pos < self._size:
-            received = self._transport.recv_into(self._bufview[pos:], self._size - pos)
-            if received == 0:
-                raise tds_base.ClosedConnectionError()
-            pos += received
-            self._have += received
+        if len(self._buf) - self._size < self._block_size:
+            self._compact()
+        start = self._size
+        if self._filled < start + _header.size:
+            try:
+                self._receive(start + _header.size)
+            except _WouldBlock:
+                raise
+            except tds_base.TimeoutError:
+                if not self._session.in_cancel:
+                    self._session.put_cancel()
+                raise
+        self._type, self._status, size, self._session._spid, _ = _header.unpack_from(self._bufview, start)
+        end = start + size
+        if end > len(self._buf):
+            # packet is bigger than negotiated block size
+            self._resize(max(len(self._buf), size) + size)
+            start = self._size
+            end = start + size
+        if self._filled < end:
+            self._receive(end)
+        return start, end
+
+    def _read_packet(self):
+        """ Reads next TDS packet from the underlying transport
+
+        Can only be called when read pointer is at the end of the current packet.
+        """
+        if self._size == self._filled:
+            # buffer is drained, start from the beginning
+            self._pos = self._size = self._filled = 0
+        else:
+            self._pos = self._size
+        start, end = self._receive_header()
+        self._pos = start + _header.size
+        self._size = end
+        stats = self._stats
+        if stats is not None:
+            stats.packets_received += 1
+            stats.bytes_received += end - start
+
+    def _merge(self, size):
+        """ Makes at least size bytes available as a contiguous block
+        starting at the read position
+
+        Data of following packets is joined with the current packet by
+        moving the tail of the current packet over the header of the next one.
+        Blocks which are too big for the buffer and blocks which go beyond
+        the end of the message are not joined, in this case less data
+        is available.
+        """
+        while self._size - self._pos < size:
+            if self._pos >= self._size:
+                self._read_packet()
+                continue
+            if self._status & 1 or size > len(self._buf) // 2:
+                # last packet of the message or block is too big
+                return
+            start, end = self._receive_header()
+            avail = self._size - self._pos
+            pos = start + _header.size - avail
+            self._buf[pos:pos + avail] = self._buf[self._pos:self._size]
+            self._pos = pos
+            self._size = end
+
+    def save_position(self):
+        """ Saves current position of the reader, see :meth:`restore_position`
+
+        Data which was received but not read yet is copied, since following
+        reads can move it within the buffer.
+
+        :returns: Opaque position object
+        """
+        stats = self._stats
+        counters = None if stats is None else (stats.packets_received, stats.bytes_received)
+        return (bytes(self._bufview[self._pos:self._filled]), self._size - self._pos,
+                self._type, self._status, counters)
+
+    def restore_position(self, position):
+        """ Returns reader into position saved by :meth:`save_position`
+
+        Data received from transport after the position was saved is dropped,
+        transport should deliver it again.
+        """
+        data, size, self._type, self._status, counters = position
+        if len(self._buf) < len(data):
+            self._buf = bytearray(len(data))
+            self._bufview = memoryview(self._buf)
+        self._buf[:len(data)] = data
+        self._pos = 0
+        self._size = size
+        self._filled = len(data)
+        stats = self._stats
+        if stats is not None and counters is not None:
+            stats.packets_received, stats.bytes_received = counters
 
     def read_whole_packet(self):
         """ Reads single packet and returns bytes payload of the packet
@@ -251,7 +440,15 @@ class _TdsReader(object):
         of the packet.
         """
         self._read_packet()
-        return readall(self, self._size - _header.size)
+        return readall(self, self._size - self._pos)
+
+
+# types of requests which can carry RESETCONNECTION flag
+_resettable_packet_types = (
+    tds_base.PacketType.QUERY,
+    tds_base.PacketType.RPC,
+    tds_base.PacketType.TRANS,
+)
 
 
 class _TdsWriter(object):
@@ -268,6 +465,9 @@ class _TdsWriter(object):
         self._buf = bytearray(bufsize)
         self._packet_no = 0
         self._type = 0
+        self._reset_connection = False
+        # RequestStats of the current request when observer is installed
+        self._stats = None
 
     @property
     def session(self):
@@ -289,6 +489,15 @@ class _TdsWriter(object):
         else:
             self._buf = self._buf[0:bufsize]
 
+    def reset_connection(self):
+        """ Requests server to reset session state before processing next request
+
+        RESETCONNECTION flag is sent in the header of the first packet of the next
+        SQL batch, RPC or transaction manager request, this saves a round-trip
+        comparing to calling ``sp_reset_connection``.
+        """
+        self._reset_connection = True
+
     def begin_packet(self, packet_type):
         """ Starts new packet stream
 
@@ -298,8 +507,18 @@ class _TdsWriter(object):
         self._pos = 8
 
     def pack(self, struc, *args):
-        """ Packs and writes structure into stream """
-        self.write(struc.pack(*args))
+        """ Packs and writes structure into stream
+
+        Values are packed directly into the packet buffer when they fit
+        into the current packet, otherwise they are split across packets.
+        """
+        pos = self._pos
+        end = pos + struc.size
+        if end <= len(self._buf):
+            struc.pack_into(self._buf, pos, *args)
+            self._pos = end
+        else:
+            self.write(struc.pack(*args))
 
     def put_byte(self, value):
         """ Writes single byte into stream """
@@ -346,6 +565,12 @@ class _TdsWriter(object):
 
         Function returns only when entire buffer is written
         """
+        size = len(data)
+        pos = self._pos
+        if pos + size <= len(self._buf):
+            self._buf[pos:pos + size] = data
+            self._pos = pos + size
+            return
         data_off = 0
         while data_off < len(data):
             left = len(self._buf) - self._pos
@@ -357,6 +582,44 @@ class _TdsWriter(object):
                 self._pos += to_write
                 data_off += to_write
 
+    def write_plp_chunks(self, chunks):
+        """ Writes PLP value of unknown length
+
+        :param chunks: Iterable of chunks, empty chunks are skipped
+        """
+        self.put_uint8(tds_base.PLP_UNKNOWN)
+        for chunk in chunks:
+            if chunk:
+                self.put_uint(len(chunk))
+                self.write(chunk)
+        self.put_uint(0)
+
+    def write_plp_from(self, readinto):
+        """ Writes PLP value of unknown length reading it from a binary stream
+
+        Data is read directly into the packet buffer, every chunk of the value
+        fills the rest of the current packet.
+
+        :param readinto: readinto method of the stream
+        """
+        self.put_uint8(tds_base.PLP_UNKNOWN)
+        header_size = _uint_le.size
+        while True:
+            if len(self._buf) - self._pos <= header_size:
+                self._write_packet(final=False)
+            pos = self._pos
+            view = memoryview(self._buf)[pos + header_size:]
+            try:
+                size = readinto(view)
+            finally:
+                # release buffer, so that it can be resized later
+                del view
+            if not size:
+                break
+            _uint_le.pack_into(self._buf, pos, size)
+            self._pos = pos + header_size + size
+        self.put_uint(0)
+
     def write_b_varchar(self, s):
         self.put_byte(len(s))
         self.write_ucs2(s)
@@ -385,9 +648,20 @@ class _TdsWriter(object):
         :param final: True means this is the final packet in substream.
         """
         status = 1 if final else 0
+        if self._reset_connection and self._type in _resettable_packet_types:
+            status |= 8  # RESETCONNECTION
+            self._reset_connection = False
         _header.pack_into(self._buf, 0, self._type, status, self._pos, 0, self._packet_no)
         self._packet_no = (self._packet_no + 1) % 256
-        self._transport.sendall(self._buf[:self._pos])
+        stats = self._stats
+        if stats is None:
+            self._transport.sendall(self._buf[:self._pos])
+        else:
+            started = timer()
+            self._transport.sendall(self._buf[:self._pos])
+            stats.wait_time += timer() - started
+            stats.packets_sent += 1
+            stats.bytes_sent += self._pos
         self._pos = 8
 
 
@@ -414,6 +688,96 @@ def _create_exception_by_message(msg, custom_error_msg=None):
     return ex
 
 
+class _DeadlineTimer(object):
+    """ Calls functions when their deadlines expire
+
+    A single background thread serves all connections, it is started when the
+    first call is scheduled.  Callbacks are called from that thread, they should
+    not block.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        # heap of handles, handle is a list [deadline, sequence number, callback],
+        # callback is None for cancelled and completed handles
+        self._heap = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._thread = None
+
+    def call_later(self, delay, callback):
+        """ Schedules call of callback after delay seconds
+
+        :param delay: Delay in seconds
+        :param callback: Function which is called with the handle as the only argument
+        :returns: Handle of the call which can be passed to :meth:`cancel`
+        """
+        handle = [timer() + delay, next(self._counter), callback]
+        with self._cond:
+            heapq.heappush(self._heap, handle)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pytds-deadline-timer')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is handle:
+                self._cond.notify()
+        return handle
+
+    def cancel(self, handle):
+        """ Cancels scheduled call, does nothing if call was already made """
+        with self._cond:
+            if handle[2] is None:
+                return
+            handle[2] = None
+            self._cancelled += 1
+            # cancelled handles are removed lazily, unless they make up most of the heap
+            if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+                self._heap = [h for h in self._heap if h[2] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = timer()
+                while self._heap and self._heap[0][0] <= now:
+                    handle = heapq.heappop(self._heap)
+                    callback = handle[2]
+                    if callback is None:
+                        self._cancelled -= 1
+                        continue
+                    handle[2] = None
+                    self._cond.release()
+                    try:
+                        callback(handle)
+                    except Exception:
+                        logger.exception('Deadline callback failed')
+                    finally:
+                        self._cond.acquire()
+                    now = timer()
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+
+_deadline_timer = _DeadlineTimer()
+
+
+class _ClosedTransport(object):
+    """ Transport of closed sessions """
+    def is_connected(self):
+        return False
+
+    def sendall(self, data, flags=0):
+        raise tds_base.ClosedConnectionError()
+
+    def recv_into(self, buffer, size=0):
+        return 0
+
+    def close(self):
+        pass
+
+
+_closed_transport = _ClosedTransport()
+
+
 class _TdsSession(object):
     """ TDS session
 
@@ -450,10 +814,50 @@ class _TdsSession(object):
         self.return_value_index = 0
         self._out_params_indexes = []
         self.row = None
+        # last LobReader of the current row
+        self._pending_lob = None
         self.end_marker = 0
+        self._token_table = self._make_token_table()
+        # RequestStats of the current request, only collected when observer is installed
+        self._stats = None
+        # timeout in seconds for the next requests, None means no timeout
+        self.request_timeout = None
+        # guards sending of cancel requests, which can happen from other threads,
+        # against transitions of the session state
+        self._cancel_lock = threading.Lock()
+        # cancel request was made while request was being sent
+        self._cancel_deferred = False
+        # handle of the deadline timer call for the current request
+        self._deadline = None
+        # current request was cancelled because its timeout expired
+        self._timed_out = False
+
+    def _make_token_table(self):
+        """ Builds table of bound token handlers indexed by token marker
+
+        Unknown markers are mapped to a handler which reports bad stream.
+        """
+        table = [functools.partial(self._bad_token, marker) for marker in range(256)]
+        table[tds_base.TDS_AUTH_TOKEN] = self.process_auth
+        table[tds_base.TDS_ENVCHANGE_TOKEN] = self.process_env_chg
+        for marker in _done_tokens:
+            table[marker] = functools.partial(self.process_end, marker)
+        for marker in (tds_base.TDS_ERROR_TOKEN, tds_base.TDS_INFO_TOKEN, tds_base.TDS_CAPABILITY_TOKEN):
+            table[marker] = functools.partial(self.process_msg, marker)
+        table[tds_base.TDS_PARAM_TOKEN] = self.process_param
+        table[tds_base.TDS7_RESULT_TOKEN] = self.tds7_process_result
+        table[tds_base.TDS_ROW_TOKEN] = self.process_row
+        table[tds_base.TDS_NBC_ROW_TOKEN] = self.process_nbcrow
+        table[tds_base.TDS_ORDERBY_TOKEN] = self.process_orderby
+        table[tds_base.TDS_RETURNSTATUS_TOKEN] = self.process_returnstatus
+        return table
+
+    def _bad_token(self, marker):
+        self.bad_stream('Invalid TDS marker: {0}({0:x})'.format(marker))
 
     def log_response_message(self, msg):
-        # logging is disabled by default
+        # logging is disabled by default, callers on hot paths check
+        # logging_enabled themselves to avoid building messages
         if logging_enabled:
             logger.info('[%d] %s', self._spid, msg)
 
@@ -506,7 +910,8 @@ class _TdsSession(object):
         This stream contains a list of returned columns.
         Stream format link: http://msdn.microsoft.com/en-us/library/dd357363.aspx
         """
-        self.log_response_message('got COLMETADATA')
+        if logging_enabled:
+            self.log_response_message('got COLMETADATA')
         r = self._reader
 
         # read number of columns and allocate the columns structure
@@ -526,6 +931,8 @@ class _TdsSession(object):
         self.more_rows = True
         self.row = [None] * num_cols
         self.res_info = info = _Results()
+        if self._stats is not None:
+            self._stats.results.append(info)
 
         #
         # loop through the columns populating COLINFO struct from
@@ -550,6 +957,7 @@ class _TdsSession(object):
                  scale,
                  curcol.flags & tds_base.Column.fNullable))
         info.description = tuple(header_tuple)
+        info.row_decoder = _RowDecoder(info.columns)
         return info
 
     def process_param(self):
@@ -586,6 +994,8 @@ class _TdsSession(object):
         # silly cases, nothing to do
         if not self.in_cancel:
             return
+        # response is discarded, timeout of the request is not reported
+        self._timed_out = False
 
         while True:
             token_id = self.get_token_id()
@@ -631,12 +1041,12 @@ class _TdsSession(object):
         This stream contains list of values of one returned row.
         Stream format url: http://msdn.microsoft.com/en-us/library/dd357254.aspx
         """
-        self.log_response_message("got ROW message")
+        if logging_enabled:
+            self.log_response_message("got ROW message")
         r = self._reader
         info = self.res_info
         info.row_count += 1
-        for i, curcol in enumerate(info.columns):
-            curcol.value = self.row[i] = curcol.serializer.read(r)
+        info.row_decoder.read_row(r, self.row)
 
     def process_nbcrow(self):
         """ Reads and handles NBCROW stream.
@@ -645,23 +1055,15 @@ class _TdsSession(object):
         introduced in TDS 7.3.B
         Stream format url: http://msdn.microsoft.com/en-us/library/dd304783.aspx
         """
-        self.log_response_message("got NBCROW message")
+        if logging_enabled:
+            self.log_response_message("got NBCROW message")
         r = self._reader
         info = self.res_info
         if not info:
             self.bad_stream('got row without info')
         assert len(info.columns) > 0
         info.row_count += 1
-
-        # reading bitarray for nulls, 1 represent null values for
-        # corresponding fields
-        nbc = readall(r, (len(info.columns) + 7) // 8)
-        for i, curcol in enumerate(info.columns):
-            if tds_base.my_ord(nbc[i // 8]) & (1 << (i % 8)):
-                value = None
-            else:
-                value = curcol.serializer.read(r)
-            self.row[i] = value
+        info.row_decoder.read_nbcrow(r, self.row)
 
     def process_orderby(self):
         """ Reads and processes ORDER stream
@@ -699,16 +1101,27 @@ class _TdsSession(object):
         if self.res_info:
             self.res_info.more_results = more_results
         rows_affected = r.get_int8() if tds_base.IS_TDS72_PLUS(self) else r.get_int()
-        self.log_response_message("got {} message, more_res={}, cancelled={}, rows_affected={}".format(
-            code_to_str[marker], more_results, was_cancelled, rows_affected))
-        if was_cancelled or (not more_results and not self.in_cancel):
-            self.in_cancel = False
-            self.set_state(tds_base.TDS_IDLE)
+        if logging_enabled:
+            self.log_response_message("got {} message, more_res={}, cancelled={}, rows_affected={}".format(
+                code_to_str[marker], more_results, was_cancelled, rows_affected))
         if done_count_valid:
             self.rows_affected = rows_affected
         else:
             self.rows_affected = -1
         self.done_flags = status
+        if was_cancelled or not more_results:
+            with self._cancel_lock:
+                # cancel request could be sent by another thread, in this case
+                # response ends with its acknowledgement
+                finished = was_cancelled or not self.in_cancel
+                if finished:
+                    if was_cancelled and self._stats is not None:
+                        self._stats.cancelled = True
+                    self.in_cancel = False
+                    self.set_state(tds_base.TDS_IDLE)
+            if finished and was_cancelled and self._timed_out:
+                self._timed_out = False
+                raise tds_base.TimeoutError('Timeout expired')
         if self.done_flags & tds_base.TDS_DONE_ERROR and not was_cancelled and not self.in_cancel:
             self.raise_db_exception()
 
@@ -777,6 +1190,9 @@ class _TdsSession(object):
             old_comp_flags = r.read_ucs2(r.get_byte())
             comp_flags = r.read_ucs2(r.get_byte())
             self.conn.comp_flags = comp_flags
+        elif type_id == tds_base.TDS_ENV_RESET_COMPLETION_ACK:
+            logger.info('session state was reset')
+            skipall(r, size - 1)
         elif type_id == 20:
             # routing
             sz = r.get_usmallint()
@@ -839,7 +1255,14 @@ class _TdsSession(object):
         return self._tds
 
     def close(self):
-        self._transport.close()
+        """ Closes the session
+
+        Session is detached from its transport, which can be reused by new sessions.
+        """
+        transport = self._transport
+        self.set_state(tds_base.TDS_DEAD)
+        self._transport = self._reader._transport = self._writer._transport = _closed_transport
+        transport.close()
 
     def set_state(self, state):
         """ Switches state of the TDS session.
@@ -868,8 +1291,16 @@ class _TdsSession(object):
                 raise tds_base.InterfaceError('logic error: cannot change query state from {0} to {1}'.
                                               format(tds_base.state_names[prior_state], tds_base.state_names[state]))
             self.state = state
+            if self._deadline is not None:
+                self._disarm_deadline()
+            if self._stats is not None:
+                self._finish_stats()
         elif state == tds_base.TDS_DEAD:
             self.state = state
+            if self._deadline is not None:
+                self._disarm_deadline()
+            if self._stats is not None:
+                self._finish_stats()
         elif state == tds_base.TDS_QUERYING:
             if self.state == tds_base.TDS_DEAD:
                 raise tds_base.InterfaceError('logic error: cannot change query state from {0} to {1}'.
@@ -885,6 +1316,54 @@ class _TdsSession(object):
             assert False
         return self.state
 
+    def _start_stats(self, packet_type):
+        """ Starts collecting statistics of a request and notifies observer """
+        stats = self._stats = self._reader._stats = self._writer._stats = RequestStats(packet_type)
+        # first rows are processed by hooks which remove themselves
+        self._set_first_row_hooks()
+        operation = current_operation()
+        if operation is not None:
+            stats.operation = operation
+            operation.requests.append(stats)
+        self._tds.observer.request_started(stats)
+
+    def _finish_stats(self):
+        """ Completes statistics of the current request and notifies observer """
+        stats = self._stats
+        self._stats = self._reader._stats = self._writer._stats = None
+        self._remove_first_row_hooks()
+        stats.end_time = timer()
+        stats.rows = sum(info.row_count for info in stats.results)
+        stats.rows_affected = self.rows_affected
+        observer = self._tds.observer
+        if observer is not None:
+            observer.request_finished(stats)
+        if stats.operation is not None:
+            stats.operation._request_finished()
+
+    def _set_first_row_hooks(self):
+        # token table holds bound handlers, so hooks are placed there too
+        table = self._token_table
+        self.process_row = table[tds_base.TDS_ROW_TOKEN] = self._process_first_row
+        self.process_nbcrow = table[tds_base.TDS_NBC_ROW_TOKEN] = self._process_first_nbcrow
+
+    def _remove_first_row_hooks(self):
+        self.__dict__.pop('process_row', None)
+        self.__dict__.pop('process_nbcrow', None)
+        table = self._token_table
+        table[tds_base.TDS_ROW_TOKEN] = self.process_row
+        table[tds_base.TDS_NBC_ROW_TOKEN] = self.process_nbcrow
+
+    def _process_first_row(self):
+        self._stats.first_row_time = timer()
+        self._remove_first_row_hooks()
+        self.process_row()
+
+    def _process_first_nbcrow(self):
+        self._stats.first_row_time = timer()
+        self._remove_first_row_hooks()
+        self.process_nbcrow()
+
     @contextlib.contextmanager
     def querying_context(self, packet_type):
         """ Context manager for querying.
@@ -894,6 +1373,12 @@ class _TdsSession(object):
         """
         if self.set_state(tds_base.TDS_QUERYING) != tds_base.TDS_QUERYING:
             raise tds_base.Error("Couldn't switch to state")
+        if self._tds.observer is not None:
+            self._start_stats(packet_type)
+        self._timed_out = self._cancel_deferred = False
+        if self.request_timeout:
+            self._deadline = _deadline_timer.call_later(
+                self.request_timeout, functools.partial(self._deadline_expired, self.request_timeout))
         self._writer.begin_packet(packet_type)
         try:
             yield
@@ -902,8 +1387,42 @@ class _TdsSession(object):
                 self.set_state(tds_base.TDS_IDLE)
             raise
         else:
-            self.set_state(tds_base.TDS_PENDING)
             self._writer.flush()
+            with self._cancel_lock:
+                self.set_state(tds_base.TDS_PENDING)
+                if self._cancel_deferred:
+                    self._cancel_deferred = False
+                    self._put_cancel()
+
+    def _deadline_expired(self, timeout, handle):
+        """ Called by deadline timer when timeout of the current request expires
+
+        Sends cancel request, if server does not acknowledge it within another
+        timeout period connection is shut down.
+        """
+        with self._cancel_lock:
+            if self._deadline is not handle:
+                return
+            if not self.in_cancel and not self._cancel_deferred:
+                if not self._send_cancel():
+                    self._deadline = None
+                    return
+                logger.info('Request timeout expired, cancelling request')
+                self._timed_out = True
+            self._deadline = _deadline_timer.call_later(timeout, self._cancel_expired)
+
+    def _cancel_expired(self, handle):
+        """ Called by deadline timer when cancel request of timed out request was not acknowledged """
+        with self._cancel_lock:
+            if self._deadline is not handle:
+                return
+            self._deadline = None
+        logger.warning('Cancel request was not acknowledged in time, shutting down connection')
+        self._tds.abort()
+
+    def _disarm_deadline(self):
+        _deadline_timer.cancel(self._deadline)
+        self._deadline = None
 
     def make_param(self, name, value):
         """ Generates instance of :class:`Column` from value and name
@@ -984,7 +1503,16 @@ class _TdsSession(object):
         :param params: Stored proc parameters, should be a list of :class:`Column` instances.
         :param flags: See spec for possible flags.
         """
-        logger.info('Sending RPC %s flags=%d', rpc_name, flags)
+        self.submit_rpcs([(rpc_name, params, flags)])
+
+    def submit_rpcs(self, calls):
+        """ Sends several RPC calls in a single request.
+
+        Calls are executed by the server one after another, responses
+        to the calls are returned in a single response stream.
+
+        :param calls: List of tuples (rpc_name, params, flags), see :meth:`submit_rpc`
+        """
         self.messages = []
         self.output_params = {}
         self.cancel_if_pending()
@@ -993,43 +1521,52 @@ class _TdsSession(object):
         with self.querying_context(tds_base.PacketType.RPC):
             if tds_base.IS_TDS72_PLUS(self):
                 self._start_query()
-            if tds_base.IS_TDS71_PLUS(self) and isinstance(rpc_name, tds_base.InternalProc):
-                w.put_smallint(-1)
-                w.put_smallint(rpc_name.proc_id)
-            else:
-                if isinstance(rpc_name, tds_base.InternalProc):
-                    rpc_name = rpc_name.name
-                w.put_smallint(len(rpc_name))
-                w.write_ucs2(rpc_name)
+            self._out_params_indexes = []
+            for call_no, (rpc_name, params, flags) in enumerate(calls):
+                if call_no:
+                    # separator between calls
+                    w.put_byte(0xff if tds_base.IS_TDS72_PLUS(self) else 0x80)
+                self._write_rpc(rpc_name, params, flags)
+
+    def _write_rpc(self, rpc_name, params, flags):
+        logger.info('Sending RPC %s flags=%d', rpc_name, flags)
+        w = self._writer
+        if tds_base.IS_TDS71_PLUS(self) and isinstance(rpc_name, tds_base.InternalProc):
+            w.put_smallint(-1)
+            w.put_smallint(rpc_name.proc_id)
+        else:
+            if isinstance(rpc_name, tds_base.InternalProc):
+                rpc_name = rpc_name.name
+            w.put_smallint(len(rpc_name))
+            w.write_ucs2(rpc_name)
+        #
+        # TODO support flags
+        # bit 0 (1 as flag) in TDS7/TDS5 is "recompile"
+        # bit 1 (2 as flag) in TDS7+ is "no metadata" bit this will prevent sending of column infos
+        #
+        w.put_usmallint(flags)
+        for i, param in enumerate(params):
+            if param.flags & tds_base.fByRefValue:
+                self._out_params_indexes.append(i)
+            w.put_byte(len(param.column_name))
+            w.write_ucs2(param.column_name)
             #
-            # TODO support flags
-            # bit 0 (1 as flag) in TDS7/TDS5 is "recompile"
-            # bit 1 (2 as flag) in TDS7+ is "no metadata" bit this will prevent sending of column infos
+            # TODO support other flags (use defaul null/no metadata)
+            # bit 1 (2 as flag) in TDS7+ is "default value" bit
+            # (what's the meaning of "default value" ?)
             #
-            w.put_usmallint(flags)
-            self._out_params_indexes = []
-            for i, param in enumerate(params):
-                if param.flags & tds_base.fByRefValue:
-                    self._out_params_indexes.append(i)
-                w.put_byte(len(param.column_name))
-                w.write_ucs2(param.column_name)
-                #
-                # TODO support other flags (use defaul null/no metadata)
-                # bit 1 (2 as flag) in TDS7+ is "default value" bit
-                # (what's the meaning of "default value" ?)
-                #
-                w.put_byte(param.flags)
+            w.put_byte(param.flags)
 
-                # TYPE_INFO structure: https://msdn.microsoft.com/en-us/library/dd358284.aspx
-                serializer = param.choose_serializer(
-                    type_factory=self._tds.type_factory,
-                    collation=self._tds.collation or raw_collation
-                )
-                type_id = serializer.type
-                w.put_byte(type_id)
-                serializer.write_info(w)
+            # TYPE_INFO structure: https://msdn.microsoft.com/en-us/library/dd358284.aspx
+            serializer = param.choose_serializer(
+                type_factory=self._tds.type_factory,
+                collation=self._tds.collation or raw_collation
+            )
+            type_id = serializer.type
+            w.put_byte(type_id)
+            serializer.write_info(w)
 
-                serializer.write(w, param.value)
+            serializer.write(w, param.value)
 
     def submit_plain_query(self, operation):
         """ Sends a plain query to server.
@@ -1057,10 +1594,27 @@ class _TdsSession(object):
 
         Spec: http://msdn.microsoft.com/en-us/library/dd358082.aspx
 
-        :param metadata: A list of :class:`Column` instances.
-        :param rows: A collection of rows, each row is a collection of values.
+        :param metadata: A list of :class:`Column` instances, columns which have serializer,
+          e.g. columns of result set, are sent using that serializer.
+        :param rows: A collection of rows, each row is a sequence of values.
         :return:
         """
+        def write_rows(w, serializers):
+            write_row = _RowEncoder(serializers).write_row
+            for row in rows:
+                write_row(w, row)
+        self._submit_bulk(metadata, write_rows)
+
+    def submit_bulk_columns(self, metadata, columns):
+        """ Sends insert bulk command with values given by columns.
+
+        :param metadata: A list of :class:`Column` instances, see :meth:`submit_bulk`.
+        :param columns: A list of tuples ``(values, null_mask)`` in the order of metadata,
+          null_mask can be None, see :meth:`_ColumnarEncoder.write_columns`.
+        """
+        self._submit_bulk(metadata, lambda w, serializers: _ColumnarEncoder(serializers).write_columns(w, columns))
+
+    def _submit_bulk(self, metadata, write_rows):
         logger.info('Sending INSERT BULK')
         num_cols = len(metadata)
         w = self._writer
@@ -1074,20 +1628,19 @@ class _TdsSession(object):
                 else:
                     w.put_usmallint(col.column_usertype)
                 w.put_usmallint(col.flags)
-                serializer = col.choose_serializer(
-                    type_factory=self._tds.type_factory,
-                    collation=self._tds.collation,
-                )
+                serializer = col.serializer
+                if serializer is None:
+                    serializer = col.choose_serializer(
+                        type_factory=self._tds.type_factory,
+                        collation=self._tds.collation,
+                    )
                 type_id = serializer.type
                 w.put_byte(type_id)
                 serializers.append(serializer)
                 serializer.write_info(w)
                 w.put_byte(len(col.column_name))
                 w.write_ucs2(col.column_name)
-            for row in rows:
-                w.put_byte(tds_base.TDS_ROW_TOKEN)
-                for i, col in enumerate(metadata):
-                    serializers[i].write(w, row[i])
+            write_rows(w, serializers)
 
             # https://msdn.microsoft.com/en-us/library/dd340421.aspx
             w.put_byte(tds_base.TDS_DONE_TOKEN)
@@ -1104,11 +1657,43 @@ class _TdsSession(object):
 
         Switches connection to IN_CANCEL state.
         """
+        with self._cancel_lock:
+            self._put_cancel()
+
+    def _put_cancel(self):
+        # caller should hold _cancel_lock
         logger.info('Sending CANCEL')
         self._writer.begin_packet(tds_base.PacketType.CANCEL)
         self._writer.flush()
         self.in_cancel = 1
 
+    def send_cancel(self):
+        """ Requests cancellation of the current request without waiting for acknowledgement
+
+        Can be called from any thread.  If request is still being sent cancel request
+        is sent right after it.  Rows of the current result set which were not
+        read yet are discarded, acknowledgement is consumed by the thread reading
+        the response or by the next request.
+
+        :returns: True if request is being cancelled, False if no request is in progress
+        """
+        with self._cancel_lock:
+            if not self._send_cancel():
+                return False
+        self.more_rows = False
+        return True
+
+    def _send_cancel(self):
+        # caller should hold _cancel_lock
+        if self.state in (tds_base.TDS_IDLE, tds_base.TDS_DEAD):
+            return False
+        if not self.in_cancel:
+            if self.state == tds_base.TDS_QUERYING:
+                self._cancel_deferred = True
+            else:
+                self._put_cancel()
+        return True
+
     _begin_tran_struct_72 = struct.Struct('<HBB')
 
     def begin_tran(self, isolation_level=0):
@@ -1333,10 +1918,10 @@ class _TdsSession(object):
                 raise self.bad_stream('Server returned unexpected ENCRYPT_ON value')
             else:
                 # encrypt login packet only
-                tls.establish_channel(self)
+                self._establish_channel()
         elif crypt_flag == PreLoginEnc.ENCRYPT_ON:
             # encrypt entire connection
-            tls.establish_channel(self)
+            self._establish_channel()
         elif crypt_flag == PreLoginEnc.ENCRYPT_REQ:
             if login.enc_flag == PreLoginEnc.ENCRYPT_NOT_SUP:
                 # connection terminated by server and client
@@ -1344,7 +1929,7 @@ class _TdsSession(object):
                                      'enable encryption and try connecting again')
             else:
                 # encrypt entire connection
-                tls.establish_channel(self)
+                self._establish_channel()
         elif crypt_flag == PreLoginEnc.ENCRYPT_NOT_SUP:
             if login.enc_flag == PreLoginEnc.ENCRYPT_ON:
                 # connection terminated by server and client
@@ -1353,6 +1938,9 @@ class _TdsSession(object):
         else:
             self.bad_stream('Unexpected value of enc_flag returned by server: {}'.format(crypt_flag))
 
+    def _establish_channel(self):
+        tls.establish_channel(self)
+
     def tds7_send_login(self, login):
         # https://msdn.microsoft.com/en-us/library/dd304019.aspx
         option_flag2 = login.option_flag2
@@ -1536,32 +2124,37 @@ class _TdsSession(object):
         self.has_status = True
 
     def process_token(self, marker):
-        handler = _token_map.get(marker)
-        if not handler:
-            self.bad_stream('Invalid TDS marker: {0}({0:x})'.format(marker))
-        return handler(self)
+        return self._token_table[marker]()
 
     def get_token_id(self):
-        self.set_state(tds_base.TDS_READING)
+        if self.state != tds_base.TDS_READING:
+            self.set_state(tds_base.TDS_READING)
         try:
+            if self._pending_lob is not None:
+                lob = self._pending_lob
+                self._pending_lob = None
+                lob.expire()
             marker = self._reader.get_byte()
         except tds_base.TimeoutError:
             self.set_state(tds_base.TDS_PENDING)
             raise
         except:
             self._tds.close()
+            if self._timed_out:
+                # connection was shut down because cancel request was not acknowledged
+                raise tds_base.TimeoutError('Timeout expired')
             raise
         return marker
 
     def process_simple_request(self):
         while True:
             marker = self.get_token_id()
-            if marker in (tds_base.TDS_DONE_TOKEN, tds_base.TDS_DONEPROC_TOKEN, tds_base.TDS_DONEINPROC_TOKEN):
+            if marker in _done_tokens:
                 self.process_end(marker)
                 if not self.done_flags & tds_base.TDS_DONE_MORE_RESULTS:
                     return
             else:
-                self.process_token(marker)
+                self._token_table[marker]()
 
     def next_set(self):
         while self.more_rows:
@@ -1583,19 +2176,56 @@ class _TdsSession(object):
 
         return self.row
 
+    def fetch_columns(self, max_rows=None):
+        """ Fetches rows of current result set into per-column buffers
+
+        :param max_rows: Maximum number of rows to fetch, None means all rows
+        :returns: List of tuples (values, null_mask), see :meth:`_ColumnarDecoder.finish`
+        """
+        if self.res_info is None:
+            raise tds_base.ProgrammingError("Previous statement didn't produce any results")
+
+        if self.skipped_to_status:
+            raise tds_base.ProgrammingError("Unable to fetch any rows after accessing return_status")
+
+        info = self.res_info
+        decoder = _ColumnarDecoder(info.columns)
+        r = self._reader
+        count = 0
+        while self.more_rows and (max_rows is None or count < max_rows):
+            marker = self.get_token_id()
+            if marker == tds_base.TDS_ROW_TOKEN:
+                decoder.read_row(r)
+            elif marker == tds_base.TDS_NBC_ROW_TOKEN:
+                decoder.read_nbcrow(r)
+            elif marker in _done_tokens:
+                self.process_end(marker)
+                break
+            else:
+                self._token_table[marker]()
+                continue
+            info.row_count += 1
+            count += 1
+        if count and self._stats is not None and self._stats.first_row_time is None:
+            self._stats.first_row_time = timer()
+        return decoder.finish()
+
     def next_row(self):
         if not self.more_rows:
             return False
         while True:
             marker = self.get_token_id()
-            if marker in (tds_base.TDS_ROW_TOKEN, tds_base.TDS_NBC_ROW_TOKEN):
-                self.process_token(marker)
+            if marker == _ROW_TOKEN:
+                self.process_row()
                 return True
-            elif marker in (tds_base.TDS_DONE_TOKEN, tds_base.TDS_DONEPROC_TOKEN, tds_base.TDS_DONEINPROC_TOKEN):
+            elif marker == _NBC_ROW_TOKEN:
+                self.process_nbcrow()
+                return True
+            elif marker in _done_tokens:
                 self.process_end(marker)
                 return False
             else:
-                self.process_token(marker)
+                self._token_table[marker]()
 
     def find_result_or_done(self):
         self.done_flags = 0
@@ -1604,7 +2234,7 @@ class _TdsSession(object):
             if marker == tds_base.TDS7_RESULT_TOKEN:
                 self.process_token(marker)
                 return True
-            elif marker in (tds_base.TDS_DONE_TOKEN, tds_base.TDS_DONEPROC_TOKEN, tds_base.TDS_DONEINPROC_TOKEN):
+            elif marker in _done_tokens:
                 self.process_end(marker)
                 if self.done_flags & tds_base.TDS_DONE_MORE_RESULTS:
                     if self.done_flags & tds_base.TDS_DONE_COUNT:
@@ -1612,7 +2242,7 @@ class _TdsSession(object):
                 else:
                     return False
             else:
-                self.process_token(marker)
+                self._token_table[marker]()
 
     def process_rpc(self):
         self.done_flags = 0
@@ -1631,6 +2261,43 @@ class _TdsSession(object):
             else:
                 self.process_token(marker)
 
+    def process_batch(self):
+        """ Processes whole response to a request, result sets are skipped
+
+        Used for responses to requests containing multiple statements or RPC calls.
+        Failure of a statement does not stop processing, first error is raised
+        after whole response is consumed.
+
+        :returns: Total number of affected rows, or -1 if server did not return any row counts
+        """
+        self.done_flags = 0
+        total = -1
+        error = None
+        # whether row count was reported by statements of the current RPC call
+        counted = False
+        while True:
+            marker = self.get_token_id()
+            if marker in _done_tokens:
+                try:
+                    self.process_end(marker)
+                except tds_base.DatabaseError as ex:
+                    if error is None:
+                        error = ex
+                if self.done_flags & tds_base.TDS_DONE_COUNT:
+                    # count of DONEPROC duplicates counts of statements of the procedure
+                    if marker != tds_base.TDS_DONEPROC_TOKEN or not counted:
+                        total = max(total, 0) + self.rows_affected
+                        counted = True
+                if marker == tds_base.TDS_DONEPROC_TOKEN:
+                    counted = False
+                if not self.done_flags & tds_base.TDS_DONE_MORE_RESULTS:
+                    self.rows_affected = total
+                    if error is not None:
+                        raise error
+                    return total
+            else:
+                self.process_token(marker)
+
     def complete_rpc(self):
         # go through all result sets
         while self.next_set():
@@ -1645,22 +2312,142 @@ class _TdsSession(object):
                 return
 
 
-_token_map = {
-    tds_base.TDS_AUTH_TOKEN: _TdsSession.process_auth,
-    tds_base.TDS_ENVCHANGE_TOKEN: _TdsSession.process_env_chg,
-    tds_base.TDS_DONE_TOKEN: lambda self: self.process_end(tds_base.TDS_DONE_TOKEN),
-    tds_base.TDS_DONEPROC_TOKEN: lambda self: self.process_end(tds_base.TDS_DONEPROC_TOKEN),
-    tds_base.TDS_DONEINPROC_TOKEN: lambda self: self.process_end(tds_base.TDS_DONEINPROC_TOKEN),
-    tds_base.TDS_ERROR_TOKEN: lambda self: self.process_msg(tds_base.TDS_ERROR_TOKEN),
-    tds_base.TDS_INFO_TOKEN: lambda self: self.process_msg(tds_base.TDS_INFO_TOKEN),
-    tds_base.TDS_CAPABILITY_TOKEN: lambda self: self.process_msg(tds_base.TDS_CAPABILITY_TOKEN),
-    tds_base.TDS_PARAM_TOKEN: lambda self: self.process_param(),
-    tds_base.TDS7_RESULT_TOKEN: lambda self: self.tds7_process_result(),
-    tds_base.TDS_ROW_TOKEN: lambda self: self.process_row(),
-    tds_base.TDS_NBC_ROW_TOKEN: lambda self: self.process_nbcrow(),
-    tds_base.TDS_ORDERBY_TOKEN: lambda self: self.process_orderby(),
-    tds_base.TDS_RETURNSTATUS_TOKEN: lambda self: self.process_returnstatus(),
-    }
+class _PreparedStatementCache(object):
+    """ LRU cache of server side prepared statements
+
+    Maps tuple of SQL statement and parameter declarations to a handle of
+    prepared statement.  First execution of a statement is done using
+    ``sp_prepexec``, handle returned in its output parameter is used to
+    execute statement with ``sp_execute`` later.  Handles of evicted statements
+    are released by ``sp_unprepare`` calls sent in the same request as
+    the next statement.
+
+    Handle is returned by the server after all results of the statement.
+    Until then the statement is executed with ``sp_executesql``, e.g. by other
+    MARS sessions.  If results were cancelled handle is not known, such
+    statement is executed with ``sp_executesql`` afterwards.
+
+    Cache is shared by all sessions of the connection and can be used from
+    several threads.
+
+    :param size: Maximum number of prepared statements
+    """
+
+    def __init__(self, size):
+        self._size = size
+        # values are lists [handle or None, dict of output params of the preparing request, preparing session],
+        # handle is False for statements which should not be prepared
+        self._entries = collections.OrderedDict()
+        self._unprepare = []
+        # entries removed from the cache while their handles were not known yet
+        self._orphans = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """ Forgets all handles without releasing them, should be called when server resets session """
+        with self._lock:
+            self._entries.clear()
+            self._unprepare = []
+            self._orphans = []
+
+    @staticmethod
+    def _resolve(entry):
+        if entry[0] is None:
+            param = entry[1].get(0)
+            if param is not None:
+                entry[0] = param.value
+        return entry[0]
+
+    @staticmethod
+    def _is_pending(entry):
+        """ Whether response of the preparing request is not consumed yet """
+        session = entry[2]
+        return session.output_params is entry[1] and session.state not in (tds_base.TDS_IDLE, tds_base.TDS_DEAD)
+
+    def make_calls(self, session, operation, declarations, params, prepare=True):
+        """ Makes list of RPC calls which execute statement
+
+        :param session: An instance of :class:`_TdsSession`
+        :param operation: SQL statement
+        :param declarations: Tuple of parameter declarations
+        :param params: List of :class:`Column` instances with values of parameters
+        :param prepare: If false statement which is not prepared yet is executed by ``sp_executesql``
+        :returns: Tuple of list of calls for :meth:`_TdsSession.submit_rpcs`, and a function which should be
+          called after the calls are submitted or None
+        """
+        key = (operation, declarations)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if (entry is not None and entry[2] is session and
+                    self._resolve(entry) is None and self._is_pending(entry)):
+                # response of the preparing request will be cancelled by the new request of this session
+                self._orphans.append(entry)
+                entry = None
+            if entry is not None:
+                self._entries[key] = entry
+                handle = self._resolve(entry)
+                if handle is None and not self._is_pending(entry):
+                    # preparation was cancelled, handle is lost
+                    logger.info('handle of prepared statement is not known, statement will not be prepared')
+                    entry[0] = handle = False
+                calls = self._unprepare_calls(session)
+                if handle:
+                    calls.append((tds_base.SP_EXECUTE, [session.make_param('', handle)] + params, 0))
+                else:
+                    # not prepared, or handle is not returned by the preparing session yet
+                    calls.append(self._executesql_call(session, operation, declarations, params))
+                return calls, None
+
+            if not prepare:
+                calls = self._unprepare_calls(session)
+                calls.append(self._executesql_call(session, operation, declarations, params))
+                return calls, None
+
+            while len(self._entries) >= self._size:
+                _, evicted = self._entries.popitem(last=False)
+                self._release(evicted)
+            calls = self._unprepare_calls(session)
+        calls.append((tds_base.SP_PREPEXEC,
+                      [session.make_param('', output(param_type='int')),
+                       session.make_param('', u','.join(declarations)),
+                       session.make_param('', operation)] + params,
+                      0))
+
+        def submitted():
+            entry = [None, session.output_params, session]
+            with self._lock:
+                if key in self._entries:
+                    # statement was prepared concurrently by another session
+                    self._orphans.append(entry)
+                else:
+                    self._entries[key] = entry
+        return calls, submitted
+
+    def _release(self, entry):
+        handle = self._resolve(entry)
+        if handle:
+            self._unprepare.append(handle)
+        elif handle is None and self._is_pending(entry):
+            self._orphans.append(entry)
+
+    def _unprepare_calls(self, session):
+        if self._orphans:
+            orphans = self._orphans
+            self._orphans = []
+            for entry in orphans:
+                self._release(entry)
+        calls = [(tds_base.SP_UNPREPARE, [session.make_param('', handle)], 0) for handle in self._unprepare]
+        self._unprepare = []
+        return calls
+
+    @staticmethod
+    def _executesql_call(session, operation, declarations, params):
+        return (tds_base.SP_EXECUTESQL,
+                [session.make_param('', operation), session.make_param('', u','.join(declarations))] + params,
+                0)
 
 
 # this class represents root TDS connection
@@ -1674,8 +2461,11 @@ class _TdsSocket(object):
         self.tds72_transaction = 0
         self._mars_enabled = False
         self.sock = None
+        self._raw_sock = None
         self.bufsize = 4096
         self.tds_version = tds_base.TDS74
+        # instance of pytds.observer.Observer which is notified about requests
+        self.observer = None
         self.use_tz = use_tz
         self.type_factory = tds_types.SerializerFactory(self.tds_version)
         self.type_inferrer = None
@@ -1684,6 +2474,9 @@ class _TdsSocket(object):
         self._main_session = None
         self._login = None
         self.route = None
+        # host and port of the server this connection is connected to
+        self.server_address = None
+        self.prepared_cache = None
 
     def __repr__(self):
         fmt = "<_TdsSocket tran={} mars={} tds_version={} use_tz={}>"
@@ -1696,6 +2489,8 @@ class _TdsSocket(object):
         self.query_timeout = login.query_timeout
         self._main_session = _TdsSession(self, sock, tzinfo_factory)
         self.sock = sock
+        # plain socket, sock is replaced by a wrapper when encryption is used
+        self._raw_sock = sock
         self.tds_version = login.tds_version
         login.server_enc_flag = PreLoginEnc.ENCRYPT_NOT_SUP
         if tds_base.IS_TDS71_PLUS(self):
@@ -1709,6 +2504,20 @@ class _TdsSocket(object):
         if self.route is not None:
             return self.route
 
+        self._finish_login(tzinfo_factory)
+        q = []
+        if login.database and self.env.database != login.database:
+            q.append('use ' + tds_base.tds_quote_id(login.database))
+        if q:
+            self._main_session.submit_plain_query(''.join(q))
+            self._main_session.process_simple_request()
+        return None
+
+    def _finish_login(self, tzinfo_factory):
+        """ Configures connection according to the results of the login
+
+        :param tzinfo_factory: Timezone factory for new sessions
+        """
         # update block size if server returned different one
         if self._main_session._writer.bufsize != self._main_session._reader.get_block_size():
             self._main_session._reader.set_block_size(self._main_session._writer.bufsize)
@@ -1720,6 +2529,9 @@ class _TdsSocket(object):
             bytes_to_unicode=self._login.bytes_to_unicode,
             allow_tz=not self.use_tz
         )
+        prepared_cache_size = getattr(self._login, 'prepared_cache_size', 0)
+        if prepared_cache_size:
+            self.prepared_cache = _PreparedStatementCache(prepared_cache_size)
         if self._mars_enabled:
             from .smp import SmpManager
             self._smp_manager = SmpManager(self.sock)
@@ -1728,13 +2540,6 @@ class _TdsSocket(object):
                 self._smp_manager.create_session(),
                 tzinfo_factory)
         self._is_connected = True
-        q = []
-        if login.database and self.env.database != login.database:
-            q.append('use ' + tds_base.tds_quote_id(login.database))
-        if q:
-            self._main_session.submit_plain_query(''.join(q))
-            self._main_session.process_simple_request()
-        return None
 
     @property
     def mars_enabled(self):
@@ -1752,13 +2557,24 @@ class _TdsSocket(object):
     def is_connected(self):
         return self._is_connected
 
+    def abort(self):
+        """ Shuts down socket of the connection
+
+        Can be called from any thread, threads blocked on the socket receive
+        end of stream and close the connection.
+        """
+        try:
+            self._raw_sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
     def close(self):
         self._is_connected = False
         if self.sock is not None:
             self.sock.close()
         if self._smp_manager:
             self._smp_manager.transport_closed()
-        self._main_session.state = tds_base.TDS_DEAD
+        self._main_session.set_state(tds_base.TDS_DEAD)
         if self._main_session.authentication:
             self._main_session.authentication.close()
             self._main_session.authentication = None
@@ -1768,6 +2584,416 @@ class _Results(object):
     def __init__(self):
             self.columns = []
             self.row_count = 0
+            self.row_decoder = None
+
+
+def _lob_encoding(serializer):
+    """ Returns encoding of values of PLP type, None for binary types
+
+    Raises ValueError if values of type can't be read by :class:`pytds.tds_types.LobReader`
+    """
+    if isinstance(serializer, tds_types.NVarCharMaxSerializer):
+        return ucs2_codec.name
+    if isinstance(serializer, tds_types.VarCharMaxSerializer):
+        return serializer._codec.name
+    if isinstance(serializer, tds_types.VarBinarySerializerMax):
+        return None
+    raise ValueError('Column of type {0!r} can not be read by LobReader'.format(serializer))
+
+
+class _RowDecoder(object):
+    """ Decoder of ROW and NBCROW tokens precompiled for a result set
+
+    Consecutive columns of fixed size non-nullable types are merged into
+    runs which are decoded by a single struct.Struct, the rest of the columns
+    are decoded by their serializers.  Decoder is built once per COLMETADATA
+    token and reused for every row of the result set.
+    """
+
+    # limit size of a single run so that it always fits into the reader's
+    # buffer and is read as a contiguous block
+    _MAX_RUN_SIZE = 256
+
+    def __init__(self, columns, lob_start=None):
+        """
+        :param columns: List of :class:`Column` instances
+        :param lob_start: Index of the first column which values are
+          returned as :class:`pytds.tds_types.LobReader` instances, all following
+          columns should be of PLP types too
+        """
+        self._num_cols = len(columns)
+        if lob_start is None:
+            self._lob_columns = []
+        else:
+            self._lob_columns = [(i, _lob_encoding(col.serializer))
+                                 for i, col in enumerate(columns[lob_start:], lob_start)]
+            columns = columns[:lob_start]
+        # list of tuples (start, end, struct or None, read method or None)
+        self._steps = steps = []
+        run_start = 0
+        run_fmt = ''
+        for i, col in enumerate(columns):
+            fmt = col.serializer.fixed_format
+            if fmt is not None and run_fmt and \
+                    struct.calcsize('<' + run_fmt + fmt) > self._MAX_RUN_SIZE:
+                steps.append((run_start, i, struct.Struct('<' + run_fmt), None))
+                run_fmt = ''
+            if fmt is None:
+                if run_fmt:
+                    steps.append((run_start, i, struct.Struct('<' + run_fmt), None))
+                    run_fmt = ''
+                steps.append((i, i + 1, None, col.serializer.read))
+            else:
+                if not run_fmt:
+                    run_start = i
+                run_fmt += fmt
+        if run_fmt:
+            steps.append((run_start, len(columns), struct.Struct('<' + run_fmt), None))
+
+    def read_row(self, r, row):
+        """ Reads values of ROW token into row list
+
+        :param r: An instance of :class:`_TdsReader`
+        :param row: List which receives decoded values
+        """
+        for start, end, struc, read in self._steps:
+            if struc is None:
+                row[start] = read(r)
+            else:
+                buf, offset = readall_fast(r, struc.size)
+                row[start:end] = struc.unpack_from(buf, offset)
+        if self._lob_columns:
+            self._read_lobs(r, row, None)
+
+    def read_nbcrow(self, r, row):
+        """ Reads values of NBCROW token into row list
+
+        :param r: An instance of :class:`_TdsReader`
+        :param row: List which receives decoded values
+        """
+        # reading bitarray for nulls, 1 represent null values for
+        # corresponding fields
+        nbc = bytearray(readall(r, (self._num_cols + 7) // 8))
+        for start, end, struc, read in self._steps:
+            if struc is None:
+                if nbc[start >> 3] & (1 << (start & 7)):
+                    row[start] = None
+                else:
+                    row[start] = read(r)
+            else:
+                # fixed size types are never nullable and so are never
+                # marked in the bitmap
+                buf, offset = readall_fast(r, struc.size)
+                row[start:end] = struc.unpack_from(buf, offset)
+        if self._lob_columns:
+            self._read_lobs(r, row, nbc)
+
+    def _read_lobs(self, r, row, nbc):
+        """ Creates readers of values of LOB columns, values are read lazily """
+        lob = None
+        for i, encoding in self._lob_columns:
+            if nbc is not None and nbc[i >> 3] & (1 << (i & 7)):
+                row[i] = tds_types.LobReader(None)
+            else:
+                lob = row[i] = tds_types.LobReader(r, encoding=encoding, prev=lob)
+        r.session._pending_lob = lob
+
+
+class _RowEncoder(object):
+    """ Encoder of ROW tokens precompiled for a bulk load
+
+    Counterpart of :class:`_RowDecoder`, consecutive columns of fixed size
+    types are packed by a single struct.Struct, the rest of the columns are
+    written by their serializers.  ROW token byte is packed together with
+    the leading run of fixed size columns.
+    """
+
+    def __init__(self, serializers):
+        # list of tuples (start, end, struct or None, write method or None)
+        steps = []
+        run_start = 0
+        run_fmt = 'B'
+        for i, serializer in enumerate(serializers):
+            fmt = serializer.fixed_format
+            if fmt is None:
+                if run_fmt:
+                    steps.append((run_start, i, struct.Struct('<' + run_fmt), None))
+                    run_fmt = ''
+                steps.append((i, i + 1, None, serializer.write))
+            else:
+                if not run_fmt:
+                    run_start = i
+                run_fmt += fmt
+        if run_fmt:
+            steps.append((run_start, len(serializers), struct.Struct('<' + run_fmt), None))
+        # first step is always a run starting with the ROW token
+        _, self._head_end, self._head, _ = steps[0]
+        self._steps = steps[1:]
+
+    def write_row(self, w, row):
+        """ Writes ROW token with values from row
+
+        :param w: An instance of :class:`_TdsWriter`
+        :param row: Sequence of values
+        """
+        w.pack(self._head, tds_base.TDS_ROW_TOKEN, *row[:self._head_end])
+        for start, end, struc, write in self._steps:
+            if struc is None:
+                write(w, row[start])
+            else:
+                w.pack(struc, *row[start:end])
+
+
+def _array_frombytes(arr, data):
+    if six.PY2:
+        arr.fromstring(bytes(data))
+    else:
+        arr.frombytes(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+
+
+class _ColumnarDecoder(object):
+    """ Decoder of ROW and NBCROW tokens which accumulates values by columns
+
+    Columns of types which provide array_typecode are stored in
+    :class:`array.array` instances, other columns are stored in lists.
+    Runs of fixed size columns are not unpacked while reading rows, raw bytes
+    of such runs are collected and converted into arrays once by :meth:`finish`.
+    """
+
+    # numpy types for columns where typecode alone is not enough
+    _numpy_dtypes = {
+        tds_base.SYBBIT: 'bool',
+        tds_base.SYBMSDATETIME2: 'datetime64[us]',
+    }
+
+    # numpy types for struct format characters of fixed size types
+    _numpy_fixed_dtypes = {
+        '?': 'bool', 'B': 'u1', 'h': '<i2', 'l': '<i4', 'q': '<i8', 'f': '<f4', 'd': '<f8',
+    }
+
+    def __init__(self, columns):
+        self._columns = columns
+        self._num_cols = len(columns)
+        # list of tuples (start, struct, data, read, values, nulls, fill)
+        self._steps = steps = []
+        for start, end, struc, _ in _RowDecoder(columns)._steps:
+            if struc is None:
+                serializer = columns[start].serializer
+                typecode = serializer.array_typecode
+                if typecode is None:
+                    values = []
+                    fill = None
+                else:
+                    values = array.array(typecode)
+                    fill = 0
+                steps.append((start, None, None, serializer.read_array_value, values, array.array('B'), fill))
+            else:
+                steps.append((start, struc, bytearray(), None, None, None, None))
+
+    def read_row(self, r):
+        """ Reads values of ROW token and appends them to columns
+
+        :param r: An instance of :class:`_TdsReader`
+        """
+        for start, struc, data, read, values, nulls, fill in self._steps:
+            if struc is None:
+                value = read(r)
+                if value is None:
+                    nulls.append(1)
+                    values.append(fill)
+                else:
+                    nulls.append(0)
+                    values.append(value)
+            else:
+                buf, offset = readall_fast(r, struc.size)
+                data += buf[offset:offset + struc.size]
+
+    def read_nbcrow(self, r):
+        """ Reads values of NBCROW token and appends them to columns
+
+        :param r: An instance of :class:`_TdsReader`
+        """
+        nbc = bytearray(readall(r, (self._num_cols + 7) // 8))
+        for start, struc, data, read, values, nulls, fill in self._steps:
+            if struc is None:
+                if nbc[start >> 3] & (1 << (start & 7)):
+                    value = None
+                else:
+                    value = read(r)
+                if value is None:
+                    nulls.append(1)
+                    values.append(fill)
+                else:
+                    nulls.append(0)
+                    values.append(value)
+            else:
+                buf, offset = readall_fast(r, struc.size)
+                data += buf[offset:offset + struc.size]
+
+    def finish(self):
+        """ Returns accumulated columns
+
+        :returns: List of tuples (values, null_mask) in the order of columns,
+          null_mask is None for columns of fixed size types, which are never NULL.
+        """
+        columns = self._columns
+        result = []
+        for start, struc, data, read, values, nulls, fill in self._steps:
+            if struc is None:
+                if NUMPY_AVAILABLE:
+                    values = self._to_numpy(columns[start].serializer, values)
+                    nulls = numpy.array(nulls, dtype='bool')
+                result.append((values, nulls))
+            else:
+                result.extend((values, None) for values in self._split_run(start, struc, data))
+        return result
+
+    def _split_run(self, start, struc, data):
+        serializers = [col.serializer for col in self._columns[start:start + len(struc.format) - 1]]
+        if NUMPY_AVAILABLE:
+            dtype = numpy.dtype([('f{0}'.format(i), self._numpy_fixed_dtypes[serializer.fixed_format])
+                                 for i, serializer in enumerate(serializers)])
+            records = numpy.frombuffer(bytes(data), dtype=dtype)
+            return [records[name].copy() for name in dtype.names]
+        arrays = [[] if serializer.array_typecode is None else array.array(serializer.array_typecode)
+                  for serializer in serializers]
+        if len(arrays) == 1 and isinstance(arrays[0], array.array) and arrays[0].itemsize == struc.size:
+            _array_frombytes(arrays[0], data)
+        else:
+            for offset in xrange(0, len(data), struc.size):
+                for arr, value in zip(arrays, struc.unpack_from(data, offset)):
+                    arr.append(value)
+        return arrays
+
+    def _to_numpy(self, serializer, values):
+        if isinstance(values, list):
+            return values
+        dtype = self._numpy_dtypes.get(serializer.get_typeid())
+        if dtype is None:
+            return numpy.array(values, dtype=values.typecode)
+        return numpy.array(values, dtype=values.typecode).astype(dtype)
+
+
+class _ColumnarEncoder(object):
+    """ Encoder of ROW tokens for a bulk load of data given by columns
+
+    When every column has fixed size type, either non-nullable or nullable
+    (e.g. INTN) one, blocks of rows without NULLs are serialized at once:
+    values of all columns of the block are interleaved and packed by a single
+    struct.Struct, or by a NumPy structured array when columns are NumPy arrays.
+    Blocks containing NULLs and columns of other types are written row by row.
+    """
+
+    _BLOCK_SIZE = 1024
+
+    # numpy types for struct format characters of fixed size types
+    _numpy_fixed_dtypes = _ColumnarDecoder._numpy_fixed_dtypes
+
+    def __init__(self, serializers):
+        self._serializers = serializers
+        # used for every block which can not be serialized at once
+        self._write_row = _RowEncoder(serializers).write_row
+        # list of tuples (struct format character, length prefix or None)
+        # for columns which can be serialized at once
+        self._formats = formats = []
+        for serializer in serializers:
+            if serializer.fixed_format is not None:
+                formats.append((serializer.fixed_format, None))
+            elif isinstance(serializer, tds_types.BaseTypeSerializerN) and \
+                    serializer._current_subtype.fixed_format is not None:
+                formats.append((serializer._current_subtype.fixed_format, serializer.size))
+            else:
+                self._formats = None
+                break
+        if self._formats is not None:
+            self._row_format = 'B' + ''.join(fmt if prefix is None else 'B' + fmt for fmt, prefix in formats)
+        self._structs = {}
+
+    def write_columns(self, w, columns):
+        """ Writes ROW tokens with values from columns
+
+        :param w: An instance of :class:`_TdsWriter`
+        :param columns: List of tuples ``(values, null_mask)`` in the order of serializers,
+          values are sequences of the same length like lists, :class:`array.array`
+          instances or NumPy arrays, null_mask is a sequence which has true values
+          for NULL cells or None.  None values in lists and masked values of NumPy
+          masked arrays are also treated as NULLs.
+        """
+        columns = [self._unmask(values, mask) for values, mask in columns]
+        num_rows = len(columns[0][0]) if columns else 0
+        for start in xrange(0, num_rows, self._BLOCK_SIZE):
+            end = min(start + self._BLOCK_SIZE, num_rows)
+            block = [(values[start:end], None if mask is None else mask[start:end]) for values, mask in columns]
+            if self._formats is not None and not self._has_nulls(block):
+                self._write_block(w, block, end - start)
+            else:
+                self._write_rows(w, block)
+
+    @staticmethod
+    def _unmask(values, mask):
+        if mask is None and NUMPY_AVAILABLE and isinstance(values, numpy.ma.MaskedArray):
+            return values.data, numpy.ma.getmaskarray(values)
+        return values, mask
+
+    @staticmethod
+    def _has_nulls(block):
+        for values, mask in block:
+            if mask is not None:
+                if NUMPY_AVAILABLE and isinstance(mask, numpy.ndarray):
+                    if mask.any():
+                        return True
+                elif any(mask):
+                    return True
+            if isinstance(values, (list, tuple)) and None in values:
+                return True
+        return False
+
+    def _write_rows(self, w, block):
+        write_row = self._write_row
+        columns = []
+        for values, mask in block:
+            if mask is not None:
+                values = [None if null else value for value, null in zip(values, mask)]
+            columns.append(values)
+        for row in zip(*columns):
+            write_row(w, row)
+
+    def _write_block(self, w, block, size):
+        if NUMPY_AVAILABLE and all(isinstance(values, numpy.ndarray) for values, _ in block):
+            records = self._numpy_block(block, size)
+            if records is not None:
+                w.write(records.tobytes())
+                return
+        struc = self._structs.get(size)
+        if struc is None:
+            struc = self._structs[size] = struct.Struct('<' + self._row_format * size)
+        parts = [itertools.repeat(tds_base.TDS_ROW_TOKEN, size)]
+        for (fmt, prefix), (values, _) in zip(self._formats, block):
+            if prefix is not None:
+                parts.append(itertools.repeat(prefix, size))
+            parts.append(values)
+        w.pack(struc, *itertools.chain.from_iterable(zip(*parts)))
+
+    def _numpy_block(self, block, size):
+        fields = [('t', 'u1')]
+        for i, (fmt, prefix) in enumerate(self._formats):
+            if prefix is not None:
+                fields.append(('n{0}'.format(i), 'u1'))
+            fields.append(('v{0}'.format(i), self._numpy_fixed_dtypes[fmt]))
+        dtype = numpy.dtype(fields)
+        records = numpy.empty(size, dtype=dtype)
+        records['t'] = tds_base.TDS_ROW_TOKEN
+        for i, ((fmt, prefix), (values, _)) in enumerate(zip(self._formats, block)):
+            field = 'v{0}'.format(i)
+            # values which may not fit into column type are packed by struct which checks ranges
+            if not numpy.can_cast(values.dtype, dtype.fields[field][0], 'safe'):
+                return None
+            if prefix is not None:
+                records['n{0}'.format(i)] = prefix
+            records[field] = values
+        return records
 
 
 def _parse_instances(msg):
@@ -491,6 +491,8 @@ class InternalProc(object):
 SP_EXECUTESQL = InternalProc(TDS_SP_EXECUTESQL, 'sp_executesql')
 SP_PREPARE = InternalProc(TDS_SP_PREPARE, 'sp_prepare')
 SP_EXECUTE = InternalProc(TDS_SP_EXECUTE, 'sp_execute')
+SP_PREPEXEC = InternalProc(TDS_SP_PREPEXEC, 'sp_prepexec')
+SP_UNPREPARE = InternalProc(TDS_SP_UNPREPARE, 'sp_unprepare')
 
 
 def skipall(stm, size):
@@ -566,9 +568,10 @@ def readall(stm, size):
 
 def readall_fast(stm, size):
     """
-    Slightly faster version of readall, it reads no more than two chunks.
-    Meaning that it can only be used to read small data that doesn't span
-    more that two packets.
+    Slightly faster version of readall, instead of copying data it returns
+    a buffer and an offset of the data in this buffer.
+    Intended for small data, which stream's read_fast method can usually
+    provide as a single contiguous block.
 
     :param stm: Stream to read from, should have read method.
     :param size: Number of bytes to read.
@@ -577,8 +580,8 @@ def readall_fast(stm, size):
     buf, offset = stm.read_fast(size)
     if len(buf) - offset < size:
         # slow case
-        buf = buf[offset:]
-        buf += stm.recv(size - len(buf))
+        buf = bytearray(buf[offset:])
+        buf += readall(stm, size - len(buf))
         return buf, 0
     return buf, offset
 
@@ -1,3 +1,4 @@
+import array
 import itertools
 import datetime
 import decimal
@@ -6,7 +7,7 @@ import re
 import uuid
 import six
 import functools
-from io import StringIO, BytesIO
+from io import StringIO, BytesIO, RawIOBase, TextIOBase
 
 from pytds.tds_base import read_chunks
 from . import tds_base
@@ -18,6 +19,16 @@ _flt4_struct = struct.Struct('f')
 _flt8_struct = struct.Struct('d')
 _utc = tz.utc
 
+# array typecode for 4 byte signed integers
+_int32_typecode = 'i' if array.array('i').itemsize == 4 else 'l'
+
+# array typecode for 8 byte signed integers, array module of Python 2 does not
+# support them, such columns are stored in lists there
+_int64_typecode = 'q' if 'q' in getattr(array, 'typecodes', '') else None
+
+# number of days between 0001-01-01 and 1970-01-01
+_unix_epoch_days = 719162
+
 
 def _applytz(dt, tzinfo):
     if not tzinfo:
@@ -65,11 +76,16 @@ class PlpReader(object):
         """
         return self._size
 
-    def chunks(self):
+    def chunks(self, views=False):
         """ Generates chunks from stream, each chunk is an instace of bytes.
+
+        :param views: If true chunks are generated as memoryview objects
+          referencing reader's buffer, such chunk is only valid until the next
+          chunk is requested.
         """
         if self.is_null():
             return
+        recv = self._rdr.recv_view if views else self._rdr.recv
         total = 0
         while True:
             chunk_len = self._rdr.get_uint()
@@ -83,10 +99,196 @@ class PlpReader(object):
             total += chunk_len
             left = chunk_len
             while left:
-                buf = self._rdr.recv(left)
+                buf = recv(left)
                 yield buf
                 left -= len(buf)
 
+    def read_all(self):
+        """ Reads whole value into a single buffer
+
+        When total size is known upfront buffer is allocated once and chunks
+        are copied into it directly from the reader's buffer.
+
+        :return: A bytearray with value, or None if value is NULL
+        """
+        if self.is_null():
+            return None
+        if self.is_unknown_len():
+            buf = bytearray()
+            for chunk in self.chunks(views=True):
+                buf += chunk
+            return buf
+        size = self._size
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        for chunk in self.chunks(views=True):
+            end = pos + len(chunk)
+            if end > size:
+                self._rdr.session.bad_stream(
+                    "PLP actual length exceeds reported length (%d)" % size)
+            view[pos:end] = chunk
+            pos = end
+        return buf
+
+
+class LobReader(RawIOBase):
+    """ Lazy reader of VARCHAR(MAX), NVARCHAR(MAX), VARBINARY(MAX) and XML values
+
+    Returned as a value of columns enabled by :meth:`pytds.Cursor.set_lob_readers`.
+    Value is read from the connection on demand, in raw form: text values
+    are encoded using encoding given by :attr:`encoding` attribute, they can
+    be decoded by wrapping reader into :class:`io.TextIOWrapper`.
+
+    Values of a row are received sequentially, so reading a value skips
+    unread parts of values preceding it in the row, and readers of these
+    values become unusable.  Reader is valid only until the next row is
+    fetched, unread part of the value is skipped then.
+    """
+
+    def __init__(self, r, encoding=None, prev=None):
+        """
+        :param r: An instance of :class:`_TdsReader`, or None for NULL value
+        :param encoding: Name of encoding of text value, None for binary value
+        :param prev: Reader of the preceding value in the row
+        """
+        super(LobReader, self).__init__()
+        self._rdr = r
+        self._prev = prev
+        self._plp = None
+        self._chunks = None
+        # unread part of the current chunk
+        self._view = None
+        self._expired = False
+        self.encoding = encoding
+
+    def _start(self):
+        if self._expired:
+            raise tds_base.InterfaceError('LOB value is no longer available, it was skipped')
+        if self._chunks is None:
+            if self._prev is not None:
+                self._prev.expire()
+                self._prev = None
+            if self._rdr is None:
+                self._chunks = iter(())
+            else:
+                self._plp = PlpReader(self._rdr)
+                self._chunks = self._plp.chunks(views=True)
+
+    def is_null(self):
+        """
+        :return: True if value is NULL
+        """
+        self._start()
+        return self._plp is None or self._plp.is_null()
+
+    @property
+    def size(self):
+        """ Total size of value in bytes, None if it is not known upfront or value is NULL """
+        self._start()
+        if self.is_null() or self._plp.is_unknown_len():
+            return None
+        return self._plp.size()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        """ Reads up to len(b) bytes into b
+
+        :return: Number of bytes read, 0 at the end of value
+        """
+        self._start()
+        view = self._view
+        if not view:
+            view = next(self._chunks, None)
+            if view is None:
+                return 0
+        size = min(len(b), len(view))
+        b[:size] = view[:size]
+        self._view = view[size:]
+        return size
+
+    def chunks(self):
+        """ Generates unread chunks of value as memoryview objects
+
+        Chunk references internal buffer of the connection, so it is only
+        valid until the next chunk is requested.
+        """
+        self._start()
+        if self._view:
+            view = self._view
+            self._view = None
+            yield view
+        for view in self._chunks:
+            yield view
+
+    def skip(self):
+        """ Skips unread part of value """
+        for _ in self.chunks():
+            pass
+
+    def expire(self):
+        """ Skips unread part of value and makes reader unusable """
+        if not self._expired:
+            self.skip()
+            self._expired = True
+
+
+# size of chunks read from file-like objects passed as values of MAX types
+_stream_chunk_size = 64 * 1024
+
+
+def _is_stream(val):
+    """ Checks whether value is a file-like object or an iterator of chunks
+
+    Other iterables, like lists or objects supporting buffer protocol,
+    are not streams.  Streams can be read only once.
+    """
+    if isinstance(val, (six.binary_type, six.text_type, bytearray, memoryview)):
+        return False
+    if hasattr(val, 'read') or hasattr(val, 'readinto'):
+        return True
+    return hasattr(val, '__iter__') and iter(val) is val
+
+
+def _write_plp_stream(w, val, codec=None):
+    """ Writes value given by file-like object or iterator of chunks as PLP value of unknown length
+
+    :param w: An instance of :class:`_TdsWriter`
+    :param val: File-like object or iterator of chunks
+    :param codec: Codec used to encode text chunks incrementally,
+      chunks of bytes are written as is
+    """
+    if not isinstance(val, TextIOBase) and hasattr(val, 'readinto'):
+        w.write_plp_from(val.readinto)
+        return
+    if hasattr(val, 'read'):
+        chunks = _read_chunks(val.read)
+    else:
+        chunks = val
+    if codec is not None:
+        chunks = _encode_chunks(chunks, codec)
+    w.write_plp_chunks(chunks)
+
+
+def _read_chunks(read):
+    while True:
+        chunk = read(_stream_chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _encode_chunks(chunks, codec):
+    encoder = codec.incrementalencoder()
+    for chunk in chunks:
+        if isinstance(chunk, six.text_type):
+            yield encoder.encode(chunk)
+        else:
+            yield chunk
+    yield encoder.encode(u'', True)
+
 
 class _StreamChunkedHandler(object):
     def __init__(self, stream):
@@ -298,8 +500,17 @@ class BaseTypeSerializer(tds_base.CommonEqualityMixin):
     In addition actual types should provide the following:
 
     - type - class variable storing type identifier
+
+    Fixed size types which are decoded directly by :mod:`struct` also provide
+    fixed_format - struct format character for the value, it is used by row
+    decoder to unpack runs of such columns with a single call.
+
+    Types which can be stored in :class:`array.array` by columnar fetch
+    provide array_typecode and may override read_array_value.
     """
     type = 0
+    fixed_format = None
+    array_typecode = None
 
     def __init__(self, precision=None, scale=None, size=None):
         self._precision = precision
@@ -362,6 +573,15 @@ class BaseTypeSerializer(tds_base.CommonEqualityMixin):
         """
         raise NotImplementedError
 
+    def read_array_value(self, r):
+        """ Reads value from the stream in a form suitable for storing
+        in an array of array_typecode type.
+
+        :param r: An instance of :class:`_TdsReader` to read value from.
+        :return: A read value or None for NULL.
+        """
+        return self.read(r)
+
     def set_chunk_handler(self, chunk_handler):
         raise ValueError("Column type does not support chunk handler")
 
@@ -413,6 +633,10 @@ class BaseTypeSerializerN(BaseTypeSerializer):
     def get_typeid(self):
         return self._current_subtype.get_typeid()
 
+    @property
+    def array_typecode(self):
+        return self._current_subtype.array_typecode
+
     @classmethod
     def from_stream(cls, r):
         size = r.get_byte()
@@ -491,6 +715,8 @@ class FloatType(SqlTypeMetaclass):
 class BitSerializer(BasePrimitiveTypeSerializer):
     type = tds_base.SYBBIT
     declaration = 'BIT'
+    fixed_format = '?'
+    array_typecode = 'B'
 
     def write(self, w, value):
         w.put_byte(1 if value else 0)
@@ -519,6 +745,8 @@ BitNSerializer.instance = BitNSerializer(BitType())
 class TinyIntSerializer(BasePrimitiveTypeSerializer):
     type = tds_base.SYBINT1
     declaration = 'TINYINT'
+    fixed_format = 'B'
+    array_typecode = 'B'
 
     def write(self, w, val):
         w.put_byte(val)
@@ -532,6 +760,8 @@ TinyIntSerializer.instance = TinyIntSerializer()
 class SmallIntSerializer(BasePrimitiveTypeSerializer):
     type = tds_base.SYBINT2
     declaration = 'SMALLINT'
+    fixed_format = 'h'
+    array_typecode = 'h'
 
     def write(self, w, val):
         w.put_smallint(val)
@@ -545,6 +775,8 @@ SmallIntSerializer.instance = SmallIntSerializer()
 class IntSerializer(BasePrimitiveTypeSerializer):
     type = tds_base.SYBINT4
     declaration = 'INT'
+    fixed_format = 'l'
+    array_typecode = _int32_typecode
 
     def write(self, w, val):
         w.put_int(val)
@@ -558,6 +790,8 @@ IntSerializer.instance = IntSerializer()
 class BigIntSerializer(BasePrimitiveTypeSerializer):
     type = tds_base.SYBINT8
     declaration = 'BIGINT'
+    fixed_format = 'q'
+    array_typecode = _int64_typecode
 
     def write(self, w, val):
         w.put_int8(val)
@@ -603,6 +837,8 @@ class IntNSerializer(BaseTypeSerializerN):
 class RealSerializer(BasePrimitiveTypeSerializer):
     type = tds_base.SYBREAL
     declaration = 'REAL'
+    fixed_format = 'f'
+    array_typecode = 'f'
 
     def write(self, w, val):
         w.pack(_flt4_struct, val)
@@ -616,6 +852,8 @@ RealSerializer.instance = RealSerializer()
 class FloatSerializer(BasePrimitiveTypeSerializer):
     type = tds_base.SYBFLT8
     declaration = 'FLOAT'
+    fixed_format = 'd'
+    array_typecode = 'd'
 
     def write(self, w, val):
         w.pack(_flt8_struct, val)
@@ -726,6 +964,8 @@ class VarCharMaxSerializer(VarChar72Serializer):
     def write(self, w, val):
         if val is None:
             w.put_uint8(tds_base.PLP_NULL)
+        elif _is_stream(val):
+            _write_plp_stream(w, val, self._codec)
         else:
             if w._tds._tds._login.bytes_to_unicode:
                 val = tds_base.force_unicode(val)
@@ -755,10 +995,11 @@ class VarCharMaxSerializer(VarChar72Serializer):
         if r.is_null():
             return None
         if self._chunk_handler is None:
+            # value is collected into a single buffer and decoded at once
+            buf = r.read_all()
             if login.bytes_to_unicode:
-                self._chunk_handler = _DefaultChunkedHandler(StringIO())
-            else:
-                self._chunk_handler = _DefaultChunkedHandler(BytesIO())
+                return self._codec.decode(buf)[0]
+            return bytes(buf)
         if login.bytes_to_unicode:
             for chunk in tds_base.iterdecode(r.chunks(), self._codec):
                 self._chunk_handler.add_chunk(chunk)
@@ -781,7 +1022,7 @@ class NVarChar70Serializer(BaseTypeSerializer):
     @classmethod
     def from_stream(cls, r):
         size = r.get_usmallint()
-        return cls(size / 2)
+        return cls(size // 2)
 
     def write_info(self, w):
         w.put_usmallint(self.size * 2)
@@ -809,7 +1050,7 @@ class NVarChar71Serializer(NVarChar70Serializer):
     def from_stream(cls, r):
         size = r.get_usmallint()
         collation = r.get_collation()
-        return cls(size / 2, collation)
+        return cls(size // 2, collation)
 
     def write_info(self, w):
         super(NVarChar71Serializer, self).write_info(w)
@@ -823,13 +1064,14 @@ class NVarChar72Serializer(NVarChar71Serializer):
         collation = r.get_collation()
         if size == 0xffff:
             return NVarCharMaxSerializer(collation=collation)
-        return cls(size / 2, collation=collation)
+        return cls(size // 2, collation=collation)
 
 
 class NVarCharMaxSerializer(NVarChar72Serializer):
     def __init__(self, collation=raw_collation):
         super(NVarCharMaxSerializer, self).__init__(size=-1, collation=collation)
-        self._chunk_handler = _DefaultChunkedHandler(StringIO())
+        # values are returned as strings unless chunk handler is set
+        self._chunk_handler = None
 
     def __repr__(self):
         return 'NVarCharMax(s={},c={})'.format(self.size, repr(self._collation))
@@ -844,6 +1086,8 @@ class NVarCharMaxSerializer(NVarChar72Serializer):
     def write(self, w, val):
         if val is None:
             w.put_uint8(tds_base.PLP_NULL)
+        elif _is_stream(val):
+            _write_plp_stream(w, val, ucs2_codec)
         else:
             if isinstance(val, bytes):
                 val = tds_base.force_unicode(val)
@@ -870,6 +1114,9 @@ class NVarCharMaxSerializer(NVarChar72Serializer):
         r = PlpReader(r)
         if r.is_null():
             return None
+        if self._chunk_handler is None:
+            # value is collected into a single buffer and decoded at once
+            return ucs2_codec.decode(r.read_all())[0]
         for chunk in tds_base.iterdecode(r.chunks(), ucs2_codec):
             self._chunk_handler.add_chunk(chunk)
         return self._chunk_handler.end()
@@ -1154,6 +1401,8 @@ class VarBinarySerializerMax(VarBinarySerializer):
     def write(self, w, val):
         if val is None:
             w.put_uint8(tds_base.PLP_NULL)
+        elif _is_stream(val):
+            _write_plp_stream(w, val)
         else:
             w.put_uint8(len(val))
             if val:
@@ -1759,6 +2008,7 @@ class MsTimeSerializer(BaseDateTime73Serializer):
 
 class DateTime2Serializer(BaseDateTime73Serializer):
     type = tds_base.SYBMSDATETIME2
+    array_typecode = _int64_typecode
 
     def __init__(self, typ):
         super(DateTime2Serializer, self).__init__(precision=typ.precision,
@@ -1801,6 +2051,20 @@ class DateTime2Serializer(BaseDateTime73Serializer):
             return None
         return self.read_fixed(r, size)
 
+    def read_array_value(self, r):
+        """ Reads value as a number of microseconds since 1970-01-01
+
+        This avoids creation of datetime objects, timezone factory is not
+        applied to the values.
+        """
+        size = r.get_byte()
+        if size == 0:
+            return None
+        buf = tds_base.readall(r, size)
+        ticks = _decode_num(buf[:size - 3]) * 10 ** (7 - self._typ.precision)
+        days = _decode_num(buf[size - 3:])
+        return (days - _unix_epoch_days) * 86400000000 + ticks // 10
+
 
 class DateTimeOffsetSerializer(BaseDateTime73Serializer):
     type = tds_base.SYBMSDATETIMEOFFSET
@@ -1863,6 +2127,10 @@ class MsDecimalSerializer(BaseTypeSerializer):
 
     _info_struct = struct.Struct('BBB')
 
+    # structs for size, sign and mantissa of values of every size,
+    # mantissa is packed as 32-bit words starting with the least significant one
+    _value_structs = dict((size, struct.Struct('<BB' + 'L' * ((size - 1) // 4))) for size in (5, 9, 13, 17))
+
     def __init__(self, precision=18, scale=0):
         super(MsDecimalSerializer, self).__init__(precision=precision,
                                                   scale=scale,
@@ -1897,18 +2165,17 @@ class MsDecimalSerializer(BaseTypeSerializer):
             value = value.normalize()
             scale = self.scale
             size = self.size
-            w.put_byte(size)
             val = value
             positive = 1 if val > 0 else 0
-            w.put_byte(positive)  # sign
             if not positive:
                 val *= -1
-            size -= 1
-            val *= 10 ** scale
-            for i in range(size):
-                w.put_byte(int(val % 256))
-                val //= 256
+            val = int(val * 10 ** scale)
+            words = []
+            for i in range((size - 1) // 4):
+                words.append(val & 0xffffffff)
+                val >>= 32
             assert val == 0
+            w.pack(self._value_structs[size], size, positive, *words)
 
     def _decode(self, positive, buf):
         val = _decode_num(buf)
@@ -2158,8 +2425,20 @@ class TableType(SqlTypeMetaclass):
 class TableValuedParam(SqlValueMetaclass):
     """
     Used to represent a value of table-valued parameter
+
+    Rows can be given by any iterable, e.g. generator, or by an iterable of
+    column batches, every batch is a sequence of columns and every column is a
+    sequence of values, all columns of a batch should have the same length.
+    Rows are consumed while request is sent, so that they are never stored
+    in memory all at once.
+
+    :param type_name: Name of table type, e.g. dbo.MyType
+    :param columns: List of :class:`Column` instances describing columns of
+      table type, when not given types of columns are inferred from the first row
+    :param rows: Iterable of rows, each row is a sequence of values
+    :param column_batches: Iterable of column batches, can be given instead of rows
     """
-    def __init__(self, type_name=None, columns=None, rows=None):
+    def __init__(self, type_name=None, columns=None, rows=None, column_batches=None):
         # parsing type name
         self._typ_schema = ''
         self._typ_name = ''
@@ -2171,6 +2450,10 @@ class TableValuedParam(SqlValueMetaclass):
             if len(parts) > 1:
                 self._typ_schema = parts[0]
 
+        if column_batches is not None:
+            if rows is not None:
+                raise ValueError('Either rows or column_batches should be given, not both')
+            rows = itertools.chain.from_iterable(six.moves.zip(*batch) for batch in column_batches)
         self._columns = columns
         self._rows = rows
 
@@ -2194,6 +2477,11 @@ class TableValuedParam(SqlValueMetaclass):
         return self._rows is None
 
     def peek_row(self):
+        if isinstance(self._rows, (list, tuple)):
+            # sequences can be inspected without consuming them
+            if not self._rows:
+                raise tds_base.DataError("Cannot infer columns from rows for TVP because there are no rows")
+            return self._rows[0]
         try:
             rows = iter(self._rows)
         except TypeError:
@@ -2295,11 +2583,15 @@ class TableSerializer(BaseTypeSerializer):
         # now sending rows using TVP_ROW
         # https://msdn.microsoft.com/en-us/library/dd305261.aspx
         if val.rows:
+            # write methods are selected once, columns with default values are not sent
+            writers = [(i, self._columns_serializers[i].write)
+                       for i, col in enumerate(self._table_type.columns)
+                       if not col.flags & tds_base.TVP_COLUMN_DEFAULT_FLAG]
+            put_byte = w.put_byte
             for row in val.rows:
-                w.put_byte(tds_base.TVP_ROW_TOKEN)
-                for i, col in enumerate(self._table_type.columns):
-                    if not col.flags & tds_base.TVP_COLUMN_DEFAULT_FLAG:
-                        self._columns_serializers[i].write(w, row[i])
+                put_byte(tds_base.TVP_ROW_TOKEN)
+                for i, write in writers:
+                    write(w, row[i])
 
         # terminating rows
         w.put_byte(tds_base.TVP_END_TOKEN)
@@ -2376,6 +2668,39 @@ def sql_type_by_declaration(declaration):
     return _declarations_parser.parse(declaration)
 
 
+def declaration_by_serializer(serializer):
+    """ Returns SQL declaration of the type handled by serializer
+
+    Can be used to declare columns described by COLMETADATA received from the server.
+
+    :param serializer: An instance of :class:`BaseTypeSerializer`
+    :returns: SQL type declaration, e.g. ``NVARCHAR(10)``
+    """
+    typ = getattr(serializer, '_typ', None)
+    if isinstance(typ, SqlTypeMetaclass):
+        return typ.get_declaration()
+    declaration = getattr(serializer, 'declaration', None)
+    if declaration:
+        return declaration
+    if isinstance(serializer, BaseTypeSerializerN):
+        return serializer._current_subtype.declaration
+    if isinstance(serializer, VarCharMaxSerializer):
+        return VarCharMaxType().get_declaration()
+    if isinstance(serializer, NVarCharMaxSerializer):
+        return NVarCharMaxType().get_declaration()
+    if isinstance(serializer, VarBinarySerializerMax):
+        return VarBinaryMaxType().get_declaration()
+    if isinstance(serializer, VarChar70Serializer):
+        return VarCharType(size=serializer.size).get_declaration()
+    if isinstance(serializer, NVarChar70Serializer):
+        return NVarCharType(size=serializer.size).get_declaration()
+    if isinstance(serializer, VarBinarySerializer):
+        return VarBinaryType(size=serializer.size).get_declaration()
+    if isinstance(serializer, MsDecimalSerializer):
+        return DecimalType(precision=serializer.precision, scale=serializer.scale).get_declaration()
+    raise tds_base.NotSupportedError('Cannot declare column of type {0!r}'.format(serializer))
+
+
 class SerializerFactory(object):
     """
     Factory class for TDS data types
@@ -2674,6 +2999,11 @@ class TdsTypeInferrer(object):
                 return DecimalType.from_value(value)
         elif issubclass(value_type, uuid.UUID):
             return UniqueIdentifierType()
+        elif value is not None and hasattr(value, 'read'):
+            # file-like objects are streamed into MAX types
+            if isinstance(value, TextIOBase):
+                return type_factory.long_string_type()
+            return type_factory.long_binary_type()
         elif issubclass(value_type, TableValuedParam):
             columns = value.columns
             rows = value.rows
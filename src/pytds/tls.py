@@ -1,4 +1,6 @@
 import logging
+import ssl
+import threading
 try:
     import OpenSSL.SSL
     import cryptography.hazmat.backends.openssl.backend
@@ -7,6 +9,9 @@ except ImportError:
 else:
     OPENSSL_AVAILABLE = True
 
+# TLS over memory BIOs of the standard ssl module, requires Python 3.5+
+SSL_OBJECT_AVAILABLE = hasattr(ssl, 'MemoryBIO')
+
 from . import tds_base
 
 
@@ -20,6 +25,9 @@ class EncryptedSocket(object):
     def __init__(self, transport, tls_conn):
         self._transport = transport
         self._tls_conn = tls_conn
+        # cancel requests can be sent by other threads while response is received,
+        # TLS connection object is only used under the lock, socket is waited without it
+        self._lock = threading.Lock()
 
     def gettimeout(self):
         return self._transport.gettimeout()
@@ -32,9 +40,11 @@ class EncryptedSocket(object):
         if isinstance(data, bytearray):
             data = bytes(data)
 
-        res = self._tls_conn.sendall(data)
-        buf = self._tls_conn.bio_read(BUFSIZE)
-        self._transport.sendall(buf)
+        with self._lock:
+            res = self._tls_conn.sendall(data)
+            buf = self._tls_conn.bio_read(BUFSIZE)
+            # records should reach the transport in the order they were encrypted
+            self._transport.sendall(buf)
         return res
 
  #   def send(self, data):
@@ -54,21 +64,23 @@ class EncryptedSocket(object):
 
     def recv(self, bufsize):
         while True:
-            try:
-                buf = self._tls_conn.bio_read(bufsize)
-            except OpenSSL.SSL.WantReadError:
-                pass
-            else:
-                self._transport.sendall(buf)
-
-            try:
-                return self._tls_conn.recv(bufsize)
-            except OpenSSL.SSL.WantReadError:
-                buf = self._transport.recv(BUFSIZE)
-                if buf:
-                    self._tls_conn.bio_write(buf)
+            with self._lock:
+                try:
+                    buf = self._tls_conn.bio_read(bufsize)
+                except OpenSSL.SSL.WantReadError:
+                    pass
                 else:
-                    return b''
+                    self._transport.sendall(buf)
+
+                try:
+                    return self._tls_conn.recv(bufsize)
+                except OpenSSL.SSL.WantReadError:
+                    pass
+            buf = self._transport.recv(BUFSIZE)
+            if not buf:
+                return b''
+            with self._lock:
+                self._tls_conn.bio_write(buf)
 
     def close(self):
         self._tls_conn.shutdown()
@@ -78,6 +90,73 @@ class EncryptedSocket(object):
         self._tls_conn.shutdown()
 
 
+class SslObjectSocket(object):
+    """ Encrypted transport built on :class:`ssl.SSLObject` of the standard library
+
+    Unlike :class:`EncryptedSocket` this does not copy data between Python
+    objects, :meth:`sendall` encrypts buffers directly and :meth:`recv_into`
+    decrypts directly into the caller's buffer.
+    """
+    def __init__(self, transport, ssl_obj, incoming, outgoing):
+        self._transport = transport
+        self._ssl_obj = ssl_obj
+        self._incoming = incoming
+        self._outgoing = outgoing
+        self._recv_buf = bytearray(BUFSIZE)
+        self._recv_view = memoryview(self._recv_buf)
+        # same locking rules as for EncryptedSocket
+        self._lock = threading.Lock()
+
+    def gettimeout(self):
+        return self._transport.gettimeout()
+
+    def settimeout(self, timeout):
+        self._transport.settimeout(timeout)
+
+    def sendall(self, data, flags=0):
+        with self._lock:
+            self._ssl_obj.write(data)
+            # records should reach the transport in the order they were encrypted
+            self._transport.sendall(self._outgoing.read())
+
+    def recv_into(self, buffer, size=0):
+        if size == 0:
+            size = len(buffer)
+        while True:
+            with self._lock:
+                try:
+                    return self._ssl_obj.read(size, buffer)
+                except ssl.SSLWantReadError:
+                    pass
+                except ssl.SSLZeroReturnError:
+                    return 0
+                finally:
+                    # reading can produce post-handshake messages, e.g. key updates
+                    if self._outgoing.pending:
+                        self._transport.sendall(self._outgoing.read())
+            received = self._transport.recv_into(self._recv_view, BUFSIZE)
+            if not received:
+                return 0
+            with self._lock:
+                self._incoming.write(self._recv_view[:received])
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        received = self.recv_into(buf, bufsize)
+        return bytes(buf[:received])
+
+    def close(self):
+        self.shutdown()
+        self._transport.close()
+
+    def shutdown(self):
+        # like EncryptedSocket, close notification is only queued and never sent
+        try:
+            self._ssl_obj.unwrap()
+        except ssl.SSLError:
+            pass
+
+
 def verify_cb(conn, cert, err_num, err_depth, ret_code):
     return ret_code == 1
 
@@ -93,24 +172,52 @@ def validate_host(cert, name):
     cn = None
     for t, v in cert.get_subject().get_components():
         if t == b'CN':
-            cn = v
+            cn = v.decode('utf-8')
             break
 
-    if cn == name:
-        return True
-
-    # checking SAN
-    s_name = name.decode('ascii')
+    dns_names = []
     for i in range(cert.get_extension_count()):
         ext = cert.get_extension(i)
         if ext.get_short_name() == b'subjectAltName':
-            s = str(ext)
-            # SANs are usually have form like: DNS:hostname
-            if s.startswith('DNS:') and s[4:] == s_name:
-                return True
+            # SANs are formatted like: DNS:hostname, DNS:otherhost
+            for san in str(ext).split(', '):
+                if san.startswith('DNS:'):
+                    dns_names.append(san[4:])
+
+    return _match_host_name(cn, dns_names, name.decode('ascii'))
+
+
+def validate_peer_cert(cert, name):
+    """
+    Validates host name against certificate returned by :meth:`ssl.SSLObject.getpeercert`,
+    same rules as in :func:`validate_host` are applied
+
+    @param cert: Certificate returned by host, as a dictionary
+    @param name: Actual host name used for connection
+    @return: Returns true if host name matches certificate
+    """
+    cn = None
+    for rdn in cert.get('subject', ()):
+        for t, v in rdn:
+            if t == 'commonName' and cn is None:
+                cn = v
+    dns_names = [v for t, v in cert.get('subjectAltName', ()) if t == 'DNS']
+    return _match_host_name(cn, dns_names, name)
+
+
+def _match_host_name(cn, dns_names, name):
+    """
+    Matches host name against common name and DNS subject alternative names of certificate
 
+    @param cn: Common name of the certificate subject, or None
+    @param dns_names: List of DNS names from subjectAltName extension
+    @param name: Actual host name used for connection
+    @return: Returns true if host name matches certificate
+    """
+    if cn == name:
+        return True
     # TODO handle wildcards
-    return False
+    return name in dns_names
 
 
 def create_context(cafile):
@@ -125,18 +232,63 @@ def create_context(cafile):
     return ctx
 
 
+def create_ssl_context(cafile):
+    """
+    Creates context for the standard library TLS backend
+    @param cafile: Name of the file containing trusted CAs in PEM format
+    @return: ssl.SSLContext
+    """
+    ctx = ssl.create_default_context(cafile=cafile)
+    # host name is validated by validate_tls_connection, using the same rules as with pyOpenSSL
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_REQUIRED
+    # same protocol version as with pyOpenSSL context, handshake wrapped into
+    # PRELOGIN packets is not supported with TLS 1.3
+    if hasattr(ssl, 'TLSVersion'):
+        ctx.maximum_version = ssl.TLSVersion.TLSv1_2
+    else:
+        ctx.options |= getattr(ssl, 'OP_NO_TLSv1_3', 0)
+    return ctx
+
+
+def create_tls_connection(login):
+    """
+    Creates client side TLS connection object for the login
+    @param login: Login object with tls_ctx and server_name attributes
+    @return: OpenSSL.SSL.Connection in client mode
+    """
+    conn = OpenSSL.SSL.Connection(login.tls_ctx)
+    conn.set_tlsext_host_name(login.server_name.encode('ascii'))
+    # change connection to client mode
+    conn.set_connect_state()
+    return conn
+
+
+def validate_tls_connection(conn, login):
+    """
+    Validates server certificate of established TLS connection
+    @param conn: OpenSSL.SSL.Connection with completed handshake
+    @param login: Login object
+    """
+    if login.validate_host:
+        if SSL_OBJECT_AVAILABLE and isinstance(conn, ssl.SSLObject):
+            valid = validate_peer_cert(cert=conn.getpeercert(), name=login.server_name)
+        else:
+            valid = validate_host(cert=conn.get_peer_certificate(), name=login.server_name.encode('ascii'))
+        if not valid:
+            raise tds_base.Error("Certificate does not match host name '{}'".format(login.server_name))
+
+
 # https://msdn.microsoft.com/en-us/library/dd357559.aspx
 def establish_channel(tds_sock):
     w = tds_sock._writer
     r = tds_sock._reader
     login = tds_sock.conn._login
+    if SSL_OBJECT_AVAILABLE and isinstance(login.tls_ctx, ssl.SSLContext):
+        _establish_ssl_object_channel(tds_sock, login)
+        return
 
-    bhost = login.server_name.encode('ascii')
-
-    conn = OpenSSL.SSL.Connection(login.tls_ctx)
-    conn.set_tlsext_host_name(bhost)
-    # change connection to client mode
-    conn.set_connect_state()
+    conn = create_tls_connection(login)
     logger.info('doing TLS handshake')
     while True:
         try:
@@ -156,9 +308,7 @@ def establish_channel(tds_sock):
             conn.bio_write(resp)
         else:
             logger.info('TLS handshake is complete')
-            if login.validate_host:
-                if not validate_host(cert=conn.get_peer_certificate(), name=bhost):
-                    raise tds_base.Error("Certificate does not match host name '{}'".format(login.server_name))
+            validate_tls_connection(conn, login)
             enc_sock = EncryptedSocket(transport=tds_sock.conn.sock, tls_conn=conn)
             tds_sock.conn.sock = enc_sock
             tds_sock._writer._transport = enc_sock
@@ -166,6 +316,40 @@ def establish_channel(tds_sock):
             return
 
 
+def _establish_ssl_object_channel(tds_sock, login):
+    w = tds_sock._writer
+    r = tds_sock._reader
+    incoming = ssl.MemoryBIO()
+    outgoing = ssl.MemoryBIO()
+    conn = login.tls_ctx.wrap_bio(incoming, outgoing, server_side=False, server_hostname=login.server_name)
+    logger.info('doing TLS handshake')
+    while True:
+        try:
+            conn.do_handshake()
+        except ssl.SSLWantReadError:
+            req = outgoing.read()
+            logger.debug('sending %d bytes of the handshake data to the server', len(req))
+            w.begin_packet(tds_base.PacketType.PRELOGIN)
+            w.write(req)
+            w.flush()
+            resp = r.read_whole_packet()
+            logger.debug('adding %d bytes of the response into the TLS connection buffer', len(resp))
+            incoming.write(resp)
+        else:
+            break
+    # when session is resumed client's Finished message is produced after the server's one
+    if outgoing.pending:
+        w.begin_packet(tds_base.PacketType.PRELOGIN)
+        w.write(outgoing.read())
+        w.flush()
+    logger.info('TLS handshake is complete')
+    validate_tls_connection(conn, login)
+    enc_sock = SslObjectSocket(transport=tds_sock.conn.sock, ssl_obj=conn, incoming=incoming, outgoing=outgoing)
+    tds_sock.conn.sock = enc_sock
+    tds_sock._writer._transport = enc_sock
+    tds_sock._reader._transport = enc_sock
+
+
 def revert_to_clear(tds_sock):
     """
     Reverts connection back to non-encrypted mode
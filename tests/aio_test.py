@@ -0,0 +1,191 @@
+import asyncio
+import struct
+import time
+
+import pytest
+
+import pytds
+import pytds.aio
+from pytds.tds_base import PreLoginEnc, PacketType, TDS_DONE_FINAL, TDS_DONE_COUNT
+from unit_test import SimpleServer, address, test_ca, server_key, server_cert, root_ca_path
+import simple_server
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def connect(address, **kwargs):
+    return pytds.aio.connect(
+        dsn=address[0],
+        port=address[1],
+        user='sa',
+        password='password',
+        autocommit=True,
+        **kwargs)
+
+
+def int_result(name, values):
+    # COLMETADATA with single INT column followed by ROW tokens and DONE
+    coded_name = name.encode('utf-16le')
+    resp = (b'\x81' + struct.pack('<h', 1) +
+            b'\x00\x00\x00\x00' + b'\x00\x00' + b'\x38' + struct.pack('B', len(name)) + coded_name)
+    for value in values:
+        resp += b'\xd1' + struct.pack('<l', value)
+    return resp + simple_server.generate_done(TDS_DONE_COUNT, len(values))
+
+
+def test_execute(address):
+    def handler(packet_type, payload):
+        assert packet_type == PacketType.QUERY
+        assert 'select n' in payload.decode('utf-16le', 'ignore')
+        return int_result('n', [1, 2, 3])
+
+    async def main():
+        conn = await connect(address)
+        async with conn:
+            assert not conn.mars_enabled
+            cur = conn.cursor()
+            await cur.execute('select n')
+            assert cur.description[0][0] == 'n'
+            assert await cur.fetchone() == (1,)
+            assert await cur.fetchall() == [(2,), (3,)]
+            assert cur.rowcount == 3
+            await cur.execute('select n')
+            assert [row async for row in cur] == [(1,), (2,), (3,)]
+            assert await cur.execute_scalar('select n') == 1
+            # result set of the last execution can be fetched
+            await cur.executemany('select n', [(), ()])
+            assert await cur.fetchall() == [(1,), (2,), (3,)]
+            assert not await cur.nextset()
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        run(main())
+
+
+class _StreamWriter(object):
+    """ Writer of a connection which does not have a server, written data is discarded """
+    def __init__(self):
+        self.transport = self
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def test_fetch_incrementally():
+    values = list(range(1000))
+    response = int_result('n', values)
+    # payload size is not a multiple of row size, so rows span packets
+    payload_size = 504
+    chunks = [response[i:i + payload_size] for i in range(0, len(response), payload_size)]
+    packets = [struct.pack('>BBHHBx', PacketType.REPLY, 1 if i == len(chunks) - 1 else 0, len(chunk) + 8, 0, i + 1) +
+               chunk for i, chunk in enumerate(chunks)]
+    # ROW token of INT column takes 5 bytes
+    rows_start = len(response) - 5 * len(values) - len(simple_server.generate_done(TDS_DONE_COUNT, 0))
+
+    async def main():
+        reader = asyncio.StreamReader()
+        transport = pytds.aio._AsyncTransport(reader, _StreamWriter())
+        tds = pytds.tds._TdsSocket()
+        tds._main_session = session = pytds.aio._AsyncTdsSession(tds, transport, None)
+        tds.sock = transport
+        tds._is_connected = True
+        conn = pytds.aio.Connection()
+        conn._conn = tds
+        conn._session = session
+        cur = conn.cursor()
+        rows = []
+
+        async def fetch():
+            await cur.execute('select n')
+            async for row in cur:
+                rows.append(row[0])
+
+        task = asyncio.ensure_future(fetch())
+        received = 0
+        for packet in packets:
+            # packets are delivered in two parts
+            for part in (packet[:100], packet[100:]):
+                reader.feed_data(part)
+                for _ in range(10):
+                    await asyncio.sleep(0)
+            received += len(packet) - 8
+            # rows are parsed as soon as they are received, received data is not accumulated
+            assert len(rows) == min(max(received - rows_start, 0) // 5, len(values))
+            assert len(transport._in) <= len(packet)
+        await task
+        assert rows == values
+        assert cur.rowcount == len(values)
+        assert session.state == pytds.tds_base.TDS_IDLE
+
+    run(main())
+
+
+def test_timeout(address):
+    delay = {'value': 0}
+
+    def handler(packet_type, payload):
+        time.sleep(delay['value'])
+        return simple_server.generate_done(TDS_DONE_FINAL)
+
+    async def main():
+        conn = await connect(address, timeout=0.2)
+        async with conn:
+            cur = conn.cursor()
+            delay['value'] = 0.5
+            with pytest.raises(pytds.TimeoutError):
+                await cur.execute('waitfor delay')
+            delay['value'] = 0
+            # late response and cancel acknowledgement are discarded by the next request
+            await cur.execute('select 1')
+            assert conn._session.state == pytds.tds_base.TDS_IDLE
+            assert not conn._session.in_cancel
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        run(main())
+
+
+def test_encryption(server_cert, server_key, address, root_ca_path):
+    async def main():
+        conn = await connect(address, cafile=root_ca_path)
+        async with conn:
+            cur = conn.cursor()
+            await cur.execute('select 1')
+
+    with SimpleServer(address=address, enc=PreLoginEnc.ENCRYPT_ON, cert=server_cert, key=server_key):
+        run(main())
+
+
+def test_pool(address):
+    async def worker(pool):
+        async with pool.acquire() as conn:
+            cur = conn.cursor()
+            await cur.execute('select 1')
+            assert pool.size == 1
+
+    async def main():
+        pool = await pytds.aio.create_pool(
+            max_size=1, dsn=address[0], port=address[1], user='sa', password='password', autocommit=True)
+        await asyncio.gather(worker(pool), worker(pool), worker(pool))
+        assert pool.size == 1
+        await pool.close()
+        with pytest.raises(pytds.InterfaceError):
+            await pool.acquire()
+
+    with SimpleServer(address=address):
+        run(main())
@@ -110,6 +110,27 @@ def test_connection_timeout_with_mars():
         cur.execute('select 1')
 
 
+@unittest.skipUnless(LIVE_TEST, "requires HOST variable to be set")
+def test_execute_concurrently():
+    kwargs = settings.CONNECT_KWARGS.copy()
+    kwargs['database'] = 'master'
+    kwargs['use_mars'] = True
+    with connect(*settings.CONNECT_ARGS, **kwargs) as conn:
+        started = datetime.now()
+        cursors = conn.execute_concurrently([
+            "waitfor delay '00:00:01'; select 1",
+            ("waitfor delay '00:00:01'; select %s", (2,)),
+            "select number from master..spt_values where type = 'P'",
+        ])
+        assert [cur.fetchall() for cur in cursors[:2]] == [[(1,)], [(2,)]]
+        assert len(cursors[2].fetchall()) == 2048
+        assert (datetime.now() - started).total_seconds() < 1.9
+        for cur in cursors:
+            cur.close()
+        with conn.cursor() as cur:
+            assert cur.execute_scalar('select 3') == 3
+
+
 @unittest.skipUnless(LIVE_TEST, "requires HOST variable to be set")
 def test_connection_no_mars_autocommit():
     kwargs = settings.CONNECT_KWARGS.copy()
@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 6):
+    # asyncio interface requires Python 3.5, tests use syntax of Python 3.6
+    collect_ignore.append('aio_test.py')
@@ -232,10 +232,43 @@ class RequestHandler(socketserver.StreamRequestHandler):
 
         w.flush()
 
+        # serve requests until client disconnects
+        while True:
+            try:
+                buf, status = self.read_message(r)
+            except (pytds.tds_base.ClosedConnectionError, OpenSSL.SSL.Error, ConnectionError):
+                return
+            packet_type = r.packet_type
+            logger.info(f"received request of type {packet_type} from client")
+            self.server.requests.append((packet_type, status))
+            if packet_type == pytds.tds_base.PacketType.CANCEL:
+                resp = generate_done(pytds.tds_base.TDS_DONE_CANCELLED)
+            elif self.server._request_handler:
+                resp = self.server._request_handler(packet_type, buf)
+            else:
+                resp = generate_done(pytds.tds_base.TDS_DONE_FINAL)
+            w.begin_packet(pytds.tds_base.PacketType.REPLY)
+            w.write(resp)
+            w.flush()
+
+    def read_message(self, r):
+        # reads all packets up to the one with EOM flag set
+        # returns payload and status of the first packet
+        chunks = [r.read_whole_packet()]
+        status = r._status
+        while not r._status & 1:
+            chunks.append(r.read_whole_packet())
+        return b''.join(chunks), status
+
     def bad_stream(self, msg):
         raise Exception(msg)
 
 
+def generate_done(status, rows_affected=0):
+    # https://msdn.microsoft.com/en-us/library/dd340421.aspx
+    return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, status, 0, rows_affected)
+
+
 class SimpleServer(socketserver.TCPServer):
     allow_reuse_address = True
 
@@ -251,6 +284,9 @@ class SimpleServer(socketserver.TCPServer):
             ctx.use_privatekey(pkey)
         self._tls_ctx = ctx
         self._tds_version = tds_version
+        self._request_handler = None
+        # list of tuples (packet type, status of the first packet) of received requests
+        self.requests = []
 
     def set_ssl_context(self, ctx):
         self._tls_ctx = ctx
@@ -258,6 +294,11 @@ class SimpleServer(socketserver.TCPServer):
     def set_enc(self, enc):
         self._enc = enc
 
+    def set_request_handler(self, handler):
+        # handler is called with packet type and payload of the request
+        # and should return bytes with response tokens
+        self._request_handler = handler
+
 
 def run(address):
     logger.info('Starting server...')
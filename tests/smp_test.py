@@ -144,3 +144,76 @@ def test_misc():
         for _ in range(10):
             mgr.create_session()
     assert "Can't create more MARS sessions" in str(excinfo.value)
+
+
+def test_partial_reads():
+    sock = MockSock()
+    mgr = SmpManager(sock)
+    sess = mgr.create_session()
+    sock.set_input([smp_hdr.pack(0x53, 8, 0, len(b'test') + 16, 1, 10) + b'test'])
+    buf = bytearray(2)
+    assert sess.recv_into(buf) == 2
+    assert buf == b'te'
+    assert sess.recv_into(buf) == 2
+    assert buf == b'st'
+
+
+def test_concurrent_sessions():
+    import socket
+    import threading
+    client, server = socket.socketpair()
+    client.settimeout(5)
+    mgr = SmpManager(client)
+    sessions = [mgr.create_session() for _ in range(3)]
+    # packets of the last session come first, so that other sessions have to wait for it
+    server.sendall(b''.join(smp_hdr.pack(0x53, 8, sid, 16 + 2, seq_num, 10) + struct.pack('<BB', sid, seq_num)
+                            for sid in reversed(range(3)) for seq_num in range(1, 4)))
+    received = {}
+
+    def read(sess):
+        buf = bytearray(100)
+        received[sess.session_id] = [bytes(buf[:sess.recv_into(buf)]) for _ in range(3)]
+
+    threads = [threading.Thread(target=read, args=(sess,)) for sess in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert received == {sid: [struct.pack('<BB', sid, seq_num) for seq_num in range(1, 4)] for sid in range(3)}
+    client.close()
+    server.close()
+
+
+def test_receive_window_grows():
+    sock = MockSock()
+    mgr = SmpManager(sock, initial_window=4, max_window=16)
+    sess = mgr.create_session()
+    sock.consume_output()
+    # server sends as much as window allows, window grows while packets are read promptly
+    sock.set_input([b''.join(smp_hdr.pack(0x53, 8, 0, 16 + 1, seq_num, 10) + b'x' for seq_num in range(1, 41))])
+    buf = bytearray(10)
+    for _ in range(40):
+        assert sess.recv_into(buf) == 1
+    assert sess._recv_window == 16
+    assert sess.high_water_for_recv == 40 + 16
+    output = sock.consume_output()
+    acks = [smp_hdr.unpack_from(output, pos) for pos in range(0, len(output), smp_hdr.size)]
+    assert all(flags == PacketTypes.ACK for _, flags, _, _, _, _ in acks)
+    # one ACK per half of the window instead of one per two packets
+    assert len(acks) < 40 // 2
+    assert acks[-1][5] <= sess.high_water_for_recv
+
+
+def test_session_reuse():
+    sock = MockSock()
+    mgr = SmpManager(sock)
+    sessions = [mgr.create_session() for _ in range(3)]
+    assert [sess.session_id for sess in sessions] == [0, 1, 2]
+    sock.set_input([smp_hdr.pack(0x53, 4, 1, 16, 0, 10)])
+    sessions[1].close()
+    assert sessions[1].get_state() == SessionState.CLOSED
+    sess = mgr.create_session()
+    assert sess is sessions[1]
+    assert sess.session_id == 1
+    assert sess.is_connected()
+    assert mgr.create_session().session_id == 3
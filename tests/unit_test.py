@@ -1,15 +1,21 @@
 # vim: set fileencoding=utf8 :
+import array
 import binascii
+import collections
 import datetime
 import decimal
+import errno
+import io
 import struct
 import unittest
 import uuid
 import socket
+import ssl
 import threading
 import logging
 import sys
 import os
+import time
 
 import pytest
 import OpenSSL.crypto
@@ -36,6 +42,8 @@ from pytds.tds_types import (
     NText70Serializer, Text70Serializer, VarBinarySerializer, VarBinarySerializer72,
     )
 import pytds.login
+import pytds.smp
+from utils import MockSock
 
 tzoffset = pytds.tz.FixedOffsetTimezone
 logger = logging.getLogger(__name__)
@@ -458,6 +466,172 @@ class TestMessages(unittest.TestCase):
             ),
         )
 
+    def _make_result_session(self, columns, rows):
+        def col(type_info, name, flags=0):
+            return (b'\x00\x00\x00\x00' + struct.pack('<H', flags) + type_info +
+                    struct.pack('B', len(name)) + name.encode('utf-16le'))
+        payload = (b'\x81' + struct.pack('<h', len(columns)) +  # COLMETADATA token
+                   b''.join(col(*c) for c in columns) +
+                   b''.join(rows) +
+                   b'\xfd\x00\x00\x00\x00' + b'\x00' * 8)  # DONE token
+        packet = struct.pack('>BBHHBx', 4, 1, len(payload) + 8, 0, 0) + payload
+        sock = _FakeSock([packet])
+        tds = _TdsSocket()
+        tds._main_session = _TdsSession(tds, sock, None)
+        tds.sock = sock
+        sess = tds._main_session
+        sess.state = pytds.tds_base.TDS_PENDING
+        self.assertTrue(sess.find_result_or_done())
+        return sess
+
+    def test_reader_packets_reassembly(self):
+        payload = struct.pack('<lq', 1, 2) + u'test string'.encode('utf-16le') + b'x' * 10000
+        packets = []
+        for i, pos in enumerate(range(0, len(payload), 505)):
+            chunk = payload[pos:pos + 505]
+            status = 1 if pos + 505 >= len(payload) else 0
+            packets.append(struct.pack('>BBHHBx', 4, status, len(chunk) + 8, 0, i) + chunk)
+        # all packets are delivered by a single recv call
+        sock = _FakeSock([b''.join(packets[:3]), b''.join(packets[3:])])
+        tds = _TdsSocket()
+        tds._main_session = _TdsSession(tds, sock, None)
+        tds.sock = sock
+        r = tds._main_session._reader
+        r.set_block_size(512)
+        self.assertEqual(1, r.get_int())
+        self.assertEqual(2, r.get_int8())
+        self.assertEqual(u'test string', r.read_ucs2(11))
+        view = r.read_view(1000)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(b'x' * 1000, view.tobytes())
+        self.assertEqual(b'x' * 9000, pytds.tds_base.readall(r, 9000))
+        with self.assertRaises(pytds.ClosedConnectionError):
+            r.get_byte()
+
+    def test_row_decoding(self):
+        sess = self._make_result_session(
+            [(b'\x38', 'c1'),  # INT
+             (b'\x3e', 'c2'),  # FLOAT
+             (b'\x26\x04', 'c3', Column.fNullable),  # INTN(4)
+             (b'\x32', 'c4'),  # BIT
+             (b'\x7f', 'c5')],  # BIGINT
+            [b'\xd1' +  # ROW token
+             struct.pack('<ld', 1, 2.5) + b'\x04' + struct.pack('<l?q', 3, True, 5),
+             b'\xd2'  # NBCROW token
+             b'\x04' +  # null bitmap, c3 is null
+             struct.pack('<ld?q', -1, 0.5, False, 2 ** 40)])
+        self.assertEqual([1, 2.5, 3, True, 5], sess.fetchone())
+        self.assertEqual([-1, 0.5, None, False, 2 ** 40], sess.fetchone())
+        self.assertIsNone(sess.fetchone())
+        self.assertEqual(2, sess.res_info.row_count)
+
+    def test_token_dispatch(self):
+        sess = self._make_result_session(
+            [(b'\x38', 'c1')],  # INT
+            [b'\xd1' + struct.pack('<l', 1),
+             b'\xa9' + struct.pack('<hh', 2, 1),  # ORDER token
+             b'\xd2\x00' + struct.pack('<l', 2),
+             b'\x79' + struct.pack('<l', 5),  # RETURNSTATUS token
+             b'\xd1' + struct.pack('<l', 3),
+             b'\x01'])  # invalid token
+        self.assertEqual([1], sess.fetchone())
+        self.assertEqual([2], sess.fetchone())
+        self.assertEqual([3], sess.fetchone())
+        self.assertEqual(5, sess.ret_status)
+        with self.assertRaises(pytds.InterfaceError):
+            sess.fetchone()
+
+    def test_fetch_columns(self):
+        epoch_date = struct.pack('<l', 719162)[:3]
+        sess = self._make_result_session(
+            [(b'\x38', 'c1'),  # INT
+             (b'\x3e', 'c2'),  # FLOAT
+             (b'\x26\x04', 'c3', Column.fNullable),  # INTN(4)
+             (b'\x2a\x07', 'c4', Column.fNullable)],  # DATETIME2(7)
+            [b'\xd1' + struct.pack('<ld', 1, 2.5) + b'\x04' + struct.pack('<l', 3) +
+             b'\x08' + struct.pack('<q', 15)[:5] + epoch_date,  # 1.5 microseconds after epoch
+             b'\xd2\x0c' + struct.pack('<ld', 2, 0.5),  # c3 and c4 are null
+             b'\xd1' + struct.pack('<ld', 3, 1.0) + b'\x04' + struct.pack('<l', 4) +
+             b'\x08' + struct.pack('<q', 10 ** 7)[:5] + epoch_date])
+        columns = sess.fetch_columns(2)
+        self.assertEqual(4, len(columns))
+        self.assertEqual([1, 2], list(columns[0][0]))
+        self.assertIsNone(columns[0][1])
+        self.assertEqual([2.5, 0.5], list(columns[1][0]))
+        self.assertEqual([3, 0], list(columns[2][0]))
+        self.assertEqual([False, True], [bool(v) for v in columns[2][1]])
+        self.assertEqual([False, True], [bool(v) for v in columns[3][1]])
+        if not pytds.tds.NUMPY_AVAILABLE:
+            self.assertEqual([1, 0], list(columns[3][0]))
+        columns = sess.fetch_columns()
+        self.assertEqual([3], list(columns[0][0]))
+        self.assertEqual([4], list(columns[2][0]))
+        if not pytds.tds.NUMPY_AVAILABLE:
+            self.assertEqual([1000000], list(columns[3][0]))
+        self.assertEqual(3, sess.res_info.row_count)
+        self.assertEqual([[] for _ in range(4)], [list(values) for values, _ in sess.fetch_columns()])
+
+    def _make_int64_result_session(self):
+        epoch_date = struct.pack('<l', 719162)[:3]
+        return self._make_result_session(
+            [(b'\x7f', 'c1'),  # BIGINT
+             (b'\x26\x08', 'c2', Column.fNullable),  # INTN(8)
+             (b'\x2a\x07', 'c3', Column.fNullable)],  # DATETIME2(7)
+            [b'\xd1' + struct.pack('<q', 2 ** 40) + b'\x08' + struct.pack('<q', -5) +
+             b'\x08' + struct.pack('<q', 15)[:5] + epoch_date,  # 1.5 microseconds after epoch
+             b'\xd2\x06' + struct.pack('<q', -1)])  # c2 and c3 are null
+
+    def test_fetch_columns_int64_arrays(self):
+        numpy_available = pytds.tds.NUMPY_AVAILABLE
+        pytds.tds.NUMPY_AVAILABLE = False
+        try:
+            columns = self._make_int64_result_session().fetch_columns()
+            self.assertEqual([array.array('q', [2 ** 40, -1]), array.array('q', [-5, 0]), array.array('q', [1, 0])],
+                             [values for values, _ in columns])
+            self.assertEqual([False, True], [bool(v) for v in columns[2][1]])
+
+            # array module of Python 2 does not support 8 byte integers
+            serializers = pytds.tds_types.BigIntSerializer, pytds.tds_types.DateTime2Serializer
+            for serializer in serializers:
+                serializer.array_typecode = None
+            try:
+                columns = self._make_int64_result_session().fetch_columns()
+            finally:
+                for serializer in serializers:
+                    serializer.array_typecode = pytds.tds_types._int64_typecode
+            self.assertEqual([[2 ** 40, -1], [-5, None], [1, None]], [values for values, _ in columns])
+            self.assertEqual([False, True], [bool(v) for v in columns[1][1]])
+        finally:
+            pytds.tds.NUMPY_AVAILABLE = numpy_available
+
+    @unittest.skipUnless(pytds.tds.NUMPY_AVAILABLE, 'requires NumPy')
+    def test_fetch_columns_numpy(self):
+        import numpy
+        epoch_date = struct.pack('<l', 719162)[:3]
+        sess = self._make_result_session(
+            [(b'\x38', 'c1'),  # INT
+             (b'\x32', 'c2'),  # BIT
+             (b'\x7f', 'c3'),  # BIGINT
+             (b'\x26\x08', 'c4', Column.fNullable),  # INTN(8)
+             (b'\x2a\x07', 'c5', Column.fNullable)],  # DATETIME2(7)
+            [b'\xd1' + struct.pack('<l?q', 1, True, 2 ** 40) + b'\x08' + struct.pack('<q', -5) +
+             b'\x08' + struct.pack('<q', 10 ** 7)[:5] + epoch_date,  # 1 second after epoch
+             b'\xd2\x18' + struct.pack('<l?q', 2, False, -1)])  # c4 and c5 are null
+        columns = sess.fetch_columns()
+        # run of fixed size columns is split into arrays of its columns
+        ints, bits, bigints = [values for values, _ in columns[:3]]
+        self.assertEqual([None] * 3, [nulls for _, nulls in columns[:3]])
+        self.assertEqual((numpy.dtype('<i4'), [1, 2]), (ints.dtype, ints.tolist()))
+        self.assertEqual((numpy.dtype('bool'), [True, False]), (bits.dtype, bits.tolist()))
+        self.assertEqual((numpy.dtype('<i8'), [2 ** 40, -1]), (bigints.dtype, bigints.tolist()))
+        values, nulls = columns[3]
+        self.assertEqual((numpy.dtype('int64'), [-5, 0]), (values.dtype, values.tolist()))
+        self.assertEqual((numpy.dtype('bool'), [False, True]), (nulls.dtype, nulls.tolist()))
+        values, nulls = columns[4]
+        self.assertEqual(numpy.dtype('datetime64[us]'), values.dtype)
+        self.assertEqual(numpy.datetime64('1970-01-01T00:00:01', 'us'), values[0])
+        self.assertEqual([False, True], nulls.tolist())
+
     def test_types(self):
         tds = _TdsSocket()
         tds.tds_version = TDS72
@@ -874,6 +1048,25 @@ class TypeInferenceTestCase(unittest.TestCase):
         self.assertEqual(res.table_type.columns, [Column(type=IntType()),
                                                   Column(type=NVarCharMaxType())])
 
+    def test_tvp_column_batches(self):
+        consumed = []
+
+        def batches_gen():
+            for start in (0, 2):
+                consumed.append(start)
+                yield [[start, start + 1], ['a', 'b']]
+
+        factory = SerializerFactory(TDS74)
+        tvp = pytds.TableValuedParam(type_name='dbo.CategoryTableType', column_batches=batches_gen())
+        res = infer_tds_serializer(tvp, serializer_factory=factory, collation=raw_collation)
+        # only first batch is read to infer types of columns
+        self.assertEqual(consumed, [0])
+        self.assertEqual(res.table_type.columns, [Column(type=IntType()),
+                                                  Column(type=NVarCharMaxType())])
+        self.assertEqual(list(tvp.rows), [(0, 'a'), (1, 'b'), (2, 'a'), (3, 'b')])
+        with self.assertRaises(ValueError):
+            pytds.TableValuedParam(rows=[], column_batches=[])
+
     def test_null_tvp(self):
         factory = SerializerFactory(TDS74)
         tvp = pytds.TableValuedParam(type_name='dbo.CategoryTableType')
@@ -1068,6 +1261,110 @@ class MiscTestCase(unittest.TestCase):
         self.assertEqual(b'\x7f$-\x00\xff\x81\x8b\x01', DateTimeSerializer.encode(DateTime.MAX_PYDATETIME))
 
 
+class _FakeTdsSocket(object):
+    def __init__(self):
+        self.sock = None
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def _acquire_new(self, pool):
+        entry = pool.acquire(timeout=0)
+        self.assertIsNone(entry.tds_socket)
+        entry.attach(_FakeTdsSocket(), None)
+        return entry
+
+    def test_max_size(self):
+        pool = pytds._Pool(max_size=2)
+        e1 = self._acquire_new(pool)
+        e2 = self._acquire_new(pool)
+        with self.assertRaises(pytds.TimeoutError):
+            pool.acquire(timeout=0.01)
+        self.assertEqual(1, pool.stats()['timeouts'])
+
+        # blocked acquire is woken up when connection is released
+        result = []
+        thread = threading.Thread(target=lambda: result.append(pool.acquire(timeout=5)))
+        thread.start()
+        pool.release(e1)
+        thread.join()
+        self.assertIs(e1, result[0])
+        pool.release(e1)
+        pool.release(e2)
+        self.assertEqual({'size': 2, 'idle': 2, 'in_use': 0, 'waiting': 0, 'max_size': 2, 'min_size': 0,
+                          'opened': 2, 'closed': 0, 'timeouts': 1}, pool.stats())
+
+    def test_dead_connections_discarded(self):
+        pool = pytds._Pool(max_size=1)
+        entry = self._acquire_new(pool)
+        pool.release(entry)
+        entry.tds_socket.connected = False
+        # dead idle connection is replaced by a new slot
+        self.assertIsNone(pool.acquire(timeout=0).tds_socket)
+        self.assertEqual(1, pool.stats()['closed'])
+
+    def test_eviction(self):
+        pool = pytds._Pool(max_size=3, min_size=1, idle_timeout=10, max_lifetime=100)
+        entries = [self._acquire_new(pool) for _ in range(3)]
+        for entry in entries:
+            pool.release(entry)
+        for entry in entries:
+            entry.last_used -= 20
+        # idle connections above min_size are evicted
+        entry = pool.acquire(timeout=0)
+        self.assertEqual(1, pool.stats()['size'])
+        self.assertEqual(2, len([e for e in entries if not e.tds_socket.connected]))
+        # connections exceeding lifetime are not returned into the pool
+        entry.created -= 200
+        pool.release(entry)
+        self.assertFalse(entry.tds_socket.connected)
+        self.assertEqual(0, pool.stats()['size'])
+
+    def test_eviction_without_traffic(self):
+        pool = pytds._Pool(max_size=3, min_size=1, idle_timeout=0.05, max_lifetime=0.3)
+        entries = [self._acquire_new(pool) for _ in range(3)]
+        for entry in entries:
+            pool.release(entry)
+        # idle connections above min_size are closed by background thread
+        for _ in range(100):
+            if pool.stats()['size'] == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, pool.stats()['size'])
+        self.assertEqual(2, len([e for e in entries if not e.tds_socket.connected]))
+        # connection kept for min_size is closed when its lifetime ends
+        for _ in range(100):
+            if pool.stats()['size'] == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(0, pool.stats()['size'])
+        self.assertFalse(any(e.tds_socket.connected for e in entries))
+        # thread is stopped when there are no idle connections
+        for _ in range(100):
+            if not pool._reaping:
+                break
+            time.sleep(0.01)
+        self.assertFalse(pool._reaping)
+
+    def test_prewarm(self):
+        pool = pytds._Pool(max_size=3, min_size=2)
+        entry = self._acquire_new(pool)
+        pool.prewarm(lambda: (_FakeTdsSocket(), None))
+        for _ in range(100):
+            if pool.stats()['idle'] == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(2, pool.stats()['size'])
+        self.assertEqual(1, pool.stats()['idle'])
+        pool.release(entry)
+
+
 class SimpleServer(object):
     def __init__(self, address, enc=pytds.PreLoginEnc.ENCRYPT_NOT_SUP, cert=None, key=None, tds_version=pytds.tds_base.TDS74):
         if os.environ.get('INAPPVEYOR', '') == '1':
@@ -1304,6 +1601,981 @@ def test_cert_with_san(test_ca, server_key, address, root_ca_path):
             pass
 
 
+def test_ssl_tls_backend(test_ca, server_cert, server_key, address, root_ca_path):
+    value = u'x' * 100000
+
+    def handler(packet_type, payload):
+        encoded = value.encode('utf-16le')
+        resp = (b'\x81' + struct.pack('<h', 1) +
+                struct.pack('<LHBH', 0, 1, pytds.tds_base.XSYBNVARCHAR, 0xffff) + b'\x09\x04\xd0\x00\x34' +
+                b'\x03' + 'doc'.encode('utf-16le'))
+        resp += b'\xd1' + struct.pack('<QL', len(encoded), len(encoded)) + encoded + struct.pack('<L', 0)
+        return resp + struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1)
+
+    params = dict(dsn=address[0], port=address[1], user='sa', password='password', disable_connect_retry=True,
+                  autocommit=True, cafile=root_ca_path, tls_backend='ssl')
+    # TLS 1.3 is not used, same as with pyOpenSSL
+    assert pytds.tls.create_ssl_context(root_ca_path).maximum_version == ssl.TLSVersion.TLSv1_2
+    with SimpleServer(address=address, enc=PreLoginEnc.ENCRYPT_ON, cert=server_cert, key=server_key) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(**params) as conn:
+            assert isinstance(conn._conn.sock, pytds.tls.SslObjectSocket)
+            assert conn._conn.sock._ssl_obj.version() == 'TLSv1.2'
+            with conn.cursor() as cur:
+                cur.execute('select doc from t')
+                assert cur.fetchall() == [(value,)]
+
+    with SimpleServer(address=address, enc=PreLoginEnc.ENCRYPT_OFF, cert=server_cert, key=server_key):
+        with pytds.connect(enc_login_only=True, **params) as conn:
+            assert not isinstance(conn._conn.sock, pytds.tls.SslObjectSocket)
+
+    from cryptography import x509
+    bad_server_cert = test_ca.sign(name='badname', cb=x509.CertificateBuilder().subject_name(x509.Name([
+        x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, 'badname')]))
+                                   .not_valid_before(datetime.datetime.utcnow())
+                                   .not_valid_after(datetime.datetime.utcnow() + datetime.timedelta(days=1))
+                                   .serial_number(x509.random_serial_number())
+                                   .public_key(server_key.public_key()))
+    with SimpleServer(address=address, enc=PreLoginEnc.ENCRYPT_OFF, cert=bad_server_cert, key=server_key):
+        with pytest.raises(pytds.Error) as excinfo:
+            pytds.connect(**params)
+        assert 'Certificate does not match host name' in str(excinfo.value)
+
+    with pytest.raises(ValueError):
+        pytds.connect(**dict(params, tls_backend='gnutls'))
+
+
+def test_pooled_connection(address):
+    params = dict(dsn=address[0], port=address[1], user='sa', password='password',
+                  disable_connect_retry=True, autocommit=True, pooling=True, max_pool_size=1, pool_timeout=0.1)
+    with SimpleServer(address=address) as server:
+        conn = pytds.connect(**params)
+        tds_socket = conn._conn
+        with pytest.raises(pytds.TimeoutError):
+            pytds.connect(**params)
+        conn.close()
+        # connection is taken from the pool and reset with the first request
+        with pytds.connect(**params) as conn:
+            assert conn._conn is tds_socket
+            assert server._server.requests == []
+            with conn.cursor() as cur:
+                cur.execute('select 1')
+                cur.execute('select 1')
+        assert server._server.requests == [
+            (pytds.tds_base.PacketType.QUERY, 0x09),  # EOM | RESETCONNECTION
+            (pytds.tds_base.PacketType.QUERY, 0x01),
+        ]
+        stats = [s for s in pytds.pool_stats().values() if s['max_size'] == 1]
+        assert stats[0]['size'] == 1
+        assert stats[0]['idle'] == 1
+        tds_socket.close()
+
+
+def test_prepared_statements_cache(address):
+    handles = iter(range(7, 100))
+    procs = []
+
+    def handler(packet_type, payload):
+        if packet_type == pytds.tds_base.PacketType.QUERY:
+            return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, 0, 0, 0)
+        headers_size, = struct.unpack_from('<L', payload)
+        name_len, proc_id = struct.unpack_from('<hH', payload, headers_size)
+        assert name_len == -1
+        procs.append(proc_id)
+        done_proc = struct.pack('<BHHQ', pytds.tds_base.TDS_DONEPROC_TOKEN, 0, 0, 0)
+        if b'\xff\xff' + struct.pack('<H', pytds.tds_base.TDS_SP_PREPEXEC) in payload:
+            # RETURNVALUE token with handle of prepared statement
+            return (struct.pack('<BHBBLH', pytds.tds_base.TDS_PARAM_TOKEN, 0, 0, 1, 0, 0) +
+                    b'\x26\x04\x04' + struct.pack('<l', next(handles)) +
+                    done_proc)
+        return done_proc
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True, prepared_cache_size=1) as conn:
+            with conn.cursor() as cur:
+                cur.execute('select %s', (1,))
+                cur.execute('select %s', (2,))
+                # evicts first statement
+                cur.execute('select %s, 1', (3,))
+                cur.execute('select %s, 1', (4,))
+                # statements without parameters are not prepared
+                cur.execute('select 1')
+            assert len(conn._conn.prepared_cache) == 1
+    assert procs[:4] == [
+        pytds.tds_base.TDS_SP_PREPEXEC,
+        pytds.tds_base.TDS_SP_EXECUTE,
+        pytds.tds_base.TDS_SP_UNPREPARE,
+        pytds.tds_base.TDS_SP_EXECUTE,
+    ]
+    assert len(procs) == 4
+
+
+class _CacheSession(object):
+    """ Session stub for testing of prepared statements cache """
+    def __init__(self):
+        self.output_params = {}
+        self.state = pytds.tds_base.TDS_IDLE
+
+    def make_param(self, name, value):
+        return value
+
+    def submit(self, submitted):
+        # what submit_rpcs does before response is read
+        self.output_params = {}
+        self.state = pytds.tds_base.TDS_PENDING
+        if submitted is not None:
+            submitted()
+
+    def receive_handle(self, handle):
+        self.output_params[0] = pytds.tds_base.Column(value=handle)
+        self.state = pytds.tds_base.TDS_IDLE
+
+
+def test_prepared_statements_cache_mars_sessions():
+    from pytds.tds import _PreparedStatementCache
+    cache = _PreparedStatementCache(1)
+    a = _CacheSession()
+    b = _CacheSession()
+
+    def procs(session, operation):
+        calls, submitted = cache.make_calls(session, operation, ('@P1 int',), [1])
+        session.submit(submitted)
+        handle_procs = (pytds.tds_base.TDS_SP_EXECUTE, pytds.tds_base.TDS_SP_UNPREPARE)
+        return ['{0} {1}'.format(call[0].name, call[1][0]) if call[0].proc_id in handle_procs else call[0].name
+                for call in calls]
+
+    assert procs(a, 'select @P1') == ['sp_prepexec']
+    # statement is still being prepared by session a
+    assert procs(b, 'select @P1') == ['sp_executesql']
+    a.receive_handle(7)
+    assert procs(b, 'select @P1') == ['sp_execute 7']
+
+    # statement evicted while being prepared is unprepared when its handle is known
+    b.state = pytds.tds_base.TDS_IDLE
+    assert procs(a, 'select @P1, 1') == ['sp_unprepare 7', 'sp_prepexec']
+    assert procs(b, 'select @P1, 2') == ['sp_prepexec']
+    a.receive_handle(8)
+    b.receive_handle(9)
+    assert procs(a, 'select @P1, 2') == ['sp_unprepare 8', 'sp_execute 9']
+    a.state = pytds.tds_base.TDS_IDLE
+
+    # statement prepared by two sessions concurrently, second handle is released
+    cache.clear()
+    calls_a, submitted_a = cache.make_calls(a, 'select 3', ('@P1 int',), [1])
+    calls_b, submitted_b = cache.make_calls(b, 'select 3', ('@P1 int',), [1])
+    a.submit(submitted_a)
+    b.submit(submitted_b)
+    a.receive_handle(10)
+    b.receive_handle(11)
+    assert procs(a, 'select 3') == ['sp_unprepare 11', 'sp_execute 10']
+
+
+def test_executemany_batches(address):
+    batches = []
+
+    def handler(packet_type, payload):
+        if packet_type == pytds.tds_base.PacketType.QUERY:
+            batches.append(0)
+            return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1)
+        calls = payload.count(b'\xff\xff' + struct.pack('<H', pytds.tds_base.TDS_SP_EXECUTESQL))
+        batches.append(calls)
+        resp = b''
+        for i in range(calls):
+            status = pytds.tds_base.TDS_DONE_COUNT
+            if i < calls - 1:
+                status |= pytds.tds_base.TDS_DONE_MORE_RESULTS
+            # statement count followed by count of the procedure
+            resp += struct.pack('<BHHQ', pytds.tds_base.TDS_DONEINPROC_TOKEN,
+                                pytds.tds_base.TDS_DONE_COUNT | pytds.tds_base.TDS_DONE_MORE_RESULTS, 0, 1)
+            resp += struct.pack('<BHHQ', pytds.tds_base.TDS_DONEPROC_TOKEN, status, 0, 1)
+        return resp
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                cur.executemany('insert into t values (%s)', [(i,) for i in range(7)], batch_size=3)
+                assert batches == [3, 3, 1]
+                assert cur.rowcount == 7
+                del batches[:]
+                # sets without parameters are sent as separate batches
+                cur.executemany('insert into t values (%s)', [(1,), (None,), (2,)])
+                assert batches == [1, 0, 1]
+                assert cur.rowcount == 3
+
+
+def test_executemany_last_result(address):
+    requests = []
+
+    def handler(packet_type, payload):
+        requests.append(packet_type)
+        # result of INSERT ... OUTPUT with number of the request
+        return (b'\x81' + struct.pack('<h', 1) +  # COLMETADATA with single INT column
+                struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x01' + 'n'.encode('utf-16le') +
+                b'\xd1' + struct.pack('<l', len(requests)) +
+                struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1))
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                # without batching result set of the last execution can be fetched
+                cur.executemany('insert into t output inserted.n values (%s)', [(1,), (2,), (3,)])
+                assert len(requests) == 3
+                assert cur.fetchall() == [(3,)]
+
+
+def test_executemany_failure_in_the_middle(address):
+    rpc_marker = b'\xff\xff' + struct.pack('<H', pytds.tds_base.TDS_SP_EXECUTESQL)
+    applied = []
+
+    def handler(packet_type, payload):
+        calls = payload.split(rpc_marker)[1:]
+        resp = b''
+        for i, call in enumerate(calls):
+            # value of the only INT parameter
+            pos = call.rindex(b'\x26\x04\x04')
+            value, = struct.unpack_from('<l', call, pos + 3)
+            status = 0
+            if i < len(calls) - 1:
+                status |= pytds.tds_base.TDS_DONE_MORE_RESULTS
+            if value == 2:
+                # server executes following calls of the request even if this one fails
+                resp += (b'\xaa' + struct.pack('<HlBB', 22, 50000, 1, 16) +  # ERROR token
+                         struct.pack('<H', 4) + 'fail'.encode('utf-16le') + b'\x00\x00' + struct.pack('<l', 1))
+                status |= pytds.tds_base.TDS_DONE_ERROR
+            else:
+                applied.append(value)
+                status |= pytds.tds_base.TDS_DONE_COUNT
+            resp += struct.pack('<BHHQ', pytds.tds_base.TDS_DONEPROC_TOKEN, status, 0, 1)
+        return resp
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                # by default executions stop at the first failure
+                with pytest.raises(pytds.DatabaseError):
+                    cur.executemany('insert into t values (%s)', [(i,) for i in range(6)])
+                assert applied == [0, 1]
+
+                # rest of the failed batch is applied, following batches are not sent
+                del applied[:]
+                with pytest.raises(pytds.DatabaseError):
+                    cur.executemany('insert into t values (%s)', [(i,) for i in range(6)], batch_size=4)
+                assert applied == [0, 1, 3]
+
+
+def test_observer(address):
+    response = (b'\x81' + struct.pack('<h', 1) +  # COLMETADATA with single INT column
+                struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x01' + 'n'.encode('utf-16le') +
+                b''.join(b'\xd1' + struct.pack('<l', i) for i in range(3)) +
+                struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 3))
+
+    class Observer(pytds.Observer):
+        def __init__(self):
+            self.started = []
+            self.finished = []
+
+        def request_started(self, stats):
+            self.started.append(stats)
+
+        def request_finished(self, stats):
+            self.finished.append(stats)
+
+    observer = Observer()
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(lambda packet_type, payload: response)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute('select n')
+                assert cur.fetchall() == [(0,), (1,), (2,)]
+                assert observer.started == []
+                conn.observer = observer
+                cur.execute('select n')
+                assert len(observer.started) == 1
+                assert observer.finished == []
+                assert cur.fetchall() == [(0,), (1,), (2,)]
+                assert cur._session._stats is None
+                conn.observer = None
+                cur.execute('select n')
+                cur.fetchall()
+    assert len(observer.finished) == 1
+    stats = observer.finished[0]
+    assert stats.packet_type == pytds.tds_base.PacketType.QUERY
+    assert stats.rows == 3
+    assert stats.rows_affected == 3
+    assert stats.packets_sent == 1
+    assert stats.bytes_sent == 8 + 22 + len('select n'.encode('utf-16le'))
+    assert stats.packets_received == 1
+    assert stats.bytes_received == 8 + len(response)
+    assert stats.start_time <= stats.first_byte_time <= stats.first_row_time <= stats.end_time
+    assert 0 <= stats.wait_time <= stats.duration
+    assert not stats.cancelled
+
+
+def test_observer_first_row_of_skipped_results(address):
+    response = (b'\x81' + struct.pack('<h', 1) +  # COLMETADATA with single INT column
+                struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x01' + 'n'.encode('utf-16le') +
+                b'\xd1' + struct.pack('<l', 1) +
+                struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1))
+    finished = []
+
+    class Observer(pytds.Observer):
+        def request_finished(self, stats):
+            finished.append(stats)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(lambda packet_type, payload: response)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True, observer=Observer()) as conn:
+            with conn.cursor() as cur:
+                # rows of batched statements are skipped by handlers from the token table
+                cur.executemany('insert into t output inserted.n values (%s)', [(1,), (2,)], batch_size=2)
+    stats, = finished
+    assert stats.rows == 1
+    assert stats.first_row_time is not None
+
+
+class _OperationsObserver(pytds.Observer):
+    def __init__(self):
+        self.started = []
+        self.finished = []
+
+    def operation_started(self, operation):
+        self.started.append(operation)
+
+    def operation_finished(self, operation):
+        self.finished.append(operation)
+
+
+def _bulk_handler(packet_type, payload):
+    done = struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 2)
+    if packet_type == pytds.tds_base.PacketType.BULK:
+        return done
+    query = payload.decode('utf-16le', 'ignore')
+    if 'select top 0' in query:
+        # COLMETADATA with INT NOT NULL column
+        return (b'\x81' + struct.pack('<h', 1) +
+                struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x03' + 'num'.encode('utf-16le') + done)
+    if 'raiserror' in query:
+        return (b'\xaa' + struct.pack('<HlBB', 22, 50000, 1, 16) +  # ERROR token
+                struct.pack('<H', 4) + 'fail'.encode('utf-16le') + b'\x00\x00' + struct.pack('<l', 1) +
+                struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_ERROR, 0, 0))
+    return done
+
+
+def test_observer_operations(address):
+    observer = _OperationsObserver()
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(_bulk_handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True, observer=observer) as conn:
+            with conn.cursor() as cur:
+                cur.execute('update t set num = 1')
+                cur.copy_to(data=[(1,), (2,)], table_or_view='t', columns=['num'])
+                with pytest.raises(pytds.OperationalError):
+                    cur.execute('raiserror')
+    assert observer.started == observer.finished
+    execute, copy, failed = observer.finished
+    assert (execute.kind, execute.operation, execute.server) == ('execute', 'update t set num = 1', address[0])
+    assert execute.rowcount == 2
+    assert execute.error is None
+    assert len(execute.requests) == 1
+    assert execute.bytes_sent == execute.requests[0].bytes_sent > 0
+    assert execute.duration >= 0
+    # statements executed by copy_to are included into the copy_to operation
+    assert (copy.kind, copy.operation) == ('copy_to', 't')
+    assert [stats.packet_type for stats in copy.requests] == [
+        pytds.tds_base.PacketType.QUERY, pytds.tds_base.PacketType.QUERY, pytds.tds_base.PacketType.BULK]
+    assert isinstance(failed.error, pytds.OperationalError)
+
+
+def test_observer_operation_includes_fetch(address):
+    response = (b'\x81' + struct.pack('<h', 1) +  # COLMETADATA with single INT column
+                struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x01' + 'n'.encode('utf-16le') +
+                b''.join(b'\xd1' + struct.pack('<l', i) for i in range(3)) +
+                struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 3))
+    observer = _OperationsObserver()
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(lambda packet_type, payload: response)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True, observer=observer) as conn:
+            # server which is not connected is at the head of the list of servers
+            conn._login.servers = collections.deque([('failed.example.com', 1433, '')] + list(conn._login.servers))
+            with conn.cursor() as cur:
+                cur.execute('select n')
+                assert observer.finished == []
+                assert cur.fetchall() == [(0,), (1,), (2,)]
+                select, = observer.finished
+                assert (select.server, select.port) == (address[0], address[1])
+                assert select.rows == 3
+                assert select.rowcount == 3
+                assert select.bytes_received == 8 + len(response)
+
+                # operation is completed when cursor is reused before results are consumed
+                cur.execute('select n')
+                cur.fetchone()
+                cur.execute('select n')
+                assert len(observer.finished) == 2
+                # and when cursor is closed
+            assert len(observer.finished) == 3
+    assert observer.started == observer.finished
+
+
+def test_otel_observer(address):
+    pytest.importorskip('opentelemetry.sdk')
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+    from pytds.otel import OpenTelemetryObserver
+
+    exporter = InMemorySpanExporter()
+    tracer_provider = TracerProvider()
+    tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+    reader = InMemoryMetricReader()
+    observer = OpenTelemetryObserver(tracer_provider=tracer_provider,
+                                     meter_provider=MeterProvider(metric_readers=[reader]))
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(_bulk_handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True, observer=observer) as conn:
+            with conn.cursor() as cur:
+                cur.execute("update t set num = 1 where name = 'x'")
+                with pytest.raises(pytds.OperationalError):
+                    cur.execute('raiserror')
+    update, failed = exporter.get_finished_spans()
+    assert update.name == 'UPDATE'
+    assert update.attributes['db.query.text'] == 'update t set num = ? where name = ?'
+    assert update.attributes['server.address'] == address[0]
+    assert update.attributes['db.mssql.rows_affected'] == 2
+    assert update.attributes['db.mssql.bytes_sent'] > 0
+    assert not failed.status.is_ok
+    assert failed.attributes['db.response.status_code'] == '50000'
+    metrics = reader.get_metrics_data().resource_metrics[0].scope_metrics[0].metrics
+    assert [m.name for m in metrics] == ['db.client.operation.duration']
+    assert sum(point.count for point in metrics[0].data.data_points) == 2
+
+
+def test_fingerprint():
+    from pytds.otel import fingerprint
+    assert fingerprint("select *  from t1\nwhere a = 10 and b = N'it''s' and c in (0x0A, 1.5e3)") == \
+        'select * from t1 where a = ? and b = ? and c in (?, ?)'
+
+
+def test_statement_timeout(address):
+    delay = {'value': 0}
+
+    def handler(packet_type, payload):
+        if delay['value']:
+            # slow statement is interrupted, acknowledgement of cancel request follows
+            time.sleep(delay['value'])
+            return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_MORE_RESULTS, 0, 0)
+        return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute('select 1', timeout=1)
+                assert cur.rowcount == 1
+                assert cur._session._deadline is None
+
+                delay['value'] = 0.3
+                started = time.time()
+                with pytest.raises(pytds.TimeoutError):
+                    cur.execute("waitfor delay '00:00:05'", timeout=0.25)
+                assert cur._session.state == pytds.tds_base.TDS_IDLE
+                assert not cur._session.in_cancel
+
+                # cancel from another thread ends the statement without error
+                canceller = threading.Timer(0.1, cur.cancel)
+                canceller.start()
+                cur.execute("waitfor delay '00:00:05'")
+                canceller.join()
+                assert time.time() - started < 2
+                assert cur._session.state == pytds.tds_base.TDS_IDLE
+
+                delay['value'] = 0
+                cur.execute('select 1')
+                assert cur.rowcount == 1
+    assert [t for t, _ in server._server.requests].count(pytds.tds_base.PacketType.CANCEL) == 2
+
+
+def test_statement_timeout_not_acknowledged(address):
+    def handler(packet_type, payload):
+        time.sleep(1)
+        return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, 0, 0, 0)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                started = time.time()
+                with pytest.raises(pytds.TimeoutError):
+                    cur.execute("waitfor delay '00:00:05'", timeout=0.1)
+                assert time.time() - started < 0.9
+                assert not conn._conn.is_connected()
+
+
+class _ResetOnSend(object):
+    """ Wraps socket to simulate connection reset on the next send """
+    def __init__(self, sock):
+        self._sock = sock
+
+    def sendall(self, data, flags=0):
+        self._sock.close()
+        raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def test_retry_after_connection_reset(address):
+    delay = {'value': 0}
+    requests = []
+
+    def handler(packet_type, payload):
+        requests.append(packet_type)
+        if delay['value']:
+            time.sleep(delay['value'])
+            return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_MORE_RESULTS, 0, 0)
+        if packet_type == pytds.tds_base.PacketType.RPC:
+            return struct.pack('<BHHQ', pytds.tds_base.TDS_DONEPROC_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1)
+        return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1)
+
+    def reset_on_send(conn):
+        old = conn._conn
+        old._main_session._writer._transport = _ResetOnSend(old._main_session._writer._transport)
+        return old
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                old = reset_on_send(conn)
+                cur.execute('select %s', (1,))
+                assert conn._conn is not old
+                assert cur._session is conn._conn._main_session
+                assert cur.rowcount == 1
+                assert requests == [pytds.tds_base.PacketType.RPC]
+
+                old = reset_on_send(conn)
+                cur.executemany('select %s', [(1,), (2,), (3,)], batch_size=2)
+                assert conn._conn is not old
+                # both batches are sent over the new connection
+                assert requests.count(pytds.tds_base.PacketType.RPC) == 3
+
+                # retried request has the deadline of the statement
+                old = reset_on_send(conn)
+                delay['value'] = 0.3
+                with pytest.raises(pytds.TimeoutError):
+                    cur.execute('select %s', (1,), timeout=0.1)
+                assert conn._conn is not old
+
+
+def test_no_retry_with_streamed_params(address):
+    requests = []
+
+    def handler(packet_type, payload):
+        requests.append(payload)
+        return struct.pack('<BHHQ', pytds.tds_base.TDS_DONEPROC_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 1)
+
+    def reset_on_send(conn):
+        conn._assert_open()
+        conn._conn._main_session._writer._transport = _ResetOnSend(conn._conn._main_session._writer._transport)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                # stream is consumed by the first attempt, request is not resent
+                reset_on_send(conn)
+                with pytest.raises(socket.error):
+                    cur.execute('insert into t values (%s)', (io.BytesIO(b'data'),))
+
+                reset_on_send(conn)
+                with pytest.raises(socket.error):
+                    cur.executemany('insert into t values (%s)',
+                                    [(Column(type=VarBinaryMaxType(), value=iter([b'da', b'ta'])),)])
+
+                # values which are not streams are resent
+                reset_on_send(conn)
+                cur.execute('insert into t values (%s)', (Column(type=VarBinaryMaxType(), value=b'data'),))
+                assert cur.rowcount == 1
+    assert len(requests) == 1
+
+
+def test_execute_concurrently_requires_mars(address):
+    with SimpleServer(address=address) as server:
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with pytest.raises(pytds.InterfaceError):
+                conn.execute_concurrently(['select 1', 'select 2'])
+
+
+class _ScriptedSmpSock(MockSock):
+    """ Socket of MARS connection with scripted responses, SMP FIN packets fail """
+    def __init__(self, input_packets=()):
+        super(_ScriptedSmpSock, self).__init__(input_packets)
+        self.sent_before_recv = None
+
+    def recv(self, size):
+        if self.sent_before_recv is None:
+            self.sent_before_recv = list(self._out_packets)
+        return super(_ScriptedSmpSock, self).recv(size)
+
+    def sendall(self, buf, flags=0):
+        if pytds.smp.SMP_HEADER.unpack(buf[:pytds.smp.SMP_HEADER.size])[1] == pytds.smp.PacketTypes.FIN:
+            raise socket.error(errno.EPIPE, 'Broken pipe')
+        super(_ScriptedSmpSock, self).sendall(buf, flags)
+
+
+def _smp_data_packets(responses, packet_size=32):
+    """ Splits TDS responses of SMP sessions into packets and interleaves them
+
+    :param responses: List of tuples of SMP session id and TDS response
+    """
+    streams = []
+    for sid, response in responses:
+        chunk_size = packet_size - pytds.tds._header.size
+        chunks = [response[i:i + chunk_size] for i in range(0, len(response), chunk_size)]
+        packets = []
+        for i, chunk in enumerate(chunks):
+            status = 1 if i == len(chunks) - 1 else 0  # end of message
+            packet = pytds.tds._header.pack(pytds.tds_base.PacketType.REPLY, status,
+                                                 pytds.tds._header.size + len(chunk), 0, i + 1) + chunk
+            packets.append(pytds.smp.SMP_HEADER.pack(pytds.smp.SMP_ID, pytds.smp.PacketTypes.DATA, sid,
+                                                     pytds.smp.SMP_HEADER.size + len(packet), i + 1, 4) + packet)
+        streams.append(packets)
+    result = []
+    for i in range(max(len(packets) for packets in streams)):
+        result.extend(packets[i] for packets in streams if i < len(packets))
+    return result
+
+
+def _int_result(values):
+    return (b'\x81' + struct.pack('<h', 1) +  # COLMETADATA with single INT column
+            struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x01' + 'n'.encode('utf-16le') +
+            b''.join(b'\xd1' + struct.pack('<l', value) for value in values) +
+            struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, len(values)))
+
+
+def _scripted_mars_connection(sock):
+    login = _TdsLogin()
+    login.bytes_to_unicode = True
+    login.servers = collections.deque([('localhost', 1433, '')])
+    tds = _TdsSocket()
+    tds._login = login
+    tds.sock = sock
+    tds._main_session = _TdsSession(tds, sock, None)
+    tds._mars_enabled = True
+    tds._finish_login(None)
+    conn = pytds.Connection()
+    conn._login = login
+    conn._conn = tds
+    conn._main_cursor = conn._active_cursor = pytds._MarsCursor(conn, tds.create_session(None), None)
+    return conn
+
+
+def test_execute_concurrently():
+    # main session is 0, session of main cursor is 1, statements are executed in sessions 2, 3 and 4
+    sock = _ScriptedSmpSock(_smp_data_packets([
+        (2, _int_result([1, 2, 3])),
+        (3, _int_result([10, 20, 30, 40])),
+        (4, _int_result([100])),
+    ]))
+    conn = _scripted_mars_connection(sock)
+    observer = _OperationsObserver()
+    conn.observer = observer
+    first, second, third = conn.execute_concurrently(['select 1', ('select %s', (2,)), 'select 3'])
+    # all requests are sent before responses are read
+    sent = [pytds.smp.SMP_HEADER.unpack(buf[:pytds.smp.SMP_HEADER.size]) for buf in sock.sent_before_recv]
+    assert [sid for _, flags, sid, _, _, _ in sent if flags == pytds.smp.PacketTypes.DATA] == [2, 3, 4]
+    assert [operation.operation for operation in observer.started] == ['select 1', 'select %s', 'select 3']
+    assert observer.finished == []
+    assert third.fetchall() == [(100,)]
+    assert first.fetchall() == [(1,), (2,), (3,)]
+    assert second.fetchall() == [(10,), (20,), (30,), (40,)]
+    assert observer.finished == [observer.started[2], observer.started[0], observer.started[1]]
+    assert [operation.rows for operation in observer.started] == [3, 4, 1]
+
+
+def test_execute_concurrently_error():
+    error = (b'\xaa' + struct.pack('<HlBB', 22, 50000, 1, 16) +  # ERROR token
+             struct.pack('<H', 4) + 'fail'.encode('utf-16le') + b'\x00\x00' + struct.pack('<l', 1) +
+             struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_ERROR, 0, 0))
+    sock = _ScriptedSmpSock(_smp_data_packets([
+        (2, _int_result([1])),
+        (3, error),
+    ]))
+    conn = _scripted_mars_connection(sock)
+    observer = _OperationsObserver()
+    conn.observer = observer
+    # closing of cursors fails, original error is raised
+    with pytest.raises(pytds.OperationalError, match='fail'):
+        conn.execute_concurrently(['select 1', 'raiserror'])
+    # failed statement is completed first, other one when its cursor is closed
+    assert observer.finished == [observer.started[1], observer.started[0]]
+    assert observer.started[0].error is None
+    assert isinstance(observer.started[1].error, pytds.OperationalError)
+
+
+def test_copy_to_native_types(address):
+    bulk_loads = []
+    queries = []
+
+    def handler(packet_type, payload):
+        if packet_type == pytds.tds_base.PacketType.BULK:
+            bulk_loads.append(payload)
+            rows = payload.count(b'\xd1')
+            return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, rows)
+        query = payload.decode('utf-16le', 'ignore')
+        queries.append(query)
+        if 'select top 0' in query:
+            # COLMETADATA with INT NOT NULL column and NVARCHAR(10) NULL column
+            return (b'\x81' + struct.pack('<h', 2) +
+                    struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x03' + 'num'.encode('utf-16le') +
+                    struct.pack('<LHBH', 0, 1, pytds.tds_base.XSYBNVARCHAR, 20) + b'\x09\x04\xd0\x00\x34' +
+                    b'\x04' + 'data'.encode('utf-16le') +
+                    struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, 0, 0, 0))
+        return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, 0, 0, 0)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                rows = iter([(1, u'a'), (2, None), (3, u'c')])
+                cur.copy_to(data=rows, table_or_view='t', columns=['num', 'data'], rows_per_batch=2)
+                assert cur.rowcount == 3
+    assert 'select top 0 [num],[data] from [t]' in queries[0]
+    assert 'INSERT BULK [t]([num] INT,[data] NVARCHAR(10))' in queries[1]
+    assert len(bulk_loads) == 2
+    assert bulk_loads[0].endswith(
+        b'\xd1' + struct.pack('<lH', 1, 2) + u'a'.encode('utf-16le') +
+        b'\xd1' + struct.pack('<lH', 2, 0xffff) +
+        struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_FINAL, 0, 0))
+    assert b'\xd1' + struct.pack('<lH', 3, 2) + u'c'.encode('utf-16le') in bulk_loads[1]
+
+
+def test_copy_from_columns(address):
+    bulk_loads = []
+
+    def handler(packet_type, payload):
+        if packet_type == pytds.tds_base.PacketType.BULK:
+            bulk_loads.append(payload)
+            return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 3)
+        if 'select top 0' in payload.decode('utf-16le', 'ignore'):
+            # COLMETADATA with INT NOT NULL column and INT NULL column
+            return (b'\x81' + struct.pack('<h', 2) +
+                    struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x03' + 'num'.encode('utf-16le') +
+                    struct.pack('<LHBB', 0, 1, pytds.tds_base.SYBINTN, 4) + b'\x03' + 'val'.encode('utf-16le') +
+                    struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, 0, 0, 0))
+        return struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, 0, 0, 0)
+
+    def rows(*values):
+        return b''.join(b'\xd1' + struct.pack('<l', num) + (b'\x00' if val is None else struct.pack('<Bl', 4, val))
+                        for num, val in values)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                cur.copy_from_columns('t', {'num': array.array('i', [1, 2, 3]), 'val': [10, 20, 30]})
+                assert cur.rowcount == 3
+                cur.copy_from_columns('t', {'num': [1, 2, 3], 'val': array.array('i', [10, 20, 30])},
+                                      null_masks={'val': [False, True, False]})
+                cur.copy_from_columns('t', {'num': [1, 2, 3], 'val': [10, 20, None]}, rows_per_batch=2)
+                with pytest.raises(ValueError):
+                    cur.copy_from_columns('t', {'num': [1, 2, 3], 'val': [10]})
+    done = struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_FINAL, 0, 0)
+    assert bulk_loads[0].endswith(rows((1, 10), (2, 20), (3, 30)) + done)
+    assert bulk_loads[1].endswith(rows((1, 10), (2, None), (3, 30)) + done)
+    assert bulk_loads[2].endswith(rows((1, 10), (2, 20)) + done)
+    assert bulk_loads[3].endswith(rows((3, None)) + done)
+    assert len(bulk_loads) == 4
+
+
+def test_writer_pack():
+    class Transport(object):
+        def __init__(self):
+            self.packets = []
+
+        def sendall(self, buf, flags=0):
+            self.packets.append(bytes(buf))
+
+    class Session(object):
+        _transport = Transport()
+
+    w = pytds.tds._TdsWriter(Session(), 16)
+    w.begin_packet(pytds.tds_base.PacketType.QUERY)
+    w.write(b'abcdef')
+    # does not fit into the rest of the packet
+    w.put_int8(1)
+    MsDecimalSerializer(precision=18, scale=2).write(w, decimal.Decimal('-12.345'))
+    MsDecimalSerializer(precision=38, scale=0).write(w, decimal.Decimal(2 ** 100))
+    w.flush()
+    packets = Session._transport.packets
+    assert all(len(packet) <= 16 for packet in packets)
+    payload = b''.join(packet[8:] for packet in packets)
+    assert payload == (b'abcdef' + struct.pack('<q', 1) +
+                       struct.pack('<BBQ', 9, 0, 1234) +
+                       struct.pack('<BBQQ', 17, 1, 0, 2 ** 36))
+
+
+def test_lob_readers(address):
+    def plp(chunks, size=pytds.tds_base.PLP_UNKNOWN):
+        return (struct.pack('<Q', size) + b''.join(struct.pack('<L', len(chunk)) + chunk for chunk in chunks) +
+                struct.pack('<L', 0))
+
+    def handler(packet_type, payload):
+        resp = (b'\x81' + struct.pack('<h', 3) +
+                struct.pack('<LHB', 0, 0, pytds.tds_base.SYBINT4) + b'\x02' + 'id'.encode('utf-16le') +
+                struct.pack('<LHBH', 0, 1, pytds.tds_base.XSYBNVARCHAR, 0xffff) + b'\x09\x04\xd0\x00\x34' +
+                b'\x03' + 'doc'.encode('utf-16le') +
+                struct.pack('<LHBH', 0, 1, pytds.tds_base.XSYBVARBINARY, 0xffff) + b'\x03' + 'bin'.encode('utf-16le'))
+        resp += (b'\xd1' + struct.pack('<l', 1) +
+                 plp([u'hello '.encode('utf-16le'), u'world'.encode('utf-16le')]) +
+                 plp([b'\x01\x02', b'\x03'], size=3))
+        resp += b'\xd1' + struct.pack('<lQ', 2, pytds.tds_base.PLP_NULL) + plp([b'xyz'])
+        return resp + struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 2)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute('select id, doc, bin from t')
+                cur.set_lob_readers(1)
+                id, doc, data = cur.fetchone()
+                assert id == 1
+                assert doc.encoding == 'utf-16-le'
+                assert io.TextIOWrapper(io.BufferedReader(doc), encoding=doc.encoding).read() == u'hello world'
+                assert data.size == 3
+                buf = bytearray(2)
+                assert data.readinto(buf) == 2
+                assert buf == b'\x01\x02'
+                assert [bytes(chunk) for chunk in data.chunks()] == [b'\x03']
+                assert data.read() == b''
+                id, doc, data = cur.fetchone()
+                assert id == 2
+                assert doc.is_null()
+                # unread value is skipped when next row is fetched
+                assert cur.fetchone() is None
+                with pytest.raises(pytds.InterfaceError):
+                    data.read()
+
+                cur.execute('select id, doc, bin from t')
+                cur.set_lob_readers(1)
+                id, doc, data = cur.fetchone()
+                # reading value skips preceding values
+                assert data.read() == b'\x01\x02\x03'
+                with pytest.raises(pytds.InterfaceError):
+                    doc.read()
+                assert [row[0] for row in cur.fetchall()] == [2]
+
+
+def test_stream_lob_params():
+    class Transport(object):
+        def __init__(self):
+            self.packets = []
+
+        def sendall(self, buf, flags=0):
+            self.packets.append(bytes(buf))
+
+    class Session(object):
+        _transport = Transport()
+
+    def plp_chunks(payload):
+        # parses PLP value of unknown length into list of chunks
+        assert struct.unpack_from('<Q', payload)[0] == pytds.tds_base.PLP_UNKNOWN
+        pos = 8
+        chunks = []
+        while True:
+            size, = struct.unpack_from('<L', payload, pos)
+            pos += 4
+            if not size:
+                assert pos == len(payload)
+                return chunks
+            chunks.append(payload[pos:pos + size])
+            pos += size
+
+    w = pytds.tds._TdsWriter(Session(), 64)
+    w.begin_packet(pytds.tds_base.PacketType.RPC)
+    data = bytes(bytearray(range(256))) * 2
+    VarBinarySerializerMax().write(w, io.BytesIO(data))
+    w.flush()
+    packets = Session._transport.packets
+    assert all(len(packet) <= 64 for packet in packets)
+    chunks = plp_chunks(b''.join(packet[8:] for packet in packets))
+    assert b''.join(chunks) == data
+    # chunks are read directly into packets and fill them
+    assert max(len(chunk) for chunk in chunks) == 64 - 8 - 4
+
+    del packets[:]
+    w.begin_packet(pytds.tds_base.PacketType.RPC)
+    NVarCharMaxSerializer().write(w, iter([u'hello ', b'', u'world']))
+    w.flush()
+    chunks = plp_chunks(b''.join(packet[8:] for packet in packets))
+    assert b''.join(chunks).decode('utf-16le') == u'hello world'
+
+    # only file-like objects and iterators are streams, other values are written whole
+    for value in (io.BytesIO(b'abc'), iter([b'abc']), (chunk for chunk in [b'abc'])):
+        assert pytds.tds_types._is_stream(value)
+    for value in (b'abc', bytearray(b'abc'), array.array('B', b'abc'), [1, 2], (b'abc',), {'a': 1}):
+        assert not pytds.tds_types._is_stream(value)
+    del packets[:]
+    w.begin_packet(pytds.tds_base.PacketType.RPC)
+    VarBinarySerializerMax().write(w, array.array('B', b'abc'))
+    w.flush()
+    assert b''.join(packet[8:] for packet in packets) == struct.pack('<QL', 3, 3) + b'abc' + struct.pack('<L', 0)
+
+    factory = SerializerFactory(TDS74)
+    assert infer_tds_serializer(io.BytesIO(), serializer_factory=factory) == VarBinarySerializerMax()
+    assert isinstance(infer_tds_serializer(io.StringIO(), serializer_factory=factory, collation=raw_collation),
+                      NVarCharMaxSerializer)
+
+
+def test_nvarchar_max_read(address):
+    def plp(chunks, size=pytds.tds_base.PLP_UNKNOWN):
+        return (struct.pack('<Q', size) + b''.join(struct.pack('<L', len(chunk)) + chunk for chunk in chunks) +
+                struct.pack('<L', 0))
+
+    value = u'\u0444\u044b\u0432' * 5000
+    encoded = value.encode('utf-16le')
+
+    def handler(packet_type, payload):
+        resp = (b'\x81' + struct.pack('<h', 1) +
+                struct.pack('<LHBH', 0, 1, pytds.tds_base.XSYBNVARCHAR, 0xffff) + b'\x09\x04\xd0\x00\x34' +
+                b'\x03' + 'doc'.encode('utf-16le'))
+        resp += b'\xd1' + plp([encoded[:1001], encoded[1001:]], size=len(encoded))
+        resp += b'\xd1' + plp([encoded[:3], encoded[3:]])
+        resp += b'\xd1' + struct.pack('<Q', pytds.tds_base.PLP_NULL)
+        return resp + struct.pack('<BHHQ', pytds.tds_base.TDS_DONE_TOKEN, pytds.tds_base.TDS_DONE_COUNT, 0, 3)
+
+    with SimpleServer(address=address) as server:
+        server._server.set_request_handler(handler)
+        with pytds.connect(dsn=address[0], port=address[1], user='sa', password='password',
+                           disable_connect_retry=True, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute('select doc from t')
+                assert cur.fetchall() == [(value,), (value,), (None,)]
+
+
 def test_ntlm():
     # test NTLM packet generation without actual server
     auth = pytds.login.NtlmAuth(user_name='testuser', password='password')